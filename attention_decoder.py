@@ -23,7 +23,9 @@ def attention_decoder(decoder_inputs,
                       pointer_gen=True,
                       use_coverage=False,
                       prev_t_coverage=None,
-                      prev_b_coverage=None):
+                      prev_b_coverage=None,
+                      t_keys=None,
+                      b_keys=None):
     """
     Args:
         decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -40,6 +42,9 @@ def attention_decoder(decoder_inputs,
         use_coverage: boolean. If True, use coverage mechanism.
         prev_coverage:
             If not None, a tensor with shape (batch_size, attn_length). The previous step's coverage vector. This is only not None in decode mode when using coverage.
+        t_keys, b_keys:
+            Optional. The encoder features of the encoder and brand states, from decoder_attention_keys.
+            If None, they are computed here.
 
     Returns:
         outputs: A list of the same length as decoder_inputs of 2D Tensors of
@@ -50,107 +55,15 @@ def attention_decoder(decoder_inputs,
         coverage: Coverage vector on the last step computed. None if use_coverage=False.
     """
     with variable_scope.variable_scope("attention_decoder") as scope:
-        # if this line fails, it's because the batch size isn't defined
-        batch_size = encoder_states.get_shape()[0].value
-
-        if prev_t_coverage is not None and prev_b_coverage is not None:
-            # reshape from (batch_size, attn_length) to (batch_size, attn_len, 1, 1)
-            prev_t_coverage = tf.expand_dims(tf.expand_dims(prev_t_coverage, 2), 3)
-            prev_b_coverage = tf.expand_dims(tf.expand_dims(prev_b_coverage, 2), 3)
-
-        def attention(encoder_states, padding_mask, decoder_state, name, coverage=None):
-            """Calculate the context vector and attention distribution from the decoder state.
-
-            Args:
-                decoder_state: state of the decoder
-                coverage: Optional. Previous timestep's coverage vector, shape (batch_size, attn_len, 1, 1).
-
-            Returns:
-                context_vector: weighted sum of encoder_states
-                attn_dist: attention distribution
-                coverage: new coverage vector. shape (batch_size, attn_len, 1, 1)
-            """
-            with variable_scope.variable_scope(name):
-                # if this line fails, it's because the attention length isn't defined
-                attn_size = encoder_states.get_shape()[2].value
-
-                # To calculate attention, we calculate
-                # v^T tanh(W_h h_i + W_s s_t + b_attn)
-                # where h_i is an encoder state, and s_t a decoder state.
-                # attn_vec_size is the length of the vectors v, b_attn, (W_h h_i) and (W_s s_t).
-                # We set it to be equal to the size of the encoder states.
-                attention_vec_size = attn_size
-
-                # Reshape encoder_states (need to insert a dim)
-                # now is shape (batch_size, attn_len, 1, attn_size)
-                encoder_states = tf.expand_dims(encoder_states, axis=2)
-
-                # Get the weight matrix W_h and apply it to each encoder state to get (W_h h_i), the encoder features
-                W_h = variable_scope.get_variable("W_h", [1, 1, attn_size, attention_vec_size])
-                # shape (batch_size,attn_length,1,attention_vec_size)
-                encoder_features = nn_ops.conv2d(encoder_states, W_h, [1, 1, 1, 1], "SAME")
-
-                # Get the weight vectors v and w_c (w_c is for coverage)
-                v = variable_scope.get_variable("v", [attention_vec_size])
-                if use_coverage:
-                    with variable_scope.variable_scope("coverage"):
-                        w_c = variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
-
-                # Pass the decoder state through a linear layer (this is W_s s_t + b_attn in the paper)
-                # shape (batch_size, attention_vec_size)
-                decoder_features = linear(decoder_state, attention_vec_size, True)
-                # reshape to (batch_size, 1, 1, attention_vec_size)
-                decoder_features = tf.expand_dims(tf.expand_dims(decoder_features, 1), 1)
-
-                def masked_attention(e, padding_mask):
-                    """Take softmax of e then apply padding_mask and re-normalize"""
-                    # take softmax. shape (batch_size, attn_length)
-                    attn_dist = nn_ops.softmax(e)
-                    attn_dist *= padding_mask  # apply mask
-                    # shape (batch_size)
-                    masked_sums = tf.reduce_sum(attn_dist, axis=1)
-                    # re-normalize
-                    return attn_dist / tf.reshape(masked_sums, [-1, 1])
-
-                if use_coverage and coverage is not None:  # non-first step of coverage
-                    # Multiply coverage vector by w_c to get coverage_features.
-                    # c has shape (batch_size, attn_length, 1, attention_vec_size)
-                    coverage_features = nn_ops.conv2d(coverage, w_c, [1, 1, 1, 1], "SAME")
-
-                    # Calculate v^T tanh(W_h h_i + W_s s_t + w_c c_i^t + b_attn)
-                    # shape (batch_size,attn_length)
-                    e = math_ops.reduce_sum(
-                        v * math_ops.tanh(encoder_features + decoder_features +
-                                          coverage_features), [2, 3])
-
-                    # Calculate attention distribution
-                    attn_dist = masked_attention(e, padding_mask)
-                    # Update coverage vector
-                    # coverage += array_ops.reshape(attn_dist, [batch_size, -1, 1, 1])
-                else:
-                    # Calculate v^T tanh(W_h h_i + W_s s_t + b_attn)
-                    e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features), [2, 3])
-
-                    # Calculate attention distribution
-                    attn_dist = masked_attention(e, padding_mask)
-                    # initialize coverage
-                    # if use_coverage:  # first step of training
-                    #     coverage = tf.expand_dims(tf.expand_dims(attn_dist, 2), 2)
-                
-                # Calculate the context vector from attn_dist and encoder_states
-                context_vector = math_ops.reduce_sum(
-                    array_ops.reshape(attn_dist, [batch_size, -1, 1, 1]) *
-                    encoder_states, [1, 2]) 
-                # shape (batch_size, attn_size).
-                context_vector = array_ops.reshape(context_vector, [-1, attn_size])
-
-                if use_coverage:
-                    if coverage is not None:
-                        coverage += array_ops.reshape(attn_dist, [batch_size, -1, 1, 1])
-                    else:
-                        coverage = tf.expand_dims(tf.expand_dims(attn_dist, 2), 2)
-
-            return context_vector, attn_dist, coverage
+        # a scalar tensor: the batch size isn't fixed when batching by a token budget
+        batch_size = array_ops.shape(encoder_states)[0]
+
+        # The encoder features (W_h h_i) don't depend on the decoder step, so compute them once for all steps
+        if t_keys is None or b_keys is None:
+            t_keys, b_keys = _decoder_attention_keys(encoder_states, brand_states)
+
+        def attention(encoder_states, keys, padding_mask, decoder_state, name, coverage=None):
+            return _attention(encoder_states, keys, padding_mask, decoder_state, name, use_coverage, coverage)
 
         outputs = []
         title_attn_dists = []
@@ -165,16 +78,14 @@ def attention_decoder(decoder_inputs,
         t_cv.set_shape([None, encoder_states.get_shape()[2].value])
         b_cv = array_ops.zeros([batch_size, brand_states.get_shape()[2].value])
         b_cv.set_shape([None, brand_states.get_shape()[2].value])
-        min_p = tf.zeros([batch_size, 1])
-        max_p = tf.ones([batch_size, 1])
 
         if initial_state_attention:  # true in decode mode
             # Re-calculate the context vector from the previous step
             # so that we can pass it through a linear layer
             # with this step's input to get a modified version of the input
             # in decode mode, this is what updates the coverage vector
-            b_cv, _, b_coverage = attention(brand_states, brand_padding_mask, initial_state, 'BrandAttention', b_coverage)
-            t_cv, _, t_coverage = attention(encoder_states, enc_padding_mask, [initial_state.c, initial_state.h, b_cv], 'TitleAttention', t_coverage)
+            b_cv, _, b_coverage = attention(brand_states, b_keys, brand_padding_mask, initial_state, 'BrandAttention', b_coverage)
+            t_cv, _, t_coverage = attention(encoder_states, t_keys, enc_padding_mask, [initial_state.c, initial_state.h, b_cv], 'TitleAttention', t_coverage)
 
         for i, inp in enumerate(decoder_inputs):
             tf.logging.info("Adding attention_decoder timestep %i of %i", i,
@@ -182,62 +93,274 @@ def attention_decoder(decoder_inputs,
             if i > 0:
                 variable_scope.get_variable_scope().reuse_variables()
 
-            # Merge input and previous attentions into one vector x of the same size as inp
-            input_size = inp.get_shape().with_rank(2)[1]
-            if input_size.value is None:
-                raise ValueError(
-                    "Could not infer input size from input: %s" % inp.name)
-            x = linear([inp] + [t_cv] + [b_cv], input_size, True)
-
-            # Run the decoder RNN cell. cell_output = decoder state
-            cell_output, state = cell(x, state)
-
-            # Run the attention mechanism.
             if i == 0 and initial_state_attention:  # always true in decode mode
-                with variable_scope.variable_scope(
-                        variable_scope.get_variable_scope(), reuse=True):  
-                    # you need this because you've already run the initial attention(...) call
-                    # don't allow coverage to update
-                    b_cv, b_attn_dist, b_coverage = attention(brand_states, brand_padding_mask, state, 'BrandAttention', b_coverage)
-                    t_cv, t_attn_dist, t_coverage = attention(encoder_states, enc_padding_mask, [state.c, state.h, b_cv], 'TitleAttention', t_coverage)
+                # you need this because you've already run the initial attention(...) call
+                # don't allow coverage to update
+                reuse_attention = True
             else:
-                b_cv, b_attn_dist, b_coverage = attention(brand_states, brand_padding_mask, state, 'BrandAttention', b_coverage)
-                t_cv, t_attn_dist, t_coverage = attention(encoder_states, enc_padding_mask, [state.c, state.h, b_cv], 'TitleAttention', t_coverage)
-
-            with tf.variable_scope('calculate_prob'):
-                # Tensor shape (batch_size, 1)
-                #todo: 要不要加上cell_output
-                # coverage_feature = tf.reduce_sum(coverage, [1, 2, 3]) / tf.reduce_sum(padding_mask, axis=1)
-                # coverage_feature = tf.reshape(coverage_feature, [batch_size, -1])
-                p = linear([state.c, state.h, x, t_cv, b_cv], 2, True)
-                #p = tf.sigmoid(p)
-                p = tf.nn.softmax(p)
-                #p_s.append(p)
-                p_b = tf.minimum(tf.slice(p, [0, 0], [-1, 1]) + 0.0, max_p) 
-                p_t = tf.maximum(tf.slice(p, [0, 1], [-1, 1]) - 0.0, min_p) 
-                p_ts.append(p_t)
-                p_bs.append(p_b)
-                #
-
-            b_attn_dist = tf.multiply(p_b, b_attn_dist)
-            t_attn_dist = tf.multiply(p_t, t_attn_dist)
+                reuse_attention = None
+            output, state, t_cv, b_cv, t_attn_dist, b_attn_dist, p_t, p_b, t_coverage, b_coverage = _decoder_step(
+                inp, state, t_cv, b_cv, encoder_states, t_keys, enc_padding_mask, brand_states, b_keys, brand_padding_mask,
+                cell, use_coverage, t_coverage, b_coverage, reuse_attention)
 
+            p_ts.append(p_t)
+            p_bs.append(p_b)
             title_attn_dists.append(t_attn_dist)
             brand_attn_dists.append(b_attn_dist)
-
-            # Concatenate the cell_output (= decoder state) and the context vector, and pass them through a linear layer
-            # This is V[s_t, h*_t] + b in the paper
-            with variable_scope.variable_scope("AttnOutputProjection"):
-                output = linear([cell_output] + [t_cv] +[b_cv], cell.output_size, True)
             outputs.append(output)
 
-        # If using coverage, reshape it
-        if t_coverage is not None and b_coverage is not None:
-            t_coverage = array_ops.reshape(t_coverage, [batch_size, -1])
-            b_coverage = array_ops.reshape(b_coverage, [batch_size, -1])
+        return outputs, state, title_attn_dists, brand_attn_dists, p_ts, p_bs, t_coverage, b_coverage
 
 
-        return outputs, state, title_attn_dists, brand_attn_dists, p_ts, p_bs, t_coverage, b_coverage
+def dynamic_attention_decoder(decoder_inputs,
+                              num_steps,
+                              initial_state,
+                              encoder_states,
+                              enc_padding_mask,
+                              brand_states,
+                              brand_padding_mask,
+                              cell,
+                              use_coverage=False,
+                              t_keys=None,
+                              b_keys=None):
+    """Same as attention_decoder in train/eval mode (initial_state_attention=False, no previous coverage),
+    but the steps are run in a tf.while_loop instead of being unrolled in the graph, and only num_steps steps are run.
+    The variables are the same, so checkpoints are interchangeable.
+
+    Args:
+        decoder_inputs: 3D Tensor [batch_size x max_dec_steps x input_size].
+        num_steps: scalar int32 Tensor, the number of steps to run, e.g. the length of the longest target in the batch.
+        initial_state, encoder_states, enc_padding_mask, brand_states, brand_padding_mask, cell, use_coverage,
+        t_keys, b_keys:
+            see attention_decoder.
+
+    Returns:
+        outputs: 3D Tensor [num_steps x batch_size x cell.output_size]. The output vectors.
+        state: The final state of the decoder.
+        title_attn_dists: 3D Tensor [num_steps x batch_size x attn_length]. The attention distributions over the encoder states.
+        brand_attn_dists: 3D Tensor [num_steps x batch_size x brand_length]. The attention distributions over the brand states.
+        p_ts, p_bs: 3D Tensors [num_steps x batch_size x 1].
+        t_coverage, b_coverage: Coverage vectors on the last step, shape (batch_size, attn_length). None if use_coverage=False.
+    """
+    with variable_scope.variable_scope("attention_decoder"):
+        batch_size = array_ops.shape(encoder_states)[0]
+        input_size = decoder_inputs.get_shape().with_rank(3)[2].value
+        inputs_ta = tf.TensorArray(tf.float32, size=array_ops.shape(decoder_inputs)[1])
+        inputs_ta = inputs_ta.unstack(tf.transpose(decoder_inputs, [1, 0, 2]))
+
+        # computed once, outside of the loop
+        if t_keys is None or b_keys is None:
+            t_keys, b_keys = _decoder_attention_keys(encoder_states, brand_states)
+
+        t_cv = array_ops.zeros([batch_size, encoder_states.get_shape()[2].value])
+        t_cv.set_shape([None, encoder_states.get_shape()[2].value])
+        b_cv = array_ops.zeros([batch_size, brand_states.get_shape()[2].value])
+        b_cv.set_shape([None, brand_states.get_shape()[2].value])
+        # A zero coverage vector gives the same attention as no coverage vector on the first step
+        t_coverage = tf.zeros_like(enc_padding_mask)
+        b_coverage = tf.zeros_like(brand_padding_mask)
+
+        def new_ta():
+            return tf.TensorArray(tf.float32, size=num_steps)
+
+        def body(i, state, t_cv, b_cv, t_coverage, b_coverage, outputs, t_attn_dists, b_attn_dists, p_ts, p_bs):
+            inp = inputs_ta.read(i)
+            inp.set_shape([None, input_size])
+            output, state, t_cv, b_cv, t_attn_dist, b_attn_dist, p_t, p_b, new_t_coverage, new_b_coverage = _decoder_step(
+                inp, state, t_cv, b_cv, encoder_states, t_keys, enc_padding_mask, brand_states, b_keys, brand_padding_mask,
+                cell, use_coverage, t_coverage if use_coverage else None, b_coverage if use_coverage else None)
+            if use_coverage:
+                t_coverage, b_coverage = new_t_coverage, new_b_coverage
+            return (i + 1, state, t_cv, b_cv, t_coverage, b_coverage,
+                    outputs.write(i, output), t_attn_dists.write(i, t_attn_dist), b_attn_dists.write(i, b_attn_dist),
+                    p_ts.write(i, p_t), p_bs.write(i, p_b))
+
+        _, state, _, _, t_coverage, b_coverage, outputs, t_attn_dists, b_attn_dists, p_ts, p_bs = tf.while_loop(
+            lambda i, *_: i < num_steps,
+            body,
+            (tf.constant(0), initial_state, t_cv, b_cv, t_coverage, b_coverage,
+             new_ta(), new_ta(), new_ta(), new_ta(), new_ta()),
+            swap_memory=True)
+
+        if not use_coverage:
+            t_coverage = b_coverage = None
+
+        return (outputs.stack(), state, t_attn_dists.stack(), b_attn_dists.stack(), p_ts.stack(), p_bs.stack(),
+                t_coverage, b_coverage)
+
+
+def decoder_attention_keys(encoder_states, brand_states):
+    """The encoder features of the encoder ("title") and brand attentions of attention_decoder.
+    Call this in the variable scope attention_decoder is called in, and pass the results as t_keys and b_keys.
+    In decode mode they only need to be computed once per example and can then be fed on every step.
+
+    Returns:
+        t_keys, b_keys: 3D Tensors [batch_size x attn_length x attn_size]
+    """
+    with variable_scope.variable_scope("attention_decoder"):
+        return _decoder_attention_keys(encoder_states, brand_states)
+
+
+def _decoder_attention_keys(encoder_states, brand_states):
+    return attention_keys(encoder_states, 'TitleAttention'), attention_keys(brand_states, 'BrandAttention')
+
+
+def attention_keys(encoder_states, name):
+    """Apply W_h to each encoder state to get the encoder features (W_h h_i) of the attention called name.
+
+    Args:
+        encoder_states: 3D Tensor [batch_size x attn_length x attn_size].
+        name: name of the variable scope of the attention
+
+    Returns:
+        3D Tensor [batch_size x attn_length x attn_size]
+    """
+    with variable_scope.variable_scope(name):
+        attn_size = encoder_states.get_shape()[2].value
+        # W_h keeps the shape of the 1x1 convolution filter it used to be applied as, so checkpoints still load
+        W_h = variable_scope.get_variable("W_h", [1, 1, attn_size, attn_size])
+        features = math_ops.matmul(
+            array_ops.reshape(encoder_states, [-1, attn_size]), array_ops.reshape(W_h, [attn_size, attn_size]))
+        return array_ops.reshape(features, [array_ops.shape(encoder_states)[0], -1, attn_size])
+
+
+def _decoder_step(inp, state, t_cv, b_cv, encoder_states, t_keys, enc_padding_mask, brand_states, b_keys, brand_padding_mask,
+                  cell, use_coverage, t_coverage, b_coverage, reuse_attention=None):
+    """Runs one step of the attention decoder.
+
+    Args:
+        inp: 2D Tensor [batch_size x input_size]. The decoder input of this step.
+        state: the previous decoder state.
+        t_cv, b_cv: the previous context vectors of the encoder ("title") and brand attention.
+        t_keys, b_keys: the encoder features of the two attentions, see attention_keys.
+        t_coverage, b_coverage: the previous coverage vectors, shape (batch_size, attn_len), or None.
+        reuse_attention: reuse flag for the variable scope of the attention of this step.
+
+    Returns:
+        output, state, t_cv, b_cv, t_attn_dist, b_attn_dist, p_t, p_b, t_coverage, b_coverage
+    """
+    # Merge input and previous attentions into one vector x of the same size as inp
+    input_size = inp.get_shape().with_rank(2)[1]
+    if input_size.value is None:
+        raise ValueError(
+            "Could not infer input size from input: %s" % inp.name)
+    x = linear([inp] + [t_cv] + [b_cv], input_size, True)
+
+    # Run the decoder RNN cell. cell_output = decoder state
+    cell_output, state = cell(x, state)
+
+    # Run the attention mechanism.
+    with variable_scope.variable_scope(
+            variable_scope.get_variable_scope(), reuse=reuse_attention):
+        b_cv, b_attn_dist, b_coverage = _attention(brand_states, b_keys, brand_padding_mask, state, 'BrandAttention', use_coverage, b_coverage)
+        t_cv, t_attn_dist, t_coverage = _attention(encoder_states, t_keys, enc_padding_mask, [state.c, state.h, b_cv], 'TitleAttention', use_coverage, t_coverage)
+
+    with tf.variable_scope('calculate_prob'):
+        # Tensor shape (batch_size, 1)
+        #todo: 要不要加上cell_output
+        # coverage_feature = tf.reduce_sum(coverage, [1, 2, 3]) / tf.reduce_sum(padding_mask, axis=1)
+        # coverage_feature = tf.reshape(coverage_feature, [batch_size, -1])
+        p = linear([state.c, state.h, x, t_cv, b_cv], 2, True)
+        #p = tf.sigmoid(p)
+        p = tf.nn.softmax(p)
+        #p_s.append(p)
+        p_b = tf.minimum(tf.slice(p, [0, 0], [-1, 1]) + 0.0, 1.0)
+        p_t = tf.maximum(tf.slice(p, [0, 1], [-1, 1]) - 0.0, 0.0)
+        #
+
+    b_attn_dist = tf.multiply(p_b, b_attn_dist)
+    t_attn_dist = tf.multiply(p_t, t_attn_dist)
+
+    # Concatenate the cell_output (= decoder state) and the context vector, and pass them through a linear layer
+    # This is V[s_t, h*_t] + b in the paper
+    with variable_scope.variable_scope("AttnOutputProjection"):
+        output = linear([cell_output] + [t_cv] +[b_cv], cell.output_size, True)
+
+    return output, state, t_cv, b_cv, t_attn_dist, b_attn_dist, p_t, p_b, t_coverage, b_coverage
+
+
+def _attention(encoder_states, encoder_features, padding_mask, decoder_state, name, use_coverage, coverage=None):
+    """Calculate the context vector and attention distribution from the decoder state.
+
+    Args:
+        encoder_states: 3D Tensor [batch_size x attn_length x attn_size], the states to attend over.
+        encoder_features: 3D Tensor [batch_size x attn_length x attn_size], (W_h h_i) from attention_keys.
+        padding_mask: 2D Tensor [batch_size x attn_length] containing 1s and 0s.
+        decoder_state: state of the decoder
+        name: name of the variable scope of this attention
+        use_coverage: boolean. If True, use coverage mechanism.
+        coverage: Optional. Previous timestep's coverage vector, shape (batch_size, attn_len).
+
+    Returns:
+        context_vector: weighted sum of encoder_states
+        attn_dist: attention distribution
+        coverage: new coverage vector. shape (batch_size, attn_len)
+    """
+    with variable_scope.variable_scope(name):
+        # if this line fails, it's because the attention length isn't defined
+        attn_size = encoder_states.get_shape()[2].value
+
+        # To calculate attention, we calculate
+        # v^T tanh(W_h h_i + W_s s_t + b_attn)
+        # where h_i is an encoder state, and s_t a decoder state.
+        # attn_vec_size is the length of the vectors v, b_attn, (W_h h_i) and (W_s s_t).
+        # We set it to be equal to the size of the encoder states.
+        attention_vec_size = attn_size
+
+        # Get the weight vectors v and w_c (w_c is for coverage)
+        v = variable_scope.get_variable("v", [attention_vec_size])
+        if use_coverage:
+            with variable_scope.variable_scope("coverage"):
+                w_c = variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
+
+        # Pass the decoder state through a linear layer (this is W_s s_t + b_attn in the paper)
+        # shape (batch_size, attention_vec_size)
+        decoder_features = linear(decoder_state, attention_vec_size, True)
+        # reshape to (batch_size, 1, attention_vec_size)
+        decoder_features = tf.expand_dims(decoder_features, 1)
+
+        def masked_attention(e, padding_mask):
+            """Take softmax of e then apply padding_mask and re-normalize"""
+            # take softmax. shape (batch_size, attn_length)
+            attn_dist = nn_ops.softmax(e)
+            attn_dist *= padding_mask  # apply mask
+            # shape (batch_size)
+            masked_sums = tf.reduce_sum(attn_dist, axis=1)
+            # re-normalize
+            return attn_dist / tf.reshape(masked_sums, [-1, 1])
+
+        if use_coverage and coverage is not None:  # non-first step of coverage
+            # Multiply coverage vector by w_c to get coverage_features.
+            # c has shape (batch_size, attn_length, attention_vec_size)
+            coverage_features = tf.expand_dims(coverage, 2) * array_ops.reshape(w_c, [attention_vec_size])
+
+            # Calculate v^T tanh(W_h h_i + W_s s_t + w_c c_i^t + b_attn)
+            # shape (batch_size,attn_length)
+            e = math_ops.reduce_sum(
+                v * math_ops.tanh(encoder_features + decoder_features +
+                                  coverage_features), [2])
+
+            # Calculate attention distribution
+            attn_dist = masked_attention(e, padding_mask)
+        else:
+            # Calculate v^T tanh(W_h h_i + W_s s_t + b_attn)
+            e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features), [2])
+
+            # Calculate attention distribution
+            attn_dist = masked_attention(e, padding_mask)
+
+        # Calculate the context vector from attn_dist and encoder_states
+        # shape (batch_size, attn_size).
+        context_vector = array_ops.squeeze(
+            math_ops.matmul(tf.expand_dims(attn_dist, 1), encoder_states), [1])
+
+        if use_coverage:
+            if coverage is not None:
+                coverage += attn_dist
+            else:
+                coverage = attn_dist
+
+    return context_vector, attn_dist, coverage
 
 
 def linear(args, output_size, bias, bias_start=0.0, scope=None):
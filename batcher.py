@@ -2,12 +2,16 @@
 # todo: query可能是"无"
 """This file contains code to process data into batches"""
 
+import copy
 import queue
-from random import shuffle
+import traceback
+import multiprocessing
+from collections import deque
 from threading import Thread
 import time
 import numpy as np
 import tensorflow as tf
+import util
 from data import *
 
 
@@ -15,7 +19,14 @@ from data import *
 
 
 class Example(object):
-    """Class representing a train/val/test example for text summarization."""
+    """Class representing a train/val/test example for text summarization.
+    The sequences are unpadded int32 numpy arrays which are never modified,
+    so the same Example can be put in several Batches."""
+
+    __slots__ = ('enc_len', 'enc_input', 'enc_input_extend_vocab',
+                 'query_len', 'query_input', 'query_input_extend_vocab',
+                 'dec_len', 'dec_input', 'target', 'oovs',
+                 'original_context', 'original_summarization', 'original_query')
 
     def __init__(self, context, summarization, query, vocab, hps):
         """Initializes the Example, 
@@ -28,48 +39,86 @@ class Example(object):
             vocab: Vocabulary object
             hps: hyperparameters
         """
-        self.hps = hps
+        context_words = split_text_with_whitespace(context) + [MARK_EOS]
+        query_words = split_text_with_whitespace(query) + [MARK_EOS]  # + ' '
+        summarization_words = split_text_with_whitespace(summarization)
+
+        # Store a version of the enc_input where in-article OOVs are represented by their temporary OOV id; 
+        # also store the in-article OOVs words themselves
+        context_ids, oovs = context2ids(context_words, vocab)
+        query_ids, oovs = query2ids(query_words, vocab, oovs)
+        # Get a verison of the reference summary where in-article OOVs are represented by their temporary article OOV id
+        summarization_ids = summarization2ids(summarization_words, vocab, oovs)
+
+        self.init_from_ids(context_ids, query_ids, summarization_ids, oovs, vocab, hps)
+
+        # Store the original strings
+        self.original_context = context
+        self.original_summarization = summarization
+        self.original_query = query
+
+    @classmethod
+    def from_text(cls, record, vocab, hps):
+        """Builds an Example from a (context, summarization, query) record of a text datafile."""
+        context, summarization, query = record
+        return cls(context, summarization, query, vocab, hps)
+
+    @classmethod
+    def from_compiled(cls, record, vocab, hps):
+        """Builds an Example from a record of a CompiledDataset, without tokenizing any text.
+
+        Args:
+            record: tuple returned by CompiledDataset.__getitem__
+            vocab: Vocabulary object
+            hps: hyperparameters
+        """
+        context_ids, query_ids, summarization_ids, oovs, context, summarization, query = record
+        example = cls.__new__(cls)
+        example.init_from_ids(context_ids, query_ids, summarization_ids, oovs, vocab, hps)
+        example.original_context = context
+        example.original_summarization = summarization
+        example.original_query = query
+        return example
 
+    def init_from_ids(self, context_ids, query_ids, summarization_ids, oovs, vocab, hps):
+        """Initializes the encoder, decoder and target sequences from ids in the extended vocab.
+
+        Args:
+            context_ids: context ids, ending with the <EOS> id; in-article OOVs have their temporary article OOV id
+            query_ids: query ids, ending with the <EOS> id; same convention as context_ids
+            summarization_ids: reference summarization ids; same convention, out-of-article OOVs are <UNK>
+            oovs: list of in-article OOV words (strings)
+            vocab: Vocabulary object
+            hps: hyperparameters
+        """
         start_decoding = vocab.word2id(MARK_GO)
         stop_decoding = vocab.word2id(MARK_EOS)
 
-        context_words = split_text_with_whitespace(context) + [MARK_EOS]
-        self.enc_len = len(context_words)
-        self.enc_input = [vocab.word2id(w) for w in context_words]
+        # np.array copies, so the Example doesn't keep a memory-mapped dataset alive
+        self.enc_input_extend_vocab = np.array(context_ids, dtype=np.int32)
+        self.query_input_extend_vocab = np.array(query_ids, dtype=np.int32)
+        summarization_ids = np.array(summarization_ids, dtype=np.int32)
+        self.oovs = oovs
 
-        query_words = split_text_with_whitespace(query) + [MARK_EOS]  # + ' '
-        self.query_len = len(query_words)
-        self.query_input = [vocab.word2id(w) for w in query_words]
+        self.enc_len = len(self.enc_input_extend_vocab)
+        self.enc_input = extended2ids(self.enc_input_extend_vocab, vocab)
 
-        summarization_words = split_text_with_whitespace(summarization)
-        summarization_ids = [vocab.word2id(w) for w in summarization_words]
+        self.query_len = len(self.query_input_extend_vocab)
+        self.query_input = extended2ids(self.query_input_extend_vocab, vocab)
 
         # Get the decoder input sequence and target sequence
         # todo: 注意max_dec_steps
-        self.dec_input, self.target = self.get_dec_inp_targ_seqs(
-            summarization_ids, hps.max_dec_steps.value, start_decoding,
+        # todo: 为什么 decoder input不用重写扩展
+        self.dec_input, _ = self.get_dec_inp_targ_seqs(
+            extended2ids(summarization_ids, vocab), hps.max_dec_steps.value, start_decoding,
             stop_decoding)
         self.dec_len = len(self.dec_input)
 
-        # Store a version of the enc_input where in-article OOVs are represented by their temporary OOV id; 
-        # also store the in-article OOVs words themselves
-        self.enc_input_extend_vocab, self.oovs = context2ids(context_words, vocab)
-        self.query_input_extend_vocab, self.oovs = query2ids(query_words, vocab, self.oovs)
-
-        # Get a verison of the reference summary where in-article OOVs are represented by their temporary article OOV id
-        abs_ids_extend_vocab = summarization2ids(summarization_words, vocab, self.oovs)
-
-        # Overwrite decoder target sequence so it uses the temp article OOV ids
-        # todo: 为什么 decoder input不用重写扩展
+        # The decoder target sequence uses the temp article OOV ids
         _, self.target = self.get_dec_inp_targ_seqs(
-            abs_ids_extend_vocab, hps.max_dec_steps.value, start_decoding,
+            summarization_ids, hps.max_dec_steps.value, start_decoding,
             stop_decoding)
 
-        # Store the original strings
-        self.original_context = context
-        self.original_summarization = summarization
-        self.original_query = query
-
     def get_dec_inp_targ_seqs(self, sequence, max_len, start_id, stop_id):
         """Given the reference summary as a sequence of tokens, 
         return the input sequence for the decoder, and the target sequence which we will use to calculate loss. 
@@ -77,7 +126,7 @@ class Example(object):
         The input sequence must start with the start_id and the target sequence must end with the stop_id (but not if it's been truncated).
 
         Args:
-            sequence: List of ids (integers)
+            sequence: int32 numpy array of ids
             max_len: integer
             start_id: integer
             stop_id: integer
@@ -86,33 +135,15 @@ class Example(object):
             inp: sequence length <=max_len starting with start_id
             target: sequence same length as input, ending with stop_id only if there was no truncation
         """
-        inp = [start_id] + sequence[:]
-        target = sequence[:]
+        inp = np.concatenate(([start_id], sequence)).astype(np.int32)
         if len(inp) > max_len:  # truncate
             inp = inp[:max_len]
-            target = target[:max_len]  # no end_token
+            target = sequence[:max_len]  # no end_token
         else:  # no truncation
-            target.append(stop_id)  # end token
+            target = np.concatenate((sequence, [stop_id])).astype(np.int32)  # end token
         assert len(inp) == len(target)
         return inp, target
 
-    def pad_decoder_inp_targ(self, max_len, pad_id):
-        """Pad decoder input and target sequences with pad_id up to max_len."""
-        self.dec_input += [pad_id] * (max_len - len(self.dec_input))
-        self.target += [pad_id] * (max_len - len(self.target))
-
-    def pad_encoder_input(self, max_len, pad_id):
-        """Pad the encoder input sequence with pad_id up to max_len."""
-        # while len(self.enc_input) < max_len:
-        self.enc_input += [pad_id] * (max_len - len(self.enc_input))
-        self.enc_input_extend_vocab += [pad_id] * (
-                max_len - len(self.enc_input_extend_vocab))
-
-    def pad_query_input(self, max_len, pad_id):
-        self.query_input += [pad_id] * (max_len - len(self.query_input))
-        self.query_input_extend_vocab += [pad_id] * (
-                max_len - len(self.query_input_extend_vocab))
-
 
 class Batch(object):
     """Class representing a minibatch of train/val/test examples for text summarization."""
@@ -148,37 +179,15 @@ class Batch(object):
             self.enc_batch_extend_vocab:
                 Same as self.enc_batch, but in-article OOVs are represented by their temporary article OOV number.
         """
-        # Determine the maximum length of the encoder input sequence in this batch
-        max_enc_seq_len = max([ex.enc_len for ex in example_list])
-        max_query_seq_len = max([ex.query_len for ex in example_list])
-
-        # Pad the encoder input sequences up to the length of the longest sequence
-        for ex in example_list:
-            ex.pad_encoder_input(max_enc_seq_len, self.pad_id)
-            ex.pad_query_input(max_query_seq_len, self.pad_id)
-
-        # Initialize the numpy arrays
         # Note: our enc_batch can have different length (second dimension) for each batch because we use dynamic_rnn for the encoder.
-        self.enc_batch = np.zeros((hps.batch_size.value, max_enc_seq_len), dtype=np.int32)
-        self.enc_lens = np.zeros((hps.batch_size.value), dtype=np.int32)
-        self.enc_padding_mask = np.zeros((hps.batch_size.value, max_enc_seq_len), dtype=np.float32)
+        self.enc_lens = np.array([ex.enc_len for ex in example_list], dtype=np.int32)
+        self.enc_padding_mask = _padding_mask(self.enc_lens, self.enc_lens.max())
+        self.enc_batch = _pad_rows([ex.enc_input for ex in example_list], self.enc_padding_mask, self.pad_id)
 
         # query encoder part
-        self.query_batch = np.zeros((hps.batch_size.value, max_query_seq_len), dtype=np.int32)
-        self.query_lens = np.zeros((hps.batch_size.value), dtype=np.int32)
-        self.query_padding_mask = np.zeros((hps.batch_size.value, max_query_seq_len), dtype=np.float32)
-
-        # Fill in the numpy arrays
-        for i, ex in enumerate(example_list):
-            self.enc_batch[i, :] = ex.enc_input[:]
-            self.enc_lens[i] = ex.enc_len
-            for j in range(ex.enc_len):
-                self.enc_padding_mask[i][j] = 1
-
-            self.query_batch[i, :] = ex.query_input[:]
-            self.query_lens[i] = ex.query_len
-            for j in range(ex.query_len):
-                self.query_padding_mask[i][j] = 1
+        self.query_lens = np.array([ex.query_len for ex in example_list], dtype=np.int32)
+        self.query_padding_mask = _padding_mask(self.query_lens, self.query_lens.max())
+        self.query_batch = _pad_rows([ex.query_input for ex in example_list], self.query_padding_mask, self.pad_id)
 
         # For pointer-generator mode, need to store some extra info
         if hps.pointer_gen.value:
@@ -187,13 +196,10 @@ class Batch(object):
             # Store the in-article OOVs themselves
             self.art_oovs = [ex.oovs for ex in example_list]
             # Store the version of the enc_batch that uses the article OOV ids
-            self.enc_batch_extend_vocab = np.zeros(
-                (hps.batch_size.value, max_enc_seq_len), dtype=np.int32)
-            self.query_batch_extend_vocab = np.zeros(
-                (hps.batch_size.value, max_query_seq_len), dtype=np.int32)
-            for i, ex in enumerate(example_list):
-                self.enc_batch_extend_vocab[i, :] = ex.enc_input_extend_vocab[:]
-                self.query_batch_extend_vocab[i, :] = ex.query_input_extend_vocab[:]
+            self.enc_batch_extend_vocab = _pad_rows(
+                [ex.enc_input_extend_vocab for ex in example_list], self.enc_padding_mask, self.pad_id)
+            self.query_batch_extend_vocab = _pad_rows(
+                [ex.query_input_extend_vocab for ex in example_list], self.query_padding_mask, self.pad_id)
 
     def init_decoder_seq(self, example_list, hps):
         """Initializes the following:
@@ -203,26 +209,16 @@ class Batch(object):
             numpy array of shape (batch_size, max_dec_steps), containing integer ids for the target sequence, padded to max_dec_steps length.
         self.dec_padding_mask:
             numpy array of shape (batch_size, max_dec_steps), containing 1s and 0s. 1s correspond to real tokens in dec_batch and target_batch; 0s correspond to padding.
+        self.no_rewrite:
+            numpy array of shape (batch_size), containing 1s for the examples whose rewrite is the query itself, else 0s.
         """
-        # Pad the inputs and targets
-        for ex in example_list:
-            ex.pad_decoder_inp_targ(hps.max_dec_steps.value, self.pad_id)
-
-        # Initialize the numpy arrays.
         # Note: our decoder inputs and targets must be the same length for each batch (second dimension = max_dec_steps) because we do not use a dynamic_rnn for decoding. However I believe this is possible, or will soon be possible, with Tensorflow 1.0, in which case it may be best to upgrade to that.
-        self.dec_batch = np.zeros(
-            (hps.batch_size.value, hps.max_dec_steps.value), dtype=np.int32)
-        self.target_batch = np.zeros(
-            (hps.batch_size.value, hps.max_dec_steps.value), dtype=np.int32)
-        self.dec_padding_mask = np.zeros(
-            (hps.batch_size.value, hps.max_dec_steps.value), dtype=np.float32)
-
-        # Fill in the numpy arrays
-        for i, ex in enumerate(example_list):
-            self.dec_batch[i, :] = ex.dec_input[:]
-            self.target_batch[i, :] = ex.target[:]
-            for j in range(ex.dec_len):
-                self.dec_padding_mask[i][j] = 1
+        dec_lens = np.array([ex.dec_len for ex in example_list], dtype=np.int32)
+        self.dec_padding_mask = _padding_mask(dec_lens, hps.max_dec_steps.value)
+        self.dec_batch = _pad_rows([ex.dec_input for ex in example_list], self.dec_padding_mask, self.pad_id)
+        self.target_batch = _pad_rows([ex.target for ex in example_list], self.dec_padding_mask, self.pad_id)
+        self.no_rewrite = np.array(
+            [ex.original_summarization == ex.original_query for ex in example_list], dtype=np.float32)
 
     def store_orig_strings(self, example_list):
         """Store the original article and abstract strings in the Batch object"""
@@ -230,6 +226,30 @@ class Batch(object):
         self.original_summarizations = [ex.original_summarization for ex in example_list]
         self.original_querys = [ex.original_query for ex in example_list]
 
+    def subset(self, rows):
+        """Return a new Batch made of the given rows of this one. The sequences keep the padding of this batch."""
+        batch = copy.copy(self)
+        for name, value in self.__dict__.items():
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                setattr(batch, name, value[rows])
+            elif isinstance(value, list):
+                setattr(batch, name, [value[r] for r in rows])
+        return batch
+
+
+def _padding_mask(lens, max_len):
+    """Returns a float32 array of shape (len(lens), max_len) with 1s for the first lens[i] positions of row i and 0s after."""
+    return (np.arange(max_len) < lens[:, None]).astype(np.float32)
+
+
+def _pad_rows(sequences, padding_mask, pad_id):
+    """Stacks 1-D int arrays into an int32 array of the shape of padding_mask, padded with pad_id.
+    The length of sequences[i] must be the number of 1s in row i of padding_mask."""
+    rows = np.full(padding_mask.shape, pad_id, dtype=np.int32)
+    # boolean indexing fills the positions row by row, in the order of the concatenation
+    rows[padding_mask.astype(bool)] = np.concatenate(sequences)
+    return rows
+
 
 class Batcher(object):
     """A class to generate minibatches of data. 
@@ -237,8 +257,8 @@ class Batcher(object):
 
     BATCH_QUEUE_MAX = 100  # max number of batches the batch_queue can hold
 
-    def __init__(self, data_path, vocab, hps, single_pass):
-        """Initialize the batcher. Start threads that process the data into batches.
+    def __init__(self, data_path, vocab, hps, single_pass, num_workers=0, seed=None, shard=None):
+        """Initialize the batcher. Start threads (or worker processes) that process the data into batches.
         Args:
           data_path: tf.Example filepattern.
           vocab: Vocabulary object
@@ -246,77 +266,167 @@ class Batcher(object):
           single_pass: If True, run through the dataset exactly once 
                       (useful for when you want to run evaluation on the dev or test set). 
           Otherwise generate random batches indefinitely (useful for training).
+          num_workers: If > 0, build the Examples and Batches in this many worker processes instead of in threads,
+              so that the work isn't serialized by the GIL. The workers take turns on consecutive chunks of
+              examples and their chunks are consumed in turn; the batches of each chunk are shuffled as they are
+              consumed, so the batches come out in the same order as with threads, for any number of workers.
+          seed: If not None, seed for shuffling the datafiles and the batches, so the batch order is reproducible.
+          shard: If not None, a pair (shard_index, num_shards): only read the examples whose index in the data
+              is shard_index modulo num_shards (see decode_shards.py).
         """
         self._data_path = data_path
+        self._shard = shard
         self._vocab = vocab
         self._hps = hps
         self._single_pass = single_pass
-
-        # Initialize a queue of Batches waiting to be used, and a queue of Examples waiting to be batched
-        self._batch_queue = queue.Queue(self.BATCH_QUEUE_MAX)
-        self._example_queue = queue.Queue(
-            self.BATCH_QUEUE_MAX * self._hps.batch_size.value)
+        self._num_workers = num_workers
+        # The same seed must be used to shuffle the datafiles in every worker, so that they split the same stream
+        self._seed = seed if seed is not None else random.randrange(2 ** 31)
+        self._finished_reading = False  # this will tell us when we're finished reading the dataset
+        self._error = None  # traceback of an exception raised in an input thread
 
         # Different settings depending on whether we're in single_pass mode or not
         if single_pass:
-            self._num_example_q_threads = 1  # just one thread, so we read through the dataset just once
-            self._num_batch_q_threads = 1  # just one thread to batch examples
             self._bucketing_cache_size = 1  # only load one batch's worth of examples before bucketing; this essentially means no bucketing
-            self._finished_reading = False  # this will tell us when we're finished reading the dataset
         else:
-            # 多线程随机性
-            self._num_example_q_threads = 1  # 16 num threads to fill example queue
-            self._num_batch_q_threads = 1  # 4 num threads to fill batch queue
             self._bucketing_cache_size = 100  # how many batches-worth of examples to load into cache before bucketing
 
-        # Start the threads that load the queues
-        self._example_q_threads = []
-        for _ in range(self._num_example_q_threads):
-            self._example_q_threads.append(
-                Thread(target=self.fill_example_queue))
-            self._example_q_threads[-1].daemon = True
-            self._example_q_threads[-1].start()
-        self._batch_q_threads = []
-        for _ in range(self._num_batch_q_threads):
-            self._batch_q_threads.append(Thread(target=self.fill_batch_queue))
-            self._batch_q_threads[-1].daemon = True
-            self._batch_q_threads[-1].start()
-
-        # Start a thread that watches the other threads and restarts them if they're dead
-        if not single_pass:  # We don't want a watcher in single_pass mode because the threads shouldn't run forever
-            self._watch_thread = Thread(target=self.watch_threads)
-            self._watch_thread.daemon = True
-            self._watch_thread.start()
+        # Number of examples that are bucketed together. In decode mode every decode_batch_dialogues examples make a batch.
+        if hps.mode.value == 'decode':
+            self._chunk_size = hps.decode_batch_dialogues.value
+        else:
+            self._chunk_size = hps.batch_size.value * self._bucketing_cache_size
+
+        if num_workers > 0:
+            self._start_workers()
+        else:
+            self._start_threads()
+
+    def _start_threads(self):
+        """Start one thread that fills the example queue and one that fills the batch queue.
+        More threads don't help: the work is pure Python and serialized by the GIL, and they would make the
+        batch order depend on thread scheduling. Use num_workers to build batches in parallel."""
+        # Initialize a queue of Batches waiting to be used, and a queue of Examples waiting to be batched
+        self._batch_queue = queue.Queue(self.BATCH_QUEUE_MAX)
+        self._example_queue = queue.Queue(
+            self.BATCH_QUEUE_MAX * self._hps.batch_size.value)
+
+        self._threads = []
+        for target in (self.fill_example_queue, self.fill_batch_queue):
+            self._threads.append(Thread(target=self._run_and_report, args=(target,)))
+            self._threads[-1].daemon = True
+            self._threads[-1].start()
+
+    def _start_workers(self):
+        """Start the worker processes, each with its own queue of lists of Batches."""
+        hps = util.plain_hps(self._hps)  # flag objects can't be sent to another process
+        self._pending_batches = deque()
+        self._next_worker = 0
+        # The workers return the batches of each chunk sorted by length; they are shuffled here, in chunk order,
+        # with the same random stream as fill_batch_queue
+        self._rng = random.Random(self._seed + 1)
+        self._worker_queues = []
+        self._workers = []
+        for worker_id in range(self._num_workers):
+            self._worker_queues.append(
+                multiprocessing.Queue(max(1, self.BATCH_QUEUE_MAX // self._bucketing_cache_size)))
+            self._workers.append(multiprocessing.Process(
+                target=_input_worker,
+                args=(worker_id, self._num_workers, self._worker_queues[-1], self._data_path, self._vocab,
+                      hps, self._single_pass, self._chunk_size, self._seed, self._shard)))
+            self._workers[-1].daemon = True
+            self._workers[-1].start()
 
     def next_batch(self):
         """Return a Batch from the batch queue.
 
-        If mode='decode' then each batch contains a single example repeated beam_size-many times; this is necessary for beam search.
+        If mode='decode' then each batch contains decode_batch_dialogues examples (fewer for the last batch),
+        each repeated beam_size-many times; this is necessary for beam search.
+        Raises an Exception if an input thread or worker process has failed.
 
         Returns:
           batch: a Batch object, or None if we're in single_pass mode and we've exhausted the dataset.
         """
-        # If the batch queue is empty, print a warning
-        if self._batch_queue.qsize() == 0:
-            tf.logging.warning(
-                'Bucket input queue is empty when calling next_batch. Bucket queue size: %i, Input queue size: %i',
-                self._batch_queue.qsize(), self._example_queue.qsize())
-            if self._single_pass and self._finished_reading:
-                tf.logging.info(
-                    "Finished reading dataset in single_pass mode.")
-                return None
+        if self._finished_reading:
+            return None
 
-        batch = self._batch_queue.get()  # get the next Batch
+        # If the batch queue is empty, print a warning
+        if self._num_workers > 0:
+            if not self._pending_batches and self._worker_queues[self._next_worker].empty():
+                tf.logging.warning('Input queue of worker %i is empty when calling next_batch.', self._next_worker)
+            batch = self._next_worker_batch()
+        else:
+            if self._batch_queue.qsize() == 0:
+                tf.logging.warning(
+                    'Bucket input queue is empty when calling next_batch. Bucket queue size: %i, Input queue size: %i',
+                    self._batch_queue.qsize(), self._example_queue.qsize())
+            batch = self._next_thread_batch()
+
+        if batch is None:
+            tf.logging.info(
+                "Finished reading dataset in single_pass mode.")
+            self._finished_reading = True
         return batch
 
+    def _next_thread_batch(self):
+        """Get the next Batch (or None at the end of the dataset) from the batch queue, or raise the error of a failed input thread."""
+        while True:
+            try:
+                return self._batch_queue.get(timeout=1)
+            except queue.Empty:
+                if self._error is not None:
+                    raise Exception('Input thread failed:\n%s' % self._error)
+
+    def _next_worker_batch(self):
+        """Get the next Batch (or None at the end of the dataset) from the workers, taking their chunks in turn."""
+        while not self._pending_batches:
+            batches = self._get_from_worker(self._next_worker)
+            if batches is None:
+                # Chunks are dealt to the workers in turn, so the first worker that runs out marks the end of the data
+                return None
+            if not self._single_pass:
+                self._rng.shuffle(batches)
+            self._pending_batches.extend(batches)
+            self._next_worker = (self._next_worker + 1) % self._num_workers
+        return self._pending_batches.popleft()
+
+    def _get_from_worker(self, worker_id):
+        """Get the next item from the queue of a worker process, or raise if the worker has failed or died."""
+        worker_queue = self._worker_queues[worker_id]
+        worker = self._workers[worker_id]
+        while True:
+            try:
+                item = worker_queue.get(timeout=1)
+            except queue.Empty:
+                if worker.is_alive():
+                    continue
+                try:
+                    # the worker may have put its last items just before exiting
+                    item = worker_queue.get(timeout=1)
+                except queue.Empty:
+                    raise Exception('Input worker process %i died with exit code %s' % (worker_id, worker.exitcode))
+            if isinstance(item, _WorkerError):
+                raise Exception('Input worker process %i failed:\n%s' % (worker_id, item.traceback))
+            return item
+
+    def _run_and_report(self, target):
+        """Run target, recording its traceback if it raises so that next_batch can re-raise it."""
+        try:
+            target()
+        except Exception:
+            self._error = traceback.format_exc()
+            tf.logging.error('Input thread failed:\n%s', self._error)
+
     def fill_example_queue(self):
-        """Reads data from file and processes into Examples which are then placed into the example queue."""
+        """Reads data from file and processes into Examples which are then placed into the example queue.
+        In single_pass mode, a None is placed after the last Example."""
 
-        input_gen = self.text_generator(self._data_path, self._single_pass)
+        input_gen = example_generator(self._data_path, self._vocab, self._hps, self._single_pass,
+                                      random.Random(self._seed), shard=self._shard)
 
         while True:
             try:
-                (context, summarization, query) = next(input_gen)
+                example = next(input_gen)
             except StopIteration:  # if there are no more examples:
                 tf.logging.info(
                     "The example generator for this example queue filling thread has exhausted data."
@@ -325,92 +435,307 @@ class Batcher(object):
                     tf.logging.info(
                         "single_pass mode is on, so we've finished reading dataset. This thread is stopping."
                     )
-                    self._finished_reading = True
+                    self._example_queue.put(None)
                     break
                 else:
                     raise Exception(
                         "single_pass mode is off but the example generator is out of data; error."
                     )
 
-            # abstract_sentences = [
-            #     sent.strip() for sent in data.abstract2sents(abstract)
-            # ]  # Use the <s> and </s> tags in abstract to get a list of sentences.
-            example = Example(context, summarization, query, self._vocab, self._hps)
             self._example_queue.put(example)
 
     def fill_batch_queue(self):
         """Takes Examples out of example queue, 
         sorts them by encoder sequence length, 
         processes into Batches and places them in the batch queue.
+        In single_pass mode, a None is placed after the last Batch.
 
-        In decode mode, makes batches that each contain a single example repeated.
+        In decode mode, makes batches of decode_batch_dialogues examples, each repeated beam_size times.
         todo: why? 为什么decode时，重复
         """
+        rng = random.Random(self._seed + 1)
         while True:
-            if self._hps.mode.value != 'decode':
-                # Get bucketing_cache_size-many batches of Examples into a list, then sort
-                inputs = []
-                for _ in range(
-                        self._hps.batch_size.value * self._bucketing_cache_size):
-                    inputs.append(self._example_queue.get())
-                inputs = sorted(inputs, key=lambda inp: inp.enc_len)
-
-                # Group the sorted Examples into batches, optionally shuffle the batches, and place in the batch queue.
-                batches = []
-                for i in range(0, len(inputs), self._hps.batch_size.value):
-                    batches.append(inputs[i:i + self._hps.batch_size.value])
-                if not self._single_pass:
-                    shuffle(batches)
-                for b in batches:  # each b is a list of Example objects
-                    self._batch_queue.put(Batch(b, self._hps, self._vocab))
-
-            else:  # beam search decode mode
-                ex = self._example_queue.get()
-                b = [ex for _ in range(self._hps.batch_size.value)]
-                self._batch_queue.put(Batch(b, self._hps, self._vocab))
-
-    def watch_threads(self):
-        """Watch example queue and batch queue threads and restart if dead."""
+            inputs = []
+            for _ in range(self._chunk_size):
+                example = self._example_queue.get()
+                if example is None:
+                    break
+                inputs.append(example)
+            for b in make_batches(inputs, self._hps, self._vocab, None if self._single_pass else rng):
+                self._batch_queue.put(b)
+            if len(inputs) == self._chunk_size:
+                continue
+            self._batch_queue.put(None)
+            break
+
+
+# The arrays of a Batch that the model reads, with their dtypes and shapes
+DATASET_FIELDS = [
+    ('enc_batch', tf.int32, [None, None]),
+    ('enc_lens', tf.int32, [None]),
+    ('enc_padding_mask', tf.float32, [None, None]),
+    ('query_batch', tf.int32, [None, None]),
+    ('query_lens', tf.int32, [None]),
+    ('query_padding_mask', tf.float32, [None, None]),
+    ('dec_batch', tf.int32, [None, None]),
+    ('target_batch', tf.int32, [None, None]),
+    ('dec_padding_mask', tf.float32, [None, None]),
+    ('no_rewrite', tf.float32, [None]),
+]
+# The arrays that the model also reads in pointer-generator mode; the Batch only has them then
+POINTER_GEN_FIELDS = [
+    ('enc_batch_extend_vocab', tf.int32, [None, None]),
+    ('query_batch_extend_vocab', tf.int32, [None, None]),
+    ('max_art_oovs', tf.int32, []),
+]
+
+
+def dataset_fields(hps):
+    """The (name, dtype, shape) of the arrays of a Batch that the model built with hps reads."""
+    return DATASET_FIELDS + POINTER_GEN_FIELDS if hps.pointer_gen.value else DATASET_FIELDS
+
+
+def batch_dataset(batcher, hps, prefetch_batches):
+    """Wraps the Batches of a Batcher in a tf.data.Dataset of dicts of arrays (see dataset_fields).
+    The batches keep the Batcher's bucketing and padding.
+    Prefetching means the next batches are copied into the graph while the current training step runs.
+
+    Args:
+        batcher: Batcher object
+        hps: hyperparameters of the Batcher and the model
+        prefetch_batches: number of batches to prefetch
+
+    Returns:
+        a tf.data.Dataset
+    """
+    fields = dataset_fields(hps)
+
+    def generate():
         while True:
-            time.sleep(60)
-            for idx, t in enumerate(self._example_q_threads):
-                if not t.is_alive():  # if the thread is dead
-                    tf.logging.error(
-                        'Found example queue thread dead. Restarting.')
-                    new_t = Thread(target=self.fill_example_queue)
-                    self._example_q_threads[idx] = new_t
-                    new_t.daemon = True
-                    new_t.start()
-            for idx, t in enumerate(self._batch_q_threads):
-                if not t.is_alive():  # if the thread is dead
-                    tf.logging.error(
-                        'Found batch queue thread dead. Restarting.')
-                    new_t = Thread(target=self.fill_batch_queue)
-                    self._batch_q_threads[idx] = new_t
-                    new_t.daemon = True
-                    new_t.start()
-
-    def text_generator(self, data_path, single_pass):
-        """Generates article and abstract text from tf.Example.
+            batch = batcher.next_batch()
+            if batch is None:
+                return
+            yield {name: getattr(batch, name) for name, _, _ in fields}
 
-        Args:
-            data_path:
-            single_pass:
-        """
+    dataset = tf.data.Dataset.from_generator(
+        generate,
+        output_types={name: dtype for name, dtype, _ in fields},
+        output_shapes={name: tf.TensorShape(shape) for name, _, shape in fields})
+    return dataset.prefetch(prefetch_batches)
+
+
+class _WorkerError(object):
+    """Sent by a worker process in place of its next Batches when it fails."""
+
+    def __init__(self, traceback):
+        self.traceback = traceback
+
+
+def _input_worker(worker_id, num_workers, out_queue, data_path, vocab, hps, single_pass, chunk_size, seed, shard):
+    """Entry point of the input worker processes.
+    Builds the Batches for the chunks of chunk_size examples whose index is worker_id modulo num_workers,
+    and puts them in out_queue as one list per chunk, sorted by length (Batcher shuffles them).
+    In single_pass mode, a None is put after the last chunk."""
+    try:
+        def keep(index):
+            return (index // chunk_size) % num_workers == worker_id
+
+        input_gen = example_generator(data_path, vocab, hps, single_pass, random.Random(seed), keep, shard)
         while True:
-            filelist = glob.glob(data_path)  # get the list of datafiles
-            assert filelist, ('Error: Empty filelist at %s' % data_path)
-            if single_pass:
-                filelist = sorted(filelist)
-            else:
-                random.shuffle(filelist)
-            for f in filelist:
-                with open(f, "r", encoding="utf8") as train_f:
-                    for line in train_f:
-                        record = line.strip().split('\t\t')
-                        if len(record) != 4:
-                            continue
-                        yield (record[0].strip() + '/' + record[1].strip(), record[3].strip(), record[2].strip())
-            if single_pass:
-                print("text_generator completed reading all datafiles. No more data.")
-                break
+            inputs = []
+            for example in input_gen:
+                inputs.append(example)
+                if len(inputs) == chunk_size:
+                    break
+            if len(inputs) == chunk_size:
+                out_queue.put(make_batches(inputs, hps, vocab, None))
+                continue
+            if not single_pass:
+                raise Exception("single_pass mode is off but the example generator is out of data; error.")
+            out_queue.put(make_batches(inputs, hps, vocab, None))
+            out_queue.put(None)
+            break
+    except Exception:
+        out_queue.put(_WorkerError(traceback.format_exc()))
+
+
+def make_batches(inputs, hps, vocab, rng):
+    """Sorts a chunk of Examples by encoder sequence length and groups them into Batches.
+    With a token budget (hps.max_batch_tokens), each batch holds as many examples as fit in the budget;
+    otherwise batches of batch_size examples are made, the last one of the chunk holding the remaining examples.
+    In decode mode, makes batches of hps.decode_batch_dialogues examples in order, each repeated beam_size times.
+
+    Args:
+        inputs: list of Examples
+        hps: hyperparameters
+        vocab: Vocabulary object
+        rng: random.Random used to shuffle the batches, or None to keep them sorted by length
+
+    Returns:
+        list of Batch objects
+    """
+    batch_size = hps.batch_size.value
+    if hps.mode.value == 'decode':  # beam search decode mode
+        num_dialogues = hps.decode_batch_dialogues.value
+        return [Batch([ex for ex in inputs[i:i + num_dialogues] for _ in range(hps.beam_size.value)], hps, vocab)
+                for i in range(0, len(inputs), num_dialogues)]
+
+    # Sort the Examples, group them into batches and optionally shuffle the batches
+    inputs = sorted(inputs, key=lambda inp: inp.enc_len)
+    if hps.max_batch_tokens.value > 0:
+        batches = group_by_tokens(inputs, hps.max_batch_tokens.value, hps.max_dec_steps.value)
+    else:
+        batches = [inputs[i:i + batch_size] for i in range(0, len(inputs), batch_size)]
+    if rng is not None:
+        rng.shuffle(batches)
+    return [Batch(b, hps, vocab) for b in batches]  # each b is a list of Example objects
+
+
+def dialogue_batch(dialogues, vocab, hps):
+    """Makes a decode mode Batch of dialogues whose rewrite is unknown; the query stands in for the reference rewrite.
+
+    Args:
+        dialogues: list of (context, query) pairs. The context is a list of turns, or a string with the turns separated by '/'.
+        vocab: Vocabulary object
+        hps: hyperparameters
+
+    Returns:
+        Batch object holding each dialogue repeated beam_size times across the batch
+    """
+    examples = [Example(context if isinstance(context, str) else '/'.join(context), query, query, vocab, hps)
+                for context, query in dialogues]
+    return Batch([ex for ex in examples for _ in range(hps.beam_size.value)], hps, vocab)
+
+
+def dialogue_error(context, query):
+    """Returns why (context, query) isn't a dialogue that dialogue_batch accepts, or None if it is one.
+    The context must be a string or a list of strings, and the query a string."""
+    if not isinstance(context, str) and not (isinstance(context, list) and all(isinstance(turn, str) for turn in context)):
+        return 'the context must be a string or a list of strings'
+    if not isinstance(query, str):
+        return 'the query must be a string'
+    return None
+
+
+def group_by_tokens(inputs, max_tokens, dec_steps):
+    """Greedily groups consecutive Examples into lists whose padded size,
+    batch_size * (max enc_len + max query_len + dec_steps), is at most max_tokens.
+    The decoder arrays of a Batch are always padded to max_dec_steps (see Batch.init_decoder_seq),
+    so they count for dec_steps whatever the length of the rewrites.
+    An Example that alone exceeds the budget gets a list of its own.
+
+    Args:
+        inputs: list of Examples, sorted by length
+        max_tokens: token budget of a batch
+        dec_steps: number of decoder steps the decoder arrays are padded to (hps.max_dec_steps)
+
+    Returns:
+        list of lists of Examples
+    """
+    batches = []
+    batch = []
+    max_enc_len = max_query_len = 0
+    for ex in inputs:
+        enc_len = max(max_enc_len, ex.enc_len)
+        query_len = max(max_query_len, ex.query_len)
+        if batch and (len(batch) + 1) * (enc_len + query_len + dec_steps) > max_tokens:
+            batches.append(batch)
+            batch = []
+            enc_len, query_len = ex.enc_len, ex.query_len
+        batch.append(ex)
+        max_enc_len, max_query_len = enc_len, query_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def example_generator(data_path, vocab, hps, single_pass, rng, keep=None, shard=None):
+    """Generates Examples. If data_path has been compiled with compile_dataset.py,
+    the Examples are built from the compiled dataset without tokenizing any text.
+
+    Args:
+        data_path:
+        vocab: Vocabulary object
+        hps: hyperparameters
+        single_pass:
+        rng: random.Random used to shuffle the datafiles
+        keep: optional function of the index of an example in the stream.
+            Examples for which it returns False are skipped without being built
+            (and, from a compiled dataset, without being read).
+        shard: optional pair (shard_index, num_shards). The stream is then made of the records whose index
+            is shard_index modulo num_shards.
+    """
+    def use(index):
+        """Whether to build the record of index in the stream of all the records of data_path."""
+        if shard is not None:
+            shard_index, num_shards = shard
+            if index % num_shards != shard_index:
+                return False
+            index //= num_shards
+        return keep is None or keep(index)
+
+    if compiled_dataset_prefixes(data_path):
+        records, make_example = compiled_generator(data_path, vocab, single_pass, rng, use), Example.from_compiled
+    else:
+        records, make_example = text_generator(data_path, single_pass, rng, use), Example.from_text
+    for record in records:
+        yield make_example(record, vocab, hps)
+
+
+def compiled_generator(data_path, vocab, single_pass, rng, use=None):
+    """Generates records from the compiled datasets matching data_path.
+
+    Args:
+        data_path:
+        vocab: Vocabulary object
+        single_pass:
+        rng: random.Random used to shuffle the datasets
+        use: optional function of the index of a record in the stream (counted over the epochs).
+            The records for which it returns False are skipped without being read.
+    """
+    datasets = [CompiledDataset(prefix, vocab)
+                for prefix in sorted(compiled_dataset_prefixes(data_path))]
+    index = 0
+    while True:
+        if not single_pass:
+            rng.shuffle(datasets)
+        for dataset in datasets:
+            for i in range(len(dataset)):
+                if use is None or use(index):
+                    yield dataset[i]
+                index += 1
+        if single_pass:
+            print("compiled_generator completed reading all datasets. No more data.")
+            break
+
+
+def text_generator(data_path, single_pass, rng, use=None):
+    """Generates article and abstract text from tf.Example.
+
+    Args:
+        data_path:
+        single_pass:
+        rng: random.Random used to shuffle the datafiles
+        use: optional function of the index of a record in the stream (counted over the epochs).
+            The records for which it returns False are skipped. Every line is still split to tell the records apart.
+    """
+    index = 0
+    while True:
+        filelist = glob.glob(data_path)  # get the list of datafiles
+        assert filelist, ('Error: Empty filelist at %s' % data_path)
+        if single_pass:
+            filelist = sorted(filelist)
+        else:
+            rng.shuffle(filelist)
+        for f in filelist:
+            with open(f, "r", encoding="utf8") as train_f:
+                for line in train_f:
+                    record = parse_record(line)
+                    if record is None:
+                        continue
+                    if use is None or use(index):
+                        yield record
+                    index += 1
+        if single_pass:
+            print("text_generator completed reading all datafiles. No more data.")
+            break
@@ -15,12 +15,11 @@
 # ==============================================================================
 """This file contains code to run beam search decoding"""
 
+import time
 import tensorflow as tf
 import numpy as np
 import data
 
-FLAGS = tf.app.flags.FLAGS
-
 
 class Hypothesis(object):
     """
@@ -92,103 +91,639 @@ def run_beam_search(sess, model, vocab, batch):
     Returns:
         best_hyp: Hypothesis object; the best hypothesis found by beam search.
     """
-    # Run the encoder to get the encoder hidden states and decoder initial state
-    enc_states, query_states, dec_in_state = model.run_encoder(sess, batch)
+    return run_beam_search_batch(sess, model, vocab, batch)[0]
+
+
+class BeamState(object):
+    """
+    Numpy store of the hypotheses of all the beams of a decode batch.
+    Row r of the batch holds one hypothesis; column t holds its token t (column 0 is [GO]).
+    A hypothesis only stores its latest token and a backpointer to the row of the hypothesis it extends,
+    so the full sequences are recovered by backtrace.
+    """
+
+    def __init__(self, num_rows, max_dec_steps, start_id, attn_length=None):
+        """BeamState constructor.
+
+        Args:
+            num_rows: Integer. Number of rows of the decode batch.
+            max_dec_steps: Integer. Maximum number of decoder steps.
+            start_id: Integer. Id of the [GO] token.
+            attn_length: Integer, or None to not record the attention distributions.
+        """
+        # tokens[r, t]: token t of the hypothesis in row r on step t
+        self.tokens = np.zeros([num_rows, max_dec_steps + 1], dtype=np.int64)
+        self.tokens[:, 0] = start_id
+        # backpointers[r, t]: the row of the hypothesis on step t-1 that the hypothesis in row r on step t extends
+        self.backpointers = np.zeros([num_rows, max_dec_steps + 1], dtype=np.int64)
+        # log_probs[r, t]: log probability of tokens[r, t]
+        self.log_probs = np.zeros([num_rows, max_dec_steps + 1])
+        # scores[r]: log probability of the latest hypothesis in row r, i.e. the sum of its token log probabilities
+        self.scores = np.zeros([num_rows])
+        # attn_dists[r, t]: attention distribution of the decoder step that produced tokens[r, t + 1]
+        if attn_length is None:
+            self.attn_dists = None
+        else:
+            self.attn_dists = np.zeros([num_rows, max_dec_steps, attn_length], dtype=np.float32)
+
+    def backtrace(self, row, step):
+        """Return the tokens, log probabilities and attention distributions (or an empty list)
+        of the hypothesis in row on step, following the backpointers down to [GO]."""
+        rows = [row]
+        for t in range(step, 0, -1):
+            rows.append(self.backpointers[rows[-1], t])
+        rows.reverse()
+        steps = np.arange(step + 1)
+        tokens = self.tokens[rows, steps].tolist()
+        log_probs = self.log_probs[rows, steps].tolist()
+        if self.attn_dists is None:
+            attn_dists = []
+        else:
+            attn_dists = list(self.attn_dists[rows[1:], steps[:-1]])
+        return tokens, log_probs, attn_dists
+
+    def hypothesis(self, row, step):
+        """Return the hypothesis in row on step as a Hypothesis object, without its decoder state and coverage."""
+        tokens, log_probs, attn_dists = self.backtrace(row, step)
+        return Hypothesis(
+            tokens=tokens, log_probs=log_probs, state=None, attn_dists=attn_dists, t_coverage=None, b_coverage=None)
+
+    def finished_hypothesis(self, parent, step, token, log_prob, attn_dist):
+        """Return the hypothesis that extends the hypothesis in row parent on step with token
+        as a Hypothesis object. Used for the hypotheses that have emitted the [STOP] token, which leave the beam."""
+        tokens, log_probs, attn_dists = self.backtrace(parent, step)
+        return Hypothesis(
+            tokens=tokens + [int(token)],
+            log_probs=log_probs + [float(log_prob)],
+            state=None,
+            attn_dists=attn_dists + ([] if attn_dist is None else [attn_dist]),
+            t_coverage=None,
+            b_coverage=None)
+
+
+def dialogue_max_steps(hps, batch):
+    """Return the maximum number of decoder steps of each dialogue of the batch, shape (num_dialogues):
+    max_dec_steps, or if dec_steps_slack >= 0, the query length (including its [STOP] token) plus dec_steps_slack,
+    since a rewrite is rarely much longer than its query (see length_stats.py)."""
+    query_lens = batch.query_lens[::hps.beam_size.value]
+    if hps.dec_steps_slack.value < 0:
+        return np.full([len(query_lens)], hps.max_dec_steps.value)
+    return np.minimum(query_lens + hps.dec_steps_slack.value, hps.max_dec_steps.value)
+
+
+def can_beat_results(live_scores, max_steps, best_results):
+    """Whether any hypothesis in the beam of each dialogue can still get a higher average log probability than
+    its best finished hypothesis. Extending a hypothesis can't raise its log probability, so its average log probability
+    is at most its log probability divided by the most tokens it can reach.
+
+    Args:
+        live_scores: array shape (num_dialogues, beam_size). The log probabilities of the hypotheses in the beams,
+            -inf for the empty places.
+        max_steps: array shape (num_dialogues). The maximum number of decoder steps of each dialogue.
+        best_results: array shape (num_dialogues). The average log probability of the best finished hypothesis
+            of each dialogue, -inf if there are none.
+    """
+    # the hypotheses reach at most max_steps tokens after the [GO] token
+    return np.max(live_scores, axis=1) / (max_steps + 1) > best_results
+
+
+def run_beam_search_batch(sess, model, vocab, batch, record_attention=False, encoding=None):
+    """Performs beam search decoding on all the dialogues of the given batch at once.
+    Each dialogue has its own beam, OOVs and finished hypotheses,
+    but the decoder runs one step for all the beams together.
+
+    Args:
+        sess: a tf.Session
+        model: a seq2seq model
+        vocab: Vocabulary object
+        batch: Batch object holding each dialogue repeated beam_size times across the batch,
+            i.e. rows d*beam_size to (d+1)*beam_size-1 hold dialogue d
+        record_attention: Boolean. Whether to keep the attention distributions of the hypotheses.
+        encoding: The encoding of the dialogues of the batch returned by model.encode, or None to run the encoder.
+
+    Returns:
+        best_hyps: list of Hypothesis objects; the best hypothesis found by beam search for each dialogue.
+    """
+    hps = model.hps
+    beam_size = hps.beam_size.value
+    num_rows = batch.enc_batch.shape[0]
+    num_dialogues = num_rows // beam_size
+    start_id = vocab.word2id(data.MARK_GO)
+    stop_id = vocab.word2id(data.MARK_EOS)
+    unk_id = vocab.word2id(data.MARK_UNK)
+
+    # Run the encoder to get the attention cache (encoder hidden states, attention keys, ...) and decoder initial state
+    attn_cache, dec_in_state = model.run_encoder(sess, batch, encoding=encoding)
     # dec_in_state is a LSTMStateTuple
-    # enc_states has shape [batch_size, <=max_enc_steps, 2*hidden_dim].
+    # attn_cache['enc_states'] has shape [batch_size, <=max_enc_steps, 2*hidden_dim].
 
-    # Initialize beam_size-many hyptheses
-    hyps = [
-        Hypothesis(
-            tokens=[vocab.word2id(data.MARK_GO)],
-            log_probs=[0.0],
-            state=dec_in_state,
-            attn_dists=[],
-            # zero vector of length attention_length
-            t_coverage=np.zeros([batch.enc_batch.shape[1]]),
-            b_coverage=np.zeros([batch.query_batch.shape[1]])
-            )
-        for _ in range(FLAGS.beam_size)
-    ]
-    # this will contain finished hypotheses (those that have emitted the [STOP] token)
-    results = []
+    # The beams of all the dialogues; rows d*beam_size to (d+1)*beam_size-1 hold the beam of dialogue d.
+    # Initially each row holds the [GO] hypothesis.
+    beam = BeamState(num_rows, hps.max_dec_steps.value, start_id,
+                     batch.enc_batch.shape[1] if record_attention else None)
+    max_steps = dialogue_max_steps(hps, batch)
+    states = dec_in_state
+    # zero vectors of length attention_length
+    t_coverage = np.zeros([num_rows, batch.enc_batch.shape[1]])
+    b_coverage = np.zeros([num_rows, batch.query_batch.shape[1]])
+    # this will contain finished hypotheses (those that have emitted the [STOP] token) for each dialogue
+    results = [[] for _ in range(num_dialogues)]
+    num_results = np.zeros([num_dialogues], dtype=np.int64)
+    # average log probability of the best finished hypothesis of each dialogue
+    best_results = np.full([num_dialogues], -np.inf)
+    # number of hypotheses in the beam of each dialogue, and its number of decoder steps.
+    # On the first step, we only had one original hypothesis (the initial hypothesis).
+    # On subsequent steps, all original hypotheses are distinct.
+    num_hyps = np.ones([num_dialogues], dtype=np.int64)
+    dialogue_steps = np.zeros([num_dialogues], dtype=np.int64)
+    # options of each hypothesis and candidates of each dialogue
+    num_options = beam_size * 2
+    num_cands = beam_size * num_options
+    # Going down the ranking of the candidates, at most beam_size are kept before the beam is full, and as
+    # each hypothesis has [STOP] at most once among its options, at most beam_size others have stopped.
+    # So only the most likely 2*beam_size candidates can be reached.
+    num_reachable = 2 * beam_size
+    dialogue_nums = np.arange(num_dialogues)[:, None]
 
     steps = 0
-    while steps < FLAGS.max_dec_steps and len(results) < FLAGS.beam_size:
+    while True:
+        # the dialogues still decoding
+        decoding = (num_results < beam_size) & (steps < max_steps)
+        if hps.early_stop_beam.value:
+            live_scores = np.where(np.arange(beam_size) < num_hyps[:, None],
+                                   beam.scores.reshape([num_dialogues, beam_size]), -np.inf)
+            decoding &= can_beat_results(live_scores, max_steps, best_results)
+        if not decoding.any():
+            break
         # latest token produced by each hypothesis
-        latest_tokens = [h.latest_token for h in hyps]
+        latest_tokens = beam.tokens[:, steps]
         # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
-        latest_tokens = [
-            t if t in range(vocab.size()) else vocab.word2id(data.MARK_UNK)
-            for t in latest_tokens
-        ]
-        # list of current decoder states of the hypotheses
-        states = [h.state for h in hyps]
-        # list of coverage vectors (or None)
-        prev_t_coverage = [h.t_coverage for h in hyps]
-        prev_b_coverage = [h.b_coverage for h in hyps]
+        latest_tokens = np.where(latest_tokens < vocab.size(), latest_tokens, unk_id)
 
         # Run one step of the decoder to get the new info
         (topk_ids, topk_log_probs, new_states, attn_dists,
          new_t_coverage, new_b_coverage) = model.decode_onestep(
              sess=sess,
-             batch=batch,
              latest_tokens=latest_tokens,
-             enc_states=enc_states,
-             query_states=query_states,
+             attn_cache=attn_cache,
              dec_init_states=states,
-             prev_t_coverage=prev_t_coverage,
-             prev_b_coverage=prev_b_coverage)
-
-        # Extend each hypothesis and collect them all in all_hyps
-        all_hyps = []
-        # On the first step, we only had one original hypothesis (the initial hypothesis).
-        # On subsequent steps, all original hypotheses are distinct.
-        num_orig_hyps = 1 if steps == 0 else len(hyps)
-        for i in range(num_orig_hyps):
-            # take the ith hypothesis and new decoder state info
-            h, new_state, attn_dist, new_t_coverage_i, new_b_coverage_i = hyps[i], new_states[
-                i], attn_dists[i], new_t_coverage[i], new_b_coverage[i]
-            # for each of the top 2*beam_size hyps:
-            for j in range(FLAGS.beam_size * 2):
-                # Extend the ith hypothesis with the jth option
-                new_hyp = h.extend(
-                    token=topk_ids[i, j],
-                    log_prob=topk_log_probs[i, j],
-                    state=new_state,
-                    attn_dist=attn_dist,
-                    t_coverage=new_t_coverage_i,
-                    b_coverage=new_b_coverage_i)
-                all_hyps.append(new_hyp)
-
-        # Filter and collect any hypotheses that have produced the end token.
-        hyps = []  # will contain hypotheses for the next step
-        for h in sort_hyps(all_hyps):  # in order of most likely h
-            # if stop token is reached...
-            if h.latest_token == vocab.word2id(data.MARK_EOS):
-                # If this hypothesis is sufficiently long, put in results. Otherwise discard.
-                if steps >= FLAGS.min_dec_steps:
-                    results.append(h)
-            else:  # hasn't reached stop token, so continue to extend this hypothesis
-                hyps.append(h)
-            if len(hyps) == FLAGS.beam_size or len(results) == FLAGS.beam_size:
-                # Once we've collected beam_size-many hypotheses for the next step, or beam_size-many complete hypotheses, stop.
-                break
+             prev_t_coverage=t_coverage,
+             prev_b_coverage=b_coverage)
+
+        # Extend each hypothesis with each of its top 2*beam_size tokens; candidate i*2*beam_size+j of a dialogue
+        # extends its ith hypothesis with the jth option. shape [num_dialogues, num_cands]
+        cand_scores = (beam.scores[:, None] + topk_log_probs).reshape([num_dialogues, num_cands])
+        cand_scores[np.arange(num_cands) >= num_hyps[:, None] * num_options] = -np.inf
+        # the reachable candidates, in order of most likely candidate
+        # (equal candidates stay in order, like the stable sort of sort_hyps)
+        cands = np.argpartition(-cand_scores, num_reachable - 1, axis=1)[:, :num_reachable]
+        cand_scores = np.take_along_axis(cand_scores, cands, axis=1)
+        order = np.lexsort((cands, -cand_scores / (steps + 2)))
+        cands = np.take_along_axis(cands, order, axis=1)
+        cand_scores = np.take_along_axis(cand_scores, order, axis=1)
+        cand_rows = dialogue_nums * beam_size + cands // num_options
+        cand_ids = topk_ids[cand_rows, cands % num_options]
+        cand_log_probs = topk_log_probs[cand_rows, cands % num_options]
+
+        # A candidate that reaches the stop token is put in results if it is sufficiently long, otherwise discarded;
+        # the others continue to be extended. Once we've collected beam_size-many hypotheses for the next step,
+        # or beam_size-many complete hypotheses, stop.
+        is_stop = cand_ids == stop_id
+        can_finish = is_stop & (steps >= hps.min_dec_steps.value)
+        num_kept_before = np.cumsum(~is_stop, axis=1) - ~is_stop
+        num_results_before = np.cumsum(can_finish, axis=1) - can_finish + num_results[:, None]
+        reached = (num_kept_before < beam_size) & (num_results_before < beam_size) & decoding[:, None]
+        kept = reached & ~is_stop
+        finished = reached & can_finish
+
+        for d, c in zip(*np.nonzero(finished)):
+            row = cand_rows[d, c]
+            results[d].append(beam.finished_hypothesis(
+                row, steps, cand_ids[d, c], cand_log_probs[d, c],
+                attn_dists[row] if record_attention else None))
+            best_results[d] = max(best_results[d], results[d][-1].avg_log_prob)
+        num_results += finished.sum(axis=1)
+
+        # The kept candidates make the new beams. A finished dialogue keeps feeding its last hypotheses to the decoder.
+        beam_cands = np.argsort(~kept, axis=1, kind='stable')[:, :beam_size]
+        in_beam = np.take_along_axis(kept, beam_cands, axis=1).ravel()
+
+        def beam_values(values, default):
+            return np.where(in_beam, np.take_along_axis(values, beam_cands, axis=1).ravel(), default)
+
+        # the row each row of the next step extends
+        parents = beam_values(cand_rows, np.arange(num_rows))
+        beam.tokens[:, steps + 1] = beam_values(cand_ids, latest_tokens)
+        beam.backpointers[:, steps + 1] = parents
+        beam.log_probs[:, steps + 1] = beam_values(cand_log_probs, 0.0)
+        beam.scores = beam_values(cand_scores, beam.scores)
+        if record_attention:
+            beam.attn_dists[:, steps] = attn_dists[parents]
+        num_hyps = np.where(decoding, kept.sum(axis=1), num_hyps)
+        dialogue_steps[decoding] = steps + 1
+
+        # Reorder the decoder states and coverage vectors
+        states = tf.contrib.rnn.LSTMStateTuple(new_states.c[parents], new_states.h[parents])
+        if new_t_coverage is not None:
+            t_coverage = new_t_coverage[parents]
+            b_coverage = new_b_coverage[parents]
 
         steps += 1
 
-    # At this point, either we've got beam_size results, or we've reached maximum decoder steps
+    # At this point, for each dialogue either we've got beam_size results, or we've reached maximum decoder steps
+    best_hyps = []
+    for d in range(num_dialogues):
+        # if we don't have any complete results,
+        # add all current hypotheses (incomplete summaries) to results
+        if len(results[d]) == 0:
+            results[d] = [
+                beam.hypothesis(row, dialogue_steps[d])
+                for row in range(d * beam_size, d * beam_size + num_hyps[d])
+            ]
+
+        # Sort hypotheses by average log probability
+        # Return the hypothesis with highest average log prob
+        best_hyps.append(sort_hyps(results[d])[0])
+    return best_hyps
 
-    # if we don't have any complete results,
-    # add all current hypotheses (incomplete summaries) to results
-    if len(results) == 0:
-        results = hyps
 
-    # Sort hypotheses by average log probability
-    hyps_sorted = sort_hyps(results)
-   # tensor_sorted = tf.convert_to_tensor(hyps_sorted[0]) 
-    # Return the hypothesis with highest average log prob
-    return hyps_sorted[0]
+def run_adaptive_beam_search(sess, model, vocab, batch, margin, max_steps=None, time_budget=None,
+                             record_attention=False, encoding=None):
+    """Performs beam search decoding on all the dialogues of the given batch, adapting the beam width of each dialogue.
+    Each dialogue starts with a beam of one hypothesis. Whenever the average log probabilities of its two most likely
+    candidates are less than margin apart, its beam width is doubled, up to beam_size.
+    A dialogue stops once it has as many finished hypotheses as its beam width.
+    Only the hypotheses in the beams of the dialogues still decoding are fed to the decoder,
+    so the decoder batch is as small as the beams are narrow.
+
+    Args:
+        sess: a tf.Session
+        model: a seq2seq model
+        vocab: Vocabulary object
+        batch: Batch object holding each dialogue repeated beam_size times across the batch
+        margin: Float. Average log probability margin under which the beam is widened.
+        max_steps: Integer, or None. The maximum number of decoder steps, on top of the limit of each dialogue
+            (see dialogue_max_steps).
+        time_budget: Float, or None. Seconds after which decoding stops,
+            and each dialogue takes its best hypothesis so far.
+        record_attention: Boolean. Whether to keep the attention distributions of the hypotheses.
+        encoding: The encoding of the dialogues of the batch returned by model.encode, or None to run the encoder.
+
+    Returns:
+        best_hyps: list of Hypothesis objects; the best hypothesis found for each dialogue.
+    """
+    start_time = time.time()
+    hps = model.hps
+    beam_size = hps.beam_size.value
+    num_dialogues = batch.enc_batch.shape[0] // beam_size
+    num_slots = num_dialogues * beam_size
+    max_steps = dialogue_max_steps(hps, batch) if max_steps is None else np.minimum(dialogue_max_steps(hps, batch), max_steps)
+    stop_id = vocab.word2id(data.MARK_EOS)
+    unk_id = vocab.word2id(data.MARK_UNK)
+
+    # Run the encoder once for each dialogue
+    dialogue_attn_cache, dec_in_state = model.run_encoder(sess, batch, beam_size=1, encoding=encoding)
+
+    # Slots d*beam_size to (d+1)*beam_size-1 hold the beam of dialogue d
+    beam = BeamState(num_slots, hps.max_dec_steps.value, vocab.word2id(data.MARK_GO),
+                     batch.enc_batch.shape[1] if record_attention else None)
+    # decoder state and coverage vectors of each slot
+    cells = np.repeat(dec_in_state.c, beam_size, axis=0)
+    hiddens = np.repeat(dec_in_state.h, beam_size, axis=0)
+    t_coverage = np.zeros([num_slots, batch.enc_batch.shape[1]])
+    b_coverage = np.zeros([num_slots, batch.query_batch.shape[1]])
+    # this will contain finished hypotheses (those that have emitted the [STOP] token) for each dialogue
+    results = [[] for _ in range(num_dialogues)]
+    best_results = np.full([num_dialogues], -np.inf)
+    widths = np.ones([num_dialogues], dtype=np.int64)
+    num_hyps = np.ones([num_dialogues], dtype=np.int64)
+    dialogue_steps = np.zeros([num_dialogues], dtype=np.int64)
+    done = np.zeros([num_dialogues], dtype=bool)
+    # the slots of the rows of the last decoder batch
+    fed_slots = None
+
+    steps = 0
+    while True:
+        done |= steps >= max_steps
+        if hps.early_stop_beam.value:
+            live_scores = np.where(np.arange(beam_size) < num_hyps[:, None],
+                                   beam.scores.reshape([num_dialogues, beam_size]), -np.inf)
+            done |= ~can_beat_results(live_scores, max_steps, best_results)
+        if done.all() or (time_budget is not None and time.time() - start_time > time_budget):
+            break
+        decoding = np.nonzero(~done)[0]
+        slots = np.concatenate([d * beam_size + np.arange(num_hyps[d]) for d in decoding])
+        if fed_slots is None or not np.array_equal(slots, fed_slots):
+            attn_cache = model.gather_attn_cache(dialogue_attn_cache, slots // beam_size)
+            fed_slots = slots
+        # the row of the decoder batch of each fed slot
+        slot_rows = np.zeros([num_slots], dtype=np.int64)
+        slot_rows[slots] = np.arange(len(slots))
+        # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+        latest_tokens = beam.tokens[slots, steps]
+        latest_tokens = np.where(latest_tokens < vocab.size(), latest_tokens, unk_id)
+
+        # Run one step of the decoder to get the new info
+        (topk_ids, topk_log_probs, new_states, attn_dists,
+         new_t_coverage, new_b_coverage) = model.decode_onestep(
+             sess=sess,
+             latest_tokens=latest_tokens,
+             attn_cache=attn_cache,
+             dec_init_states=tf.contrib.rnn.LSTMStateTuple(cells[slots], hiddens[slots]),
+             prev_t_coverage=t_coverage[slots],
+             prev_b_coverage=b_coverage[slots])
+
+        # the slot each slot of the next step extends; the slots of finished dialogues don't change
+        parents = np.arange(num_slots)
+        next_tokens = beam.tokens[:, steps].copy()
+        next_log_probs = np.zeros([num_slots])
+        next_scores = beam.scores.copy()
+        for d in decoding:
+            orig_slots = d * beam_size + np.arange(num_hyps[d])
+            orig_rows = slot_rows[orig_slots]
+            # candidate i*2*beam_size+j extends the ith hypothesis with the jth option
+            cand_scores = (beam.scores[orig_slots, None] + topk_log_probs[orig_rows]).ravel()
+            order = np.argsort(-cand_scores / (steps + 2), kind='stable')
+            # Widen the beam when the two most likely candidates are close
+            if widths[d] < beam_size and (cand_scores[order[0]] - cand_scores[order[1]]) / (steps + 2) < margin:
+                widths[d] = min(widths[d] * 2, beam_size)
+            num_kept = 0
+            for c in order:
+                i, j = divmod(c, beam_size * 2)
+                row = orig_rows[i]
+                token = topk_ids[row, j]
+                if token == stop_id:
+                    if steps >= hps.min_dec_steps.value:
+                        results[d].append(beam.finished_hypothesis(
+                            orig_slots[i], steps, token, topk_log_probs[row, j],
+                            attn_dists[row] if record_attention else None))
+                        best_results[d] = max(best_results[d], results[d][-1].avg_log_prob)
+                else:
+                    slot = d * beam_size + num_kept
+                    parents[slot] = orig_slots[i]
+                    next_tokens[slot] = token
+                    next_log_probs[slot] = topk_log_probs[row, j]
+                    next_scores[slot] = cand_scores[c]
+                    num_kept += 1
+                if num_kept == widths[d] or len(results[d]) >= widths[d]:
+                    break
+            num_hyps[d] = num_kept
+            dialogue_steps[d] = steps + 1
+            done[d] = len(results[d]) >= widths[d]
+
+        # Store the next step of the beams, and reorder the decoder states and coverage vectors.
+        # The slots that were not fed get meaningless values, but they are not fed again before being overwritten.
+        parent_rows = slot_rows[parents]
+        beam.tokens[:, steps + 1] = next_tokens
+        beam.backpointers[:, steps + 1] = parents
+        beam.log_probs[:, steps + 1] = next_log_probs
+        beam.scores = next_scores
+        if record_attention:
+            beam.attn_dists[:, steps] = attn_dists[parent_rows]
+        cells = new_states.c[parent_rows]
+        hiddens = new_states.h[parent_rows]
+        if new_t_coverage is not None:
+            t_coverage = new_t_coverage[parent_rows]
+            b_coverage = new_b_coverage[parent_rows]
+
+        steps += 1
+
+    best_hyps = []
+    for d in range(num_dialogues):
+        # if we don't have any complete results,
+        # add all current hypotheses (incomplete summaries) to results
+        if len(results[d]) == 0:
+            results[d] = [
+                beam.hypothesis(slot, dialogue_steps[d])
+                for slot in range(d * beam_size, d * beam_size + num_hyps[d])
+            ]
+        best_hyps.append(sort_hyps(results[d])[0])
+    return best_hyps
+
+
+def run_sampling_search(sess, model, vocab, batch, top_k=1, temperature=1.0, record_attention=False, encoding=None):
+    """Decodes each dialogue of the given batch with a single hypothesis, without beam search bookkeeping.
+    On each step every hypothesis takes its most likely token (greedy decoding, top_k=1),
+    or samples one of its top_k most likely tokens, with the log probabilities divided by temperature.
+    Each dialogue is encoded and decoded in a single row of the decoder batch.
+
+    Args:
+        sess: a tf.Session
+        model: a seq2seq model
+        vocab: Vocabulary object
+        batch: Batch object holding each dialogue repeated beam_size times across the batch
+        top_k: Integer, at most 2*beam_size. Number of most likely tokens to sample from; 1 for greedy decoding.
+        temperature: Float. Above 1 flattens the distribution the tokens are sampled from, below 1 sharpens it.
+        record_attention: Boolean. Whether to keep the attention distributions of the hypotheses.
+        encoding: The encoding of the dialogues of the batch returned by model.encode, or None to run the encoder.
+
+    Returns:
+        hyps: list of Hypothesis objects; the hypothesis decoded for each dialogue.
+    """
+    hps = model.hps
+    num_dialogues = batch.enc_batch.shape[0] // hps.beam_size.value
+    start_id = vocab.word2id(data.MARK_GO)
+    stop_id = vocab.word2id(data.MARK_EOS)
+    unk_id = vocab.word2id(data.MARK_UNK)
+    rows = np.arange(num_dialogues)
+
+    # Run the encoder once for each dialogue
+    attn_cache, states = model.run_encoder(sess, batch, beam_size=1, encoding=encoding)
+    t_coverage = np.zeros([num_dialogues, batch.enc_batch.shape[1]])
+    b_coverage = np.zeros([num_dialogues, batch.query_batch.shape[1]])
+
+    tokens = np.zeros([num_dialogues, hps.max_dec_steps.value + 1], dtype=np.int64)
+    tokens[:, 0] = start_id
+    log_probs = np.zeros([num_dialogues, hps.max_dec_steps.value + 1])
+    # number of tokens of each hypothesis; the hypotheses that haven't stopped have the maximum
+    lengths = np.full([num_dialogues], hps.max_dec_steps.value + 1)
+    stopped = np.zeros([num_dialogues], dtype=bool)
+    max_steps = dialogue_max_steps(hps, batch)
+    attn_dists = []
+
+    steps = 0
+    while steps < hps.max_dec_steps.value and not stopped.all():
+        # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+        latest_tokens = np.where(tokens[:, steps] < vocab.size(), tokens[:, steps], unk_id)
+
+        # Run one step of the decoder to get the new info
+        (topk_ids, topk_log_probs, states, step_attn_dists,
+         t_coverage, b_coverage) = model.decode_onestep(
+             sess=sess,
+             latest_tokens=latest_tokens,
+             attn_cache=attn_cache,
+             dec_init_states=states,
+             prev_t_coverage=t_coverage,
+             prev_b_coverage=b_coverage)
+        if record_attention:
+            attn_dists.append(step_attn_dists)
+
+        # A hypothesis can't stop before min_dec_steps
+        if steps < hps.min_dec_steps.value:
+            topk_log_probs = np.where(topk_ids == stop_id, -np.inf, topk_log_probs)
+        if top_k == 1:
+            choices = np.argmax(topk_log_probs, axis=1)
+        else:
+            # topk_ids are in order of most likely token
+            logits = topk_log_probs[:, :top_k] / temperature
+            probs = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+            probs /= np.sum(probs, axis=1, keepdims=True)
+            choices = np.argmax(np.cumsum(probs, axis=1) > np.random.rand(num_dialogues, 1), axis=1)
+        choices_ids = topk_ids[rows, choices]
+
+        # The stopped hypotheses keep feeding their last token to the decoder, but don't change
+        tokens[:, steps + 1] = np.where(stopped, tokens[:, steps], choices_ids)
+        log_probs[:, steps + 1] = np.where(stopped, 0.0, topk_log_probs[rows, choices])
+        # a hypothesis stops with the [STOP] token or once it reaches the maximum number of steps of its dialogue
+        new_stopped = ~stopped & ((choices_ids == stop_id) | (steps + 1 >= max_steps))
+        lengths[new_stopped] = steps + 2
+        stopped |= new_stopped
+        steps += 1
+
+    return [
+        Hypothesis(
+            tokens=tokens[d, :lengths[d]].tolist(),
+            log_probs=log_probs[d, :lengths[d]].tolist(),
+            state=None,
+            attn_dists=[step_attn_dists[d] for step_attn_dists in attn_dists[:lengths[d] - 1]],
+            t_coverage=None,
+            b_coverage=None)
+        for d in range(num_dialogues)
+    ]
+
+
+def run_beam_search_in_graph(sess, model, batch, encoding=None):
+    """Same as run_beam_search_batch, but the whole search runs inside the graph with a single session.run
+    (see SummarizationModel._add_beam_search). Needs a model built with in_graph_beam_search.
+    With the encoding of the dialogues (see model.encode), the search starts from it instead of running the encoder.
+
+    Returns:
+        best_hyps: list of Hypothesis objects; the best hypothesis found by beam search for each dialogue.
+        They hold the tokens and log probabilities, but no decoder state or attention distributions.
+    """
+    tokens, log_probs, lengths = model.run_beam_search(sess, batch, encoding=encoding)
+    return [
+        Hypothesis(
+            tokens=tokens[d, :length].tolist(),
+            log_probs=log_probs[d, :length].tolist(),
+            state=None,
+            attn_dists=[],
+            t_coverage=None,
+            b_coverage=None)
+        for d, length in enumerate(lengths)
+    ]
+
+
+def decode_dialogues(sess, model, vocab, batch, strategy, max_steps=None, time_budget=None, record_attention=False):
+    """Decode the dialogues of a batch with the given strategy.
+    With the no-rewrite gate (hps.no_rewrite_gate), the dialogues that the gate predicts need no rewriting
+    are not decoded; their hypothesis is their query.
+
+    Args:
+        sess: a tf.Session
+        model: a seq2seq model
+        vocab: Vocabulary object
+        batch: Batch object holding each dialogue repeated beam_size times across the batch
+        strategy: One of beam/greedy/sample/adaptive.
+            greedy and sample decode a single hypothesis for each dialogue, see run_sampling_search.
+            adaptive widens the beam of each dialogue as needed, see run_adaptive_beam_search
+        max_steps: For the adaptive strategy, the maximum number of decoder steps, or None for max_dec_steps.
+        time_budget: For the adaptive strategy, seconds after which decoding stops,
+            or None for hps.decode_time_budget.
+        record_attention: Boolean. Whether to keep the attention distributions of the hypotheses.
+
+    Returns:
+        best_hyps: list of Hypothesis objects; the best hypothesis of each dialogue.
+        no_rewrite: boolean array shape (num_dialogues), whether the gate returned the query of each dialogue,
+            or None without the gate.
+    """
+    hps = model.hps
+    if not hps.no_rewrite_gate.value:
+        return _decode_all(sess, model, vocab, batch, strategy, max_steps, time_budget, record_attention), None
+
+    beam_size = hps.beam_size.value
+    # the gate probability comes with the encoding, which the dialogues to rewrite then reuse
+    encoding, no_rewrite_prob = model.encode(sess, batch)
+    no_rewrite = no_rewrite_prob >= hps.no_rewrite_threshold.value
+    best_hyps = [None] * len(no_rewrite)
+    for d in np.nonzero(no_rewrite)[0]:
+        best_hyps[d] = query_hypothesis(vocab, batch, d * beam_size)
+    # decode the other dialogues
+    rewrite = np.nonzero(~no_rewrite)[0]
+    if len(rewrite) > 0:
+        rows = (rewrite[:, None] * beam_size + np.arange(beam_size)).ravel()
+        hyps = _decode_all(sess, model, vocab, batch.subset(rows), strategy, max_steps, time_budget, record_attention,
+                           encoding if len(rewrite) == len(no_rewrite) else model.select_encoding(encoding, rewrite))
+        for d, hyp in zip(rewrite, hyps):
+            best_hyps[d] = hyp
+    return best_hyps, no_rewrite
+
+
+def _decode_all(sess, model, vocab, batch, strategy, max_steps, time_budget, record_attention, encoding=None):
+    """Decode all the dialogues of a batch with the given strategy, from their encoding if it is given.
+    See decode_dialogues."""
+    hps = model.hps
+    if strategy == 'beam':
+        if hps.in_graph_beam_search.value:
+            return run_beam_search_in_graph(sess, model, batch, encoding=encoding)
+        return run_beam_search_batch(sess, model, vocab, batch, record_attention=record_attention, encoding=encoding)
+    elif strategy == 'adaptive':
+        if time_budget is None and hps.decode_time_budget.value > 0:
+            time_budget = hps.decode_time_budget.value
+        return run_adaptive_beam_search(sess, model, vocab, batch,
+                                        margin=hps.adaptive_beam_margin.value,
+                                        max_steps=max_steps,
+                                        time_budget=time_budget,
+                                        record_attention=record_attention,
+                                        encoding=encoding)
+    elif strategy == 'greedy':
+        return run_sampling_search(sess, model, vocab, batch, record_attention=record_attention, encoding=encoding)
+    elif strategy == 'sample':
+        return run_sampling_search(sess, model, vocab, batch,
+                                   top_k=hps.sample_top_k.value,
+                                   temperature=hps.sample_temperature.value,
+                                   record_attention=record_attention,
+                                   encoding=encoding)
+    else:
+        raise ValueError("The decode strategy must be one of beam/greedy/sample/adaptive")
+
+
+def query_hypothesis(vocab, batch, row):
+    """Return a Hypothesis whose tokens are the query of the given row of the batch, to use it as its own rewrite."""
+    # the query ends with the [STOP] token
+    query_ids = batch.query_batch_extend_vocab[row, :batch.query_lens[row]].tolist()
+    return Hypothesis(
+        tokens=[vocab.word2id(data.MARK_GO)] + query_ids,
+        log_probs=[0.0] * (len(query_ids) + 1),
+        state=None,
+        attn_dists=[],
+        t_coverage=None,
+        b_coverage=None)
+
+
+def hypothesis_words(hyp, vocab, batch, row):
+    """Returns the list of words of a decoded hypothesis, without its [GO] token and its [STOP] token.
+
+    Args:
+        hyp: Hypothesis object
+        vocab: Vocabulary object
+        batch: the Batch the hypothesis was decoded from
+        row: a row of the batch holding the hypothesis' dialogue
+    """
+    # Extract the output ids from the hypothesis and convert back to words
+    output_ids = [int(t) for t in hyp.tokens[1:]]
+    # the batch holds the in-article OOVs in pointer-generator mode
+    art_oovs = batch.art_oovs[row] if hasattr(batch, 'art_oovs') else None
+    decoded_words = data.outputids2words(output_ids, vocab, art_oovs)
+
+    # Remove the [STOP] token from decoded_words, if necessary
+    try:
+        # index of the (first) [STOP] symbol
+        fst_stop_idx = decoded_words.index(data.MARK_EOS)
+        decoded_words = decoded_words[:fst_stop_idx]
+    except ValueError:
+        pass
+    return decoded_words
 
 
 def sort_hyps(hyps):
@@ -0,0 +1,18 @@
+"""
+Desc: this script compiles a data file into the binary format read by Batcher (see data.compile_dataset),
+so that the input threads don't have to tokenize the text again on every epoch.
+Run like this:
+  python compile_dataset.py data/train.txt data/vocab.txt 4000 data/train
+and then train with --data_path=data/train. The vocab_size must be the same as the one used for training.
+"""
+import sys
+from data import Vocab, compile_dataset
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        raise Exception(
+            "Usage: python compile_dataset.py <data_path> <vocab_path> <vocab_size> <output_prefix>")
+    data_path, vocab_path, vocab_size, out_prefix = sys.argv[1:]
+    vocab = Vocab(vocab_path, int(vocab_size))
+    num_examples = compile_dataset(data_path, vocab, out_prefix)
+    print("Compiled %i examples from %s to %s" % (num_examples, data_path, out_prefix))
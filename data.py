@@ -4,12 +4,24 @@ import glob
 import random
 import struct
 import csv
+import os
+import json
+import hashlib
+import mmap
+import numpy as np
 
 MARK_PAD = '<PAD>'  # This has a vocab id, which is used to pad the encoder input, decoder input and target sequence
 MARK_UNK = '<UNK>'  # This has a vocab id, which is used to represent out-of-vocabulary words
 MARK_GO = '<GO>'  # This has a vocab id, which is used at the start of every decoder input sequence
 MARK_EOS = '<EOS>'  # This has a vocab id, which is used at the end of untruncated target sequences
 
+# Files written by compile_dataset for a compiled dataset with prefix P: P.meta.json, P.tokens.npy, ...
+COMPILED_META_SUFFIX = '.meta.json'
+COMPILED_TOKENS_SUFFIX = '.tokens.npy'
+COMPILED_OFFSETS_SUFFIX = '.offsets.npy'
+COMPILED_EXAMPLES_SUFFIX = '.examples.jsonl'
+COMPILED_RECORD_OFFSETS_SUFFIX = '.record_offsets.npy'
+
 
 class Vocab(object):
     """Vocabulary class for mapping between words and ids (integers)"""
@@ -75,6 +87,11 @@ class Vocab(object):
         """Returns the total size of the vocabulary"""
         return self._count
 
+    def fingerprint(self):
+        """Returns a hash of the words in id order. Compiled datasets are only valid for the vocab they were built with."""
+        words = [self._id_to_word[i] for i in range(self._count)]
+        return hashlib.sha1('\n'.join(words).encode('utf-8')).hexdigest()
+
     def write_metadata(self, fpath):
         """Writes metadata file for Tensorboard word embedding visualizer as described here:
         https://www.tensorflow.org/get_started/embedding_viz
@@ -109,6 +126,16 @@ def split_text_with_whitespace(text):
     return res
 
 
+def parse_record(line):
+    """Parses one line of a data file into (context, summarization, query) strings.
+    Returns None if the line doesn't have the four '\\t\\t'-separated fields.
+    """
+    record = line.strip().split('\t\t')
+    if len(record) != 4:
+        return None
+    return (record[0].strip() + '/' + record[1].strip(), record[3].strip(), record[2].strip())
+
+
 def sentence2id(sentence, vocab, add_eos=False):
     """Converting a sentence (list of words) to a list of ids."""
     unk_id = vocab.word2id(MARK_UNK)
@@ -211,6 +238,12 @@ def summarization2ids(summarization_words, vocab, context_oovs):
     return ids
 
 
+def extended2ids(extended_ids, vocab):
+    """Map temporary article OOV ids (>= vocab size) back to the <UNK> id, e.g. to look up word embeddings."""
+    extended_ids = np.asarray(extended_ids)
+    return np.where(extended_ids < vocab.size(), extended_ids, vocab.word2id(MARK_UNK)).astype(np.int32)
+
+
 def outputids2words(id_list, vocab, article_oovs):
     """
     Maps output ids to words, including mapping in-article OOVs 
@@ -279,3 +312,149 @@ def show_abs_oovs(abstract, vocab, article_oovs):
             new_words.append(w)
     out_str = ''.join(new_words)
     return out_str
+
+
+def compile_dataset(data_path, vocab, out_prefix):
+    """Tokenizes every example in data_path once and writes it in a compact binary format that the Batcher
+    can read through numpy.memmap instead of re-tokenizing the text on every epoch.
+
+    The format consists of five files:
+        out_prefix.tokens.npy: flat int32 array with the context, query and summarization ids of every example,
+            in the extended vocab (in-article OOVs are represented by their temporary article OOV id).
+        out_prefix.offsets.npy: int64 array of length 3 * num_examples + 1. Example i's context, query and
+            summarization are tokens[offsets[3i]:offsets[3i+1]], tokens[offsets[3i+1]:offsets[3i+2]]
+            and tokens[offsets[3i+2]:offsets[3i+3]].
+        out_prefix.examples.jsonl: one JSON list [oovs, context, summarization, query] per example.
+        out_prefix.record_offsets.npy: int64 array of length num_examples + 1. Example i's JSON list is
+            the bytes record_offsets[i]:record_offsets[i+1] of out_prefix.examples.jsonl.
+        out_prefix.meta.json: number of examples and the vocab fingerprint.
+
+    Args:
+        data_path: path expression to the text datafiles. Can include wildcards.
+        vocab: Vocabulary object
+        out_prefix: path prefix for the output files
+
+    Returns:
+        num_examples: number of examples written
+    """
+    filelist = sorted(glob.glob(data_path))
+    assert filelist, ('Error: Empty filelist at %s' % data_path)
+
+    tokens = []
+    offsets = [0]
+    record_offsets = [0]
+    # written as bytes, so that the record offsets are byte offsets whatever the platform's newlines
+    with open(out_prefix + COMPILED_EXAMPLES_SUFFIX, 'wb') as examples_f:
+        for fname in filelist:
+            with open(fname, 'r', encoding='utf8') as data_f:
+                for line in data_f:
+                    record = parse_record(line)
+                    if record is None:
+                        continue
+                    context, summarization, query = record
+                    context_ids, oovs = context2ids(split_text_with_whitespace(context) + [MARK_EOS], vocab)
+                    query_ids, oovs = query2ids(split_text_with_whitespace(query) + [MARK_EOS], vocab, oovs)
+                    summarization_ids = summarization2ids(split_text_with_whitespace(summarization), vocab, oovs)
+                    for ids in (context_ids, query_ids, summarization_ids):
+                        tokens.extend(ids)
+                        offsets.append(len(tokens))
+                    record = (json.dumps([oovs, context, summarization, query], ensure_ascii=False) + '\n').encode('utf8')
+                    examples_f.write(record)
+                    record_offsets.append(record_offsets[-1] + len(record))
+
+    num_examples = (len(offsets) - 1) // 3
+    np.save(out_prefix + COMPILED_TOKENS_SUFFIX, np.array(tokens, dtype=np.int32))
+    np.save(out_prefix + COMPILED_OFFSETS_SUFFIX, np.array(offsets, dtype=np.int64))
+    np.save(out_prefix + COMPILED_RECORD_OFFSETS_SUFFIX, np.array(record_offsets, dtype=np.int64))
+    with open(out_prefix + COMPILED_META_SUFFIX, 'w', encoding='utf8') as meta_f:
+        json.dump({'num_examples': num_examples,
+                   'vocab_size': vocab.size(),
+                   'vocab_fingerprint': vocab.fingerprint(),
+                   'source': data_path}, meta_f)
+    return num_examples
+
+
+def rewrite_length_excess(data_path):
+    """Returns, for every example in data_path, how many more tokens its rewrite has than its query
+    (negative if the rewrite is shorter). Used to bound the number of decoder steps from the query length.
+
+    Args:
+        data_path: path expression to the text datafiles. Can include wildcards.
+    """
+    filelist = sorted(glob.glob(data_path))
+    assert filelist, ('Error: Empty filelist at %s' % data_path)
+
+    excess = []
+    for fname in filelist:
+        with open(fname, 'r', encoding='utf8') as data_f:
+            for line in data_f:
+                record = parse_record(line)
+                if record is None:
+                    continue
+                _, summarization, query = record
+                excess.append(len(split_text_with_whitespace(summarization)) - len(split_text_with_whitespace(query)))
+    return excess
+
+
+def compiled_dataset_prefixes(data_path):
+    """Returns the prefixes of the compiled datasets matching data_path (which can include wildcards), or [] if there are none."""
+    return [fname[:-len(COMPILED_META_SUFFIX)] for fname in glob.glob(data_path + COMPILED_META_SUFFIX)]
+
+
+def data_checksum(data_path):
+    """Returns a SHA-1 hex digest of the contents of the datafiles matching data_path, in the order they are read
+    in single_pass mode. For compiled datasets, the example texts and metadata are hashed."""
+    prefixes = compiled_dataset_prefixes(data_path)
+    if prefixes:
+        paths = [prefix + suffix for prefix in sorted(prefixes)
+                 for suffix in (COMPILED_META_SUFFIX, COMPILED_EXAMPLES_SUFFIX)]
+    else:
+        paths = sorted(glob.glob(data_path))
+    checksum = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                checksum.update(block)
+    return checksum.hexdigest()
+
+
+class CompiledDataset(object):
+    """Read-only view of a dataset written by compile_dataset. The token arrays and the example records are
+    memory-mapped, so that only the examples being read are loaded."""
+
+    def __init__(self, prefix, vocab):
+        """
+        Args:
+            prefix: path prefix the dataset was compiled to
+            vocab: Vocabulary object; must be the vocab the dataset was compiled with
+        """
+        with open(prefix + COMPILED_META_SUFFIX, 'r', encoding='utf8') as meta_f:
+            meta = json.load(meta_f)
+        if meta['vocab_size'] != vocab.size() or meta['vocab_fingerprint'] != vocab.fingerprint():
+            raise Exception(
+                'Compiled dataset %s was built with a different vocabulary; re-run compile_dataset.py' % prefix)
+        self._num_examples = meta['num_examples']
+        self._tokens = np.load(prefix + COMPILED_TOKENS_SUFFIX, mmap_mode='r')
+        self._offsets = np.load(prefix + COMPILED_OFFSETS_SUFFIX, mmap_mode='r')
+        if not os.path.exists(prefix + COMPILED_RECORD_OFFSETS_SUFFIX):
+            raise Exception(
+                'Compiled dataset %s has no record offsets index; re-run compile_dataset.py' % prefix)
+        self._record_offsets = np.load(prefix + COMPILED_RECORD_OFFSETS_SUFFIX, mmap_mode='r')
+        assert len(self._record_offsets) == self._num_examples + 1, 'Corrupted compiled dataset %s' % prefix
+        # The json records are only read and decoded when the example is read
+        with open(prefix + COMPILED_EXAMPLES_SUFFIX, 'rb') as examples_f:
+            # mmap can't map an empty file
+            self._records = mmap.mmap(examples_f.fileno(), 0, access=mmap.ACCESS_READ) if self._num_examples else b''
+        assert len(self._records) == self._record_offsets[-1], 'Corrupted compiled dataset %s' % prefix
+
+    def __len__(self):
+        return self._num_examples
+
+    def __getitem__(self, i):
+        """Returns (context_ids, query_ids, summarization_ids, oovs, context, summarization, query) for example i.
+        The id arrays are in the extended vocab."""
+        start, query_start, summarization_start, end = self._offsets[3 * i:3 * i + 4]
+        record_start, record_end = self._record_offsets[i:i + 2]
+        oovs, context, summarization, query = json.loads(self._records[record_start:record_end].decode('utf8'))
+        return (self._tokens[start:query_start], self._tokens[query_start:summarization_start],
+                self._tokens[summarization_start:end], oovs, context, summarization, query)
@@ -39,7 +39,7 @@ class BeamSearchDecoder(object):
 
         Args:
             model: a Seq2SeqAttentionModel object.
-            batcher: a Batcher object.
+            batcher: a Batcher object, or None if the batches are given to search (e.g. by the rewrite server).
             vocab: Vocabulary object
         """
         self._model = model
@@ -47,21 +47,36 @@ class BeamSearchDecoder(object):
         self._batcher = batcher
         self._vocab = vocab
         self._saver = tf.train.Saver()
-        self._sess = tf.Session(config=util.get_config())
+        self._sess = tf.Session(config=util.get_config(FLAGS.intra_op_threads, FLAGS.inter_op_threads))
+        # dialogues returned as their query by the no-rewrite gate, and how many of those have their query as reference
+        self._gate_skipped = 0
+        self._gate_correct = 0
+        # the attention distributions are only written for the visualization tool
+        self._record_attention = batcher is not None and not FLAGS.single_pass
 
         # Load an initial checkpoint to use for decoding
         ckpt_path = util.load_ckpt(self._saver, self._sess, ckpt_dir="eval")
+        self._ckpt_path = ckpt_path
 
         if FLAGS.single_pass:
             # Make a descriptive decode directory name
             # this is something of the form "ckpt-123456"
             ckpt_name = "ckpt-" + ckpt_path.split('-')[-1]
-            self._decode_dir = os.path.join(FLAGS.log_root,
-                                            get_decode_dir_name(ckpt_name))
+            self._decode_dir = FLAGS.decode_dir or os.path.join(FLAGS.log_root,
+                                                                get_decode_dir_name(ckpt_name))
+            self._result_file = os.path.join(self._decode_dir, "result.txt")
+            self._progress_file = os.path.join(self._decode_dir, "progress.json")
+            self._pending_results = []  # result lines of the batch being decoded
+            # the dataset (and shard) the progress is counted in
+            self._input_checksum = "%s:%i/%i" % (
+                data.data_checksum(FLAGS.data_path), FLAGS.decode_shard, FLAGS.num_decode_shards)
+            self._num_done = 0  # examples decoded before this run
             if os.path.exists(self._decode_dir):
-                raise Exception(
-                    "single_pass decode directory %s should not already exist"
-                    % self._decode_dir)
+                if not FLAGS.resume_decode:
+                    raise Exception(
+                        "single_pass decode directory %s should not already exist "
+                        "(set resume_decode to continue decoding into it)" % self._decode_dir)
+                self._num_done = self._resume()
 
         else:  # Generic decode dir name
             self._decode_dir = os.path.join(FLAGS.log_root, "decode")
@@ -85,15 +100,32 @@ class BeamSearchDecoder(object):
         """
         t0 = time.time()
         start_time = t0
-        counter = 0
+        counter = self._num_done if FLAGS.single_pass else 0
+        to_skip = counter  # examples decoded before resuming
         while True:
-            # 1 example repeated across batch
+            # decode_batch_dialogues examples, each repeated beam_size times across the batch
             batch = self._batcher.next_batch()
+            if batch is not None and to_skip > 0:
+                num_dialogues = len(batch.enc_batch) // FLAGS.beam_size
+                if to_skip >= num_dialogues:
+                    to_skip -= num_dialogues
+                    continue
+                batch = batch.subset(np.arange(to_skip * FLAGS.beam_size, num_dialogues * FLAGS.beam_size))
+                to_skip = 0
             if batch is None:  # finished decoding dataset in single_pass mode
                 assert FLAGS.single_pass, "Dataset exhausted, but we are not in single_pass mode"
                 tf.logging.info(
                     "Decoder has finished reading dataset for single_pass, using %d seconds.",
                     time.time() - start_time)
+                if FLAGS.no_rewrite_gate:
+                    tf.logging.info(
+                        "No-rewrite gate skipped %i of %i dialogues, precision %.3f",
+                        self._gate_skipped, counter, self._gate_correct / max(self._gate_skipped, 1))
+                encoder_cache = self._model.encoder_cache
+                if encoder_cache is not None:
+                    tf.logging.info("Encoder cache: %i hits, %i misses, %i contexts in %.1f MB",
+                                    encoder_cache.hits, encoder_cache.misses, len(encoder_cache),
+                                    encoder_cache.num_bytes / 1024 / 1024)
                 tf.logging.info(
                     "Output has been saved in %s and %s. Now starting ROUGE eval...",
                     self._rouge_ref_dir, self._rouge_dec_dir)
@@ -103,62 +135,85 @@ class BeamSearchDecoder(object):
                 # rouge_log(results_dict, self._decode_dir)
                 return
 
-            original_context = batch.original_contexts[0]  # string
-            original_query = batch.original_querys[0]
-            original_summarization = batch.original_summarizations[0]  # string
-            # original_abstract_sents = batch.original_abstracts_sents[
-            #    0]  # list of strings
-
-            context_withunks = data.show_art_oovs(original_context, self._vocab)
-            abstract_withunks = data.show_abs_oovs(
-                original_summarization, self._vocab,
-                (batch.art_oovs[0] if FLAGS.pointer_gen else None))  # string
-
-            # Run beam search to get best Hypothesis
-            best_hyp = beam_search.run_beam_search(self._sess, self._model,
-                                                   self._vocab, batch)
-
-            #  export_path = os.path.join(FLAGS.export_dir,str(FLAGS.export_version))
-            # Extract the output ids from the hypothesis and convert back to words
-            output_ids = [int(t) for t in best_hyp.tokens[1:]]
-            decoded_words = data.outputids2words(
-                output_ids, self._vocab, (batch.art_oovs[0]
-                                          if FLAGS.pointer_gen else None))
-
-            # Remove the [STOP] token from decoded_words, if necessary
-            try:
-                # index of the (first) [STOP] symbol
-                fst_stop_idx = decoded_words.index(data.MARK_EOS)
-                decoded_words = decoded_words[:fst_stop_idx]
-            except ValueError:
-                decoded_words = decoded_words
-            decoded_output = ''.join(decoded_words)  # single string
+            # Get the best Hypothesis of each dialogue in the batch
+            best_hyps = self.search(batch)
+
+            for d, best_hyp in enumerate(best_hyps):
+                row = d * FLAGS.beam_size  # the first row of dialogue d
+                original_context = batch.original_contexts[row]  # string
+                original_query = batch.original_querys[row]
+                original_summarization = batch.original_summarizations[row]  # string
+                # original_abstract_sents = batch.original_abstracts_sents[
+                #    0]  # list of strings
+
+                context_withunks = data.show_art_oovs(original_context, self._vocab)
+                abstract_withunks = data.show_abs_oovs(
+                    original_summarization, self._vocab,
+                    (batch.art_oovs[row] if FLAGS.pointer_gen else None))  # string
+
+                #  export_path = os.path.join(FLAGS.export_dir,str(FLAGS.export_version))
+                decoded_words = beam_search.hypothesis_words(best_hyp, self._vocab, batch, row)
+                decoded_output = ''.join(decoded_words)  # single string
+
+                if FLAGS.single_pass:
+                    # todo: need to check
+                    # write ref summary and decoded summary to file, to eval with pyrouge later
+                    self.write_result(original_context, original_summarization,
+                                      decoded_words, counter)
+                    # self.write_for_eval(original_summarization, output_ids,
+                    #                     counter)
+                    counter += 1  # this is how many examples we've decoded
+                else:
+                    # log output to screen
+                    print_results(context_withunks, abstract_withunks,
+                                  decoded_output)
+                    # write info to .json file for visualization tool
+                    self.write_for_attnvis(context_withunks, abstract_withunks,
+                                           decoded_words, best_hyp.attn_dists)
+
+                    # Check if SECS_UNTIL_NEW_CKPT has elapsed;
+                    # if so return so we can load a new checkpoint
+                    t1 = time.time()
+                    if t1 - t0 > SECS_UNTIL_NEW_CKPT:
+                        tf.logging.info(
+                            'We\'ve been decoding with same checkpoint for %i seconds. Time to load new checkpoint',
+                            t1 - t0)
+                        self._ckpt_path = util.load_ckpt(self._saver, self._sess)
+                        t0 = time.time()
 
             if FLAGS.single_pass:
-                # todo: need to check
-                # write ref summary and decoded summary to file, to eval with pyrouge later
-                self.write_result(original_context, original_summarization,
-                                  decoded_words, counter)
-                # self.write_for_eval(original_summarization, output_ids,
-                #                     counter)
-                counter += 1  # this is how many examples we've decoded
-            else:
-                # log output to screen
-                print_results(context_withunks, abstract_withunks,
-                              decoded_output)
-                # write info to .json file for visualization tool
-                self.write_for_attnvis(context_withunks, abstract_withunks,
-                                       decoded_words, best_hyp.attn_dists)
-
-                # Check if SECS_UNTIL_NEW_CKPT has elapsed;
-                # if so return so we can load a new checkpoint
-                t1 = time.time()
-                if t1 - t0 > SECS_UNTIL_NEW_CKPT:
-                    tf.logging.info(
-                        'We\'ve been decoding with same checkpoint for %i seconds. Time to load new checkpoint',
-                        t1 - t0)
-                    _ = util.load_ckpt(self._saver, self._sess)
-                    t0 = time.time()
+                self._commit_results(counter)
+
+    @property
+    def ckpt_path(self):
+        """The path of the checkpoint loaded for decoding."""
+        return self._ckpt_path
+
+    def search(self, batch, strategy=None, max_steps=None, time_budget=None):
+        """Decode a batch with the given strategy, see beam_search.decode_dialogues.
+        With the no-rewrite gate, counts the dialogues the gate returned as their query.
+
+        Args:
+            batch: Batch object holding each dialogue repeated beam_size times across the batch
+            strategy: One of beam/greedy/sample/adaptive, or None for FLAGS.decode_strategy.
+            max_steps: For the adaptive strategy, the maximum number of decoder steps, or None for max_dec_steps.
+            time_budget: For the adaptive strategy, seconds after which decoding stops,
+                or None for FLAGS.decode_time_budget.
+
+        Returns:
+            best_hyps: list of Hypothesis objects; the best hypothesis of each dialogue.
+        """
+        if strategy is None:
+            strategy = FLAGS.decode_strategy
+        best_hyps, no_rewrite = beam_search.decode_dialogues(
+            self._sess, self._model, self._vocab, batch, strategy, max_steps=max_steps,
+            time_budget=time_budget, record_attention=self._record_attention)
+        if no_rewrite is not None:
+            for d in np.nonzero(no_rewrite)[0]:
+                row = d * FLAGS.beam_size
+                self._gate_skipped += 1
+                self._gate_correct += int(batch.original_summarizations[row] == batch.original_querys[row])
+        return best_hyps
 
     def write_for_eval(self, reference_summarization, decoded_words, ex_index):
         """
@@ -192,7 +247,7 @@ class BeamSearchDecoder(object):
     def write_result(self, original_context, reference_summarization,
                      decoded_words, ex_index):
         """
-        Write output to file.
+        Add the result of an example to the results of the batch, which _commit_results writes to file.
 
         Args:
             reference_sents: list of strings
@@ -200,20 +255,65 @@ class BeamSearchDecoder(object):
             ex_index: int, the index with which to label the files
         """
         summarization = ''.join(decoded_words)
-
-        # Write to file
-        result_file = os.path.join(self._decode_dir, "result.txt")
-
-        with open(result_file, 'a', encoding="utf8") as f:
-            f.write(
-                original_context + '\t\t' +
-                reference_summarization + '\t\t' +
-                summarization + "\n")
-            f.flush()
+        self._pending_results.append(
+            original_context + '\t\t' +
+            reference_summarization + '\t\t' +
+            summarization + "\n")
 
         if ex_index % 10 == 0:
             tf.logging.info("Wrote example %i to file" % ex_index)
 
+    def _commit_results(self, num_done):
+        """Append the results of the decoded batch to result.txt, then record the progress in progress.json:
+        the number of examples decoded, the size of result.txt, the checksum of the input and the gate counts.
+        The results are synced to disk before the progress file is replaced, so the progress never counts
+        results that weren't written, and resuming truncates result.txt to the results it counts."""
+        with open(self._result_file, 'a', encoding="utf8") as f:
+            f.write(''.join(self._pending_results))
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending_results = []
+        progress = {
+            'num_done': num_done,
+            'result_bytes': os.path.getsize(self._result_file),
+            'input_checksum': self._input_checksum,
+            'ckpt_path': self._ckpt_path,
+            'gate_skipped': self._gate_skipped,
+            'gate_correct': self._gate_correct,
+        }
+        tmp_file = self._progress_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(progress, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._progress_file)
+
+    def _resume(self):
+        """Check that the existing decode dir was decoding the same input with the same checkpoint,
+        drop the results written after its last recorded progress, restore the no-rewrite gate counts
+        and return the number of examples decoded."""
+        if os.path.exists(self._progress_file):
+            with open(self._progress_file) as f:
+                progress = json.load(f)
+        else:  # stopped before the first batch was written
+            progress = {'num_done': 0, 'result_bytes': 0, 'input_checksum': self._input_checksum,
+                        'ckpt_path': self._ckpt_path, 'gate_skipped': 0, 'gate_correct': 0}
+        if progress['input_checksum'] != self._input_checksum:
+            raise Exception("Can't resume decoding into %s: the input data or shard has changed" % self._decode_dir)
+        if progress['ckpt_path'] != self._ckpt_path:
+            raise Exception("Can't resume decoding into %s: it was decoded with checkpoint %s, not %s" % (
+                self._decode_dir, progress['ckpt_path'], self._ckpt_path))
+        if os.path.exists(self._result_file):
+            with open(self._result_file, 'r+b') as f:
+                f.truncate(progress['result_bytes'])
+        elif progress['result_bytes'] > 0:
+            raise Exception("Can't resume decoding into %s: result.txt is missing" % self._decode_dir)
+        # the gate counts are logged at the end against all the examples, including those decoded before resuming
+        self._gate_skipped = progress['gate_skipped']
+        self._gate_correct = progress['gate_correct']
+        tf.logging.info("Resuming decoding into %s after %i examples", self._decode_dir, progress['num_done'])
+        return progress['num_done']
+
     def write_for_rouge(self, reference_summarization, decoded_words,
                         ex_index):
         """
@@ -257,7 +357,7 @@ class BeamSearchDecoder(object):
             'origin_context': make_html_safe(article),
             'decoded_sum': make_html_safe(''.join(decoded_words)),
             'summarization': make_html_safe(abstract),
-            'attn_dists': attn_dists
+            'attn_dists': [attn_dist.tolist() for attn_dist in attn_dists]
         }
         output_fname = os.path.join(self._decode_dir, 'attn_vis_data.json')
         with open(output_fname, 'w') as output_file:
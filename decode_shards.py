@@ -0,0 +1,130 @@
+"""
+Desc: single_pass decoding of a dataset in several processes, merged into one result.txt in the dataset order.
+The examples are dealt to num_shards decode workers in turn (example i goes to shard i modulo num_shards);
+each worker runs run_summarization.py in single_pass decode mode with its own session, limited to
+threads_per_shard intra-op threads so that the workers share the cores instead of competing for them.
+Run like this, with the flags of a single_pass decode after the number of shards and the output directory:
+  python decode_shards.py 8 log/extractive/decode_test_8shards --data_path=data/test.txt --vocab_path=data/vocab.txt \\
+    --log_root=./log --exp_name=extractive --vocab_size=4000 --max_dec_steps=30
+which writes the worker results and logs under the output directory, and the merged results in <out_dir>/result.txt.
+Pass --intra_op_threads to override the default of (number of cores) / num_shards threads per worker.
+With --resume_decode=1, an existing output directory is continued: each worker resumes its shard.
+The flags --mode, --single_pass, --decode_shard, --num_decode_shards and --decode_dir are set for each worker
+and can't be passed.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+RUN_SUMMARIZATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_summarization.py')
+# The run_summarization flags that decode_shards.py sets for each worker
+SHARD_FLAGS = ['mode', 'single_pass', 'decode_shard', 'num_decode_shards', 'decode_dir']
+
+
+def flag_name(flag):
+    """The name of the flag set by a command line argument such as --name=value or --noname, or None for a value."""
+    if not flag.startswith('-'):
+        return None
+    return flag.lstrip('-').split('=', 1)[0]
+
+
+def check_flags(flags):
+    """Raise if the run_summarization flags set one of the SHARD_FLAGS, which would override the per-shard values."""
+    for flag in flags:
+        name = flag_name(flag)
+        if name in SHARD_FLAGS or (name is not None and name.startswith('no') and name[2:] in SHARD_FLAGS):
+            raise Exception("%s is set by decode_shards.py for each worker and can't be passed" % flag)
+
+
+def shard_command(shard, num_shards, out_dir, threads_per_shard, flags):
+    """The command line of the decode worker of a shard."""
+    command = [sys.executable, RUN_SUMMARIZATION, '--mode=decode', '--single_pass=1',
+               '--decode_shard=%i' % shard, '--num_decode_shards=%i' % num_shards,
+               '--decode_dir=%s' % os.path.join(out_dir, 'shard_%i' % shard)]
+    if not any(flag_name(flag) == 'intra_op_threads' for flag in flags):
+        command += ['--intra_op_threads=%i' % threads_per_shard, '--inter_op_threads=1']
+    return command + flags
+
+
+def run_shards(num_shards, out_dir, flags):
+    """Run the decode workers of all the shards and wait for them. Raises if one fails, after stopping the others."""
+    threads_per_shard = max(1, multiprocessing.cpu_count() // num_shards)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads_per_shard))
+    workers = []
+    for shard in range(num_shards):
+        log_file = open(os.path.join(out_dir, 'shard_%i.log' % shard), 'a')
+        workers.append((subprocess.Popen(shard_command(shard, num_shards, out_dir, threads_per_shard, flags),
+                                         stdout=log_file, stderr=subprocess.STDOUT, env=env), log_file))
+    try:
+        running = list(range(num_shards))
+        while running:
+            time.sleep(1)
+            for shard in list(running):
+                exit_code = workers[shard][0].poll()
+                if exit_code is None:
+                    continue
+                if exit_code != 0:
+                    raise Exception("Decode worker %i failed with exit code %i, see %s" % (
+                        shard, exit_code, os.path.join(out_dir, 'shard_%i.log' % shard)))
+                running.remove(shard)
+    finally:
+        for worker, log_file in workers:
+            if worker.poll() is None:
+                worker.terminate()
+                worker.wait()
+            log_file.close()
+
+
+def resume_flag(flags):
+    """Whether the resume_decode flag is set in the run_summarization flags (the last setting wins, as with the flags)."""
+    resume = False
+    for flag in flags:
+        name = flag_name(flag)
+        if name == 'noresume_decode':
+            resume = False
+        elif name == 'resume_decode':
+            resume = '=' not in flag or flag.split('=', 1)[1].lower() in ['1', 'true', 't', 'yes', 'y']
+    return resume
+
+
+def merge_results(num_shards, out_dir):
+    """Interleave the result.txt of the shards back into the dataset order, into <out_dir>/result.txt.
+    Returns the number of results."""
+    shard_results = []
+    for shard in range(num_shards):
+        # a shard without examples writes no result file
+        result_file = os.path.join(out_dir, 'shard_%i' % shard, 'result.txt')
+        if not os.path.exists(result_file):
+            shard_results.append([])
+            continue
+        with open(result_file, encoding='utf8') as f:
+            shard_results.append(f.readlines())
+    # shard i holds the examples i, i + num_shards, ..., so the shards are at most one result apart
+    counts = [len(results) for results in shard_results]
+    if any(counts[i] < counts[i + 1] for i in range(num_shards - 1)) or counts[0] - counts[-1] > 1:
+        raise Exception("The shards have inconsistent numbers of results: %s" % counts)
+    with open(os.path.join(out_dir, 'result.txt'), 'w', encoding='utf8') as f:
+        for i in range(counts[0]):
+            for results in shard_results:
+                if i < len(results):
+                    f.write(results[i])
+    return sum(counts)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        raise Exception("Usage: python decode_shards.py <num_shards> <out_dir> <run_summarization flags>")
+    num_shards = int(sys.argv[1])
+    out_dir = sys.argv[2]
+    check_flags(sys.argv[3:])
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    elif not resume_flag(sys.argv[3:]):
+        raise Exception("Output directory %s should not already exist (set --resume_decode=1 to continue it)" % out_dir)
+    start_time = time.time()
+    run_shards(num_shards, out_dir, sys.argv[3:])
+    num_results = merge_results(num_shards, out_dir)
+    print("Decoded %i examples in %i shards in %.1f seconds. Results in %s" % (
+        num_results, num_shards, time.time() - start_time, os.path.join(out_dir, 'result.txt')))
@@ -0,0 +1,62 @@
+"""
+Desc: a bounded LRU cache of the context encoder outputs, for decoding.
+In multi-turn traffic the same context comes back for retries and for several candidate queries,
+so SummarizationModel.encode keeps the encoder states, attention keys and final state of each context
+and on a hit only runs the query encoder.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def context_key(context_ids):
+    """The cache key of a context; a hash of its token ids (1D integer array, without padding)."""
+    return hashlib.sha1(np.asarray(context_ids, dtype=np.int32).tobytes()).digest()
+
+
+class EncoderCache(object):
+    """LRU cache mapping a context key to its encoder outputs, a tuple of numpy arrays:
+    enc_states [enc_len, 2*hidden_dim], enc_keys [enc_len, attn_size], state_c [hidden_dim] and state_h [hidden_dim].
+    The least recently used entries are evicted once the arrays take more than max_bytes."""
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the encoder outputs of the context key, or None on a miss."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store the encoder outputs of the context key, evicting the least recently used entries to make room."""
+        size = sum(array.nbytes for array in value)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= sum(array.nbytes for array in self._entries.pop(key))
+            self._entries[key] = value
+            self._num_bytes += size
+            while self._num_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= sum(array.nbytes for array in evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def num_bytes(self):
+        return self._num_bytes
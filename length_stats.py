@@ -0,0 +1,22 @@
+"""
+Desc: this script prints how many more tokens the rewrites have than their queries in a data file,
+to choose the dec_steps_slack flag: in decode mode, each dialogue is decoded for at most
+its query length (including the [STOP] token) plus dec_steps_slack steps.
+Run like this:
+  python length_stats.py data/train.txt 99
+and then decode with --dec_steps_slack=<the printed slack>, which covers 99% of the training rewrites.
+"""
+import sys
+import numpy as np
+from data import rewrite_length_excess
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        raise Exception("Usage: python length_stats.py <data_path> [<percentile>]")
+    data_path = sys.argv[1]
+    percentile = float(sys.argv[2]) if len(sys.argv) == 3 else 99.0
+    excess = np.array(rewrite_length_excess(data_path))
+    print("%i examples. Rewrite tokens minus query tokens: mean %.2f, max %i" % (len(excess), excess.mean(), excess.max()))
+    for p in [50, 90, 95, 99, 100]:
+        print("  %3i%%: %i" % (p, np.percentile(excess, p)))
+    print("dec_steps_slack for %g%% of the rewrites: %i" % (percentile, max(0, int(np.ceil(np.percentile(excess, percentile))))))
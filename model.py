@@ -6,7 +6,9 @@ import os
 import time
 import numpy as np
 import tensorflow as tf
-from attention_decoder import attention_decoder
+import data
+from attention_decoder import attention_decoder, dynamic_attention_decoder, decoder_attention_keys
+from encoder_cache import EncoderCache, context_key
 from tensorflow.contrib.tensorboard.plugins import projector
 
 FLAGS = tf.app.flags.FLAGS
@@ -18,9 +20,38 @@ class SummarizationModel(object):
     Supports both baseline mode, pointer-generator mode, and coverage
     """
 
-    def __init__(self, hps, vocab):
+    def __init__(self, hps, vocab, input_dataset=None):
+        """
+        Args:
+            hps: hyperparameters
+            vocab: Vocabulary object
+            input_dataset: Optional tf.data.Dataset of dicts of batch arrays (see batcher.batch_dataset).
+                If given, the inputs are read from it inside the graph and don't need to be fed.
+        """
         self._hps = hps
         self._vocab = vocab
+        self._input_dataset = input_dataset
+        # In decode mode, the context encoder outputs of recent contexts (see encode)
+        self._encoder_cache = None
+        if hps.mode.value == 'decode' and hps.encoder_cache_mb.value > 0:
+            self._encoder_cache = EncoderCache(int(hps.encoder_cache_mb.value * 1024 * 1024))
+
+    @property
+    def hps(self):
+        """The hyperparameters of the model, also read by the decoding functions of beam_search."""
+        return self._hps
+
+    @property
+    def encoder_cache(self):
+        """The EncoderCache of the context encoder outputs, or None if it is disabled."""
+        return self._encoder_cache
+
+    def _add_input(self, name, dtype, shape):
+        """Add a placeholder for the input name.
+        With an input dataset, the placeholder defaults to the dataset's next element, so it only needs to be fed to override it."""
+        if self._input_dataset is None:
+            return tf.placeholder(dtype, shape, name=name)
+        return tf.placeholder_with_default(self._next_inputs[name], shape, name=name)
 
     def _add_placeholders(self):
         """
@@ -28,56 +59,67 @@ class SummarizationModel(object):
         These are entry points for any input data.
         """
         hps = self._hps
+        # With a token budget, the number of examples in a batch varies.
+        # In decode mode, the last batch of a dataset can hold less dialogues than the others
+        if hps.max_batch_tokens.value > 0 or hps.mode.value == 'decode':
+            batch_size = None
+        else:
+            batch_size = hps.batch_size.value
+
+        if self._input_dataset is not None:
+            self._next_inputs = self._input_dataset.make_one_shot_iterator().get_next()
 
         # encoder part
-        self._enc_batch = tf.placeholder(
-            tf.int32, [hps.batch_size.value, None], name='enc_batch')
-        self._enc_lens = tf.placeholder(
-            tf.int32, [hps.batch_size.value], name='enc_lens')
-        self._enc_padding_mask = tf.placeholder(
-            tf.float32, [hps.batch_size.value, None], name='enc_padding_mask')
+        self._enc_batch = self._add_input(
+            'enc_batch', tf.int32, [batch_size, None])
+        self._enc_lens = self._add_input(
+            'enc_lens', tf.int32, [batch_size])
+        self._enc_padding_mask = self._add_input(
+            'enc_padding_mask', tf.float32, [batch_size, None])
 
         # query part
-        self._query_batch = tf.placeholder(
-            tf.int32, [hps.batch_size.value, None], name='query_batch')
-        self._query_lens = tf.placeholder(
-            tf.int32, [hps.batch_size.value], name='query_lens')
-        self._query_padding_mask = tf.placeholder(
-            tf.float32, [hps.batch_size.value, None], name='query_padding_mask')
+        self._query_batch = self._add_input(
+            'query_batch', tf.int32, [batch_size, None])
+        self._query_lens = self._add_input(
+            'query_lens', tf.int32, [batch_size])
+        self._query_padding_mask = self._add_input(
+            'query_padding_mask', tf.float32, [batch_size, None])
         
-        if FLAGS.pointer_gen:
-            self._enc_batch_extend_vocab = tf.placeholder(
-                tf.int32, [hps.batch_size.value, None],
-                name='enc_batch_extend_vocab')
-            self._max_art_oovs = tf.placeholder(
-                tf.int32, [], name='max_art_oovs')
-            self._query_batch_extend_vocab = tf.placeholder(
-                tf.int32, [hps.batch_size.value, None],
-                name='query_batch_extend_vocab')
-
-        # decoder part
-        self._dec_batch = tf.placeholder(
-            tf.int32, [hps.batch_size.value, hps.max_dec_steps.value], name='dec_batch')
-        self._target_batch = tf.placeholder(
-            tf.int32, [hps.batch_size.value, hps.max_dec_steps.value], name='target_batch')
-        self._dec_padding_mask = tf.placeholder(
-            tf.float32, [hps.batch_size.value, hps.max_dec_steps.value],
-            name='dec_padding_mask')
+        if hps.pointer_gen.value:
+            self._enc_batch_extend_vocab = self._add_input(
+                'enc_batch_extend_vocab', tf.int32, [batch_size, None])
+            self._max_art_oovs = self._add_input(
+                'max_art_oovs', tf.int32, [])
+            self._query_batch_extend_vocab = self._add_input(
+                'query_batch_extend_vocab', tf.int32, [batch_size, None])
+
+        # decoder part; in decode mode the decoder runs one step at a time
+        dec_steps = 1 if hps.mode.value == 'decode' else hps.max_dec_steps.value
+        self._dec_batch = self._add_input(
+            'dec_batch', tf.int32, [batch_size, dec_steps])
+        self._target_batch = self._add_input(
+            'target_batch', tf.int32, [batch_size, dec_steps])
+        self._dec_padding_mask = self._add_input(
+            'dec_padding_mask', tf.float32, [batch_size, dec_steps])
+        self._no_rewrite = self._add_input(
+            'no_rewrite', tf.float32, [batch_size])
 
         if hps.mode.value == "decode" and hps.coverage.value:
             self.prev_t_coverage = tf.placeholder(
-                tf.float32, [hps.batch_size.value, None], name='prev_t_coverage')
+                tf.float32, [batch_size, None], name='prev_t_coverage')
             self.prev_b_coverage = tf.placeholder(
-                tf.float32, [hps.batch_size.value, None], name='prev_b_coverage')
+                tf.float32, [batch_size, None], name='prev_b_coverage')
 
     def _make_feed_dict(self, batch, just_enc=False):
         """Make a feed dictionary mapping parts of the batch to the appropriate placeholders.
 
         Args:
-            batch: Batch object
+            batch: Batch object, or None to read the inputs from the input dataset (nothing is fed)
             just_enc: Boolean. If True(decode mode), only feed the parts needed for the encoder.
         """
         feed_dict = {}
+        if batch is None:
+            return feed_dict
         feed_dict[self._enc_batch] = batch.enc_batch
         feed_dict[self._enc_lens] = batch.enc_lens
         feed_dict[self._enc_padding_mask] = batch.enc_padding_mask
@@ -86,14 +128,16 @@ class SummarizationModel(object):
         feed_dict[self._query_lens] = batch.query_lens
         feed_dict[self._query_padding_mask] = batch.query_padding_mask
 
-        feed_dict[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
-        feed_dict[self._query_batch_extend_vocab] = batch.query_batch_extend_vocab
-        feed_dict[self._max_art_oovs] = batch.max_art_oovs
+        if self._hps.pointer_gen.value:
+            feed_dict[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
+            feed_dict[self._query_batch_extend_vocab] = batch.query_batch_extend_vocab
+            feed_dict[self._max_art_oovs] = batch.max_art_oovs
 
         if not just_enc:
             feed_dict[self._dec_batch] = batch.dec_batch
             feed_dict[self._target_batch] = batch.target_batch
             feed_dict[self._dec_padding_mask] = batch.dec_padding_mask
+            feed_dict[self._no_rewrite] = batch.no_rewrite
         return feed_dict
 
     def _add_encoder(self, encoder_inputs, seq_len, name=None, reuse=False):
@@ -196,7 +240,28 @@ class SummarizationModel(object):
             return tf.contrib.rnn.LSTMStateTuple(
                 new_c, new_h)  # Return new cell and state
 
-    def _add_decoder(self, inputs):
+    def _add_no_rewrite_gate(self):
+        """Add to the graph a logistic classifier on the query representation and the decoder initial state,
+        which predicts whether the rewrite is the query itself, so that decoding can be skipped.
+        It doesn't backpropagate into the encoder, so it doesn't change the rewriting model.
+        Sets self._no_rewrite_logits and self._no_rewrite_prob, shape (batch_size).
+        """
+        hidden_dim = self._hps.hidden_dim.value
+        with tf.variable_scope('no_rewrite_gate'):
+            features = tf.stop_gradient(tf.concat(axis=1, values=[
+                self._query_rep.c, self._query_rep.h, self._dec_in_state.c, self._dec_in_state.h]))
+            w_gate = tf.get_variable(
+                'w_gate', [hidden_dim * 4, 1],
+                dtype=tf.float32,
+                initializer=self.trunc_norm_init)
+            bias_gate = tf.get_variable(
+                'bias_gate', [1],
+                dtype=tf.float32,
+                initializer=self.trunc_norm_init)
+            self._no_rewrite_logits = tf.squeeze(tf.matmul(features, w_gate) + bias_gate, axis=1)
+            self._no_rewrite_prob = tf.sigmoid(self._no_rewrite_logits)
+
+    def _add_decoder(self, inputs, dec_in_state=None, prev_t_coverage=None, prev_b_coverage=None):
         """
         Add attention decoder to the graph. 
         In train or eval mode, you call this once to get output on ALL steps.
@@ -204,12 +269,17 @@ class SummarizationModel(object):
 
         Args:
             inputs: inputs to the decoder (word embeddings). 
-            A list of tensors shape (batch_size, emb_dim)
+            A list of tensors shape (batch_size, emb_dim),
+            or with the dynamic decoder a tensor shape (batch_size, max_dec_steps, emb_dim)
+            dec_in_state: Optional. The initial decoder state, by default self._dec_in_state.
+            prev_t_coverage, prev_b_coverage: Optional. In decode mode with coverage, the previous step's coverage vectors,
+            by default the prev_t_coverage and prev_b_coverage placeholders.
 
         Returns:
             outputs: List of tensors; the outputs of the decoder
             out_state: The final state of the decoder
-            attn_dists: A list of tensors; the attention distributions
+            attn_dists: A list of tensors; the attention distributions.
+            With the dynamic decoder, outputs and attn_dists are tensors stacked on the first axis.
             coverage: A tensor, the current coverage vector
         """
         hps = self._hps
@@ -222,19 +292,37 @@ class SummarizationModel(object):
             output_keep_prob=1.0,
             state_keep_prob=1.0)
 
+        if dec_in_state is None:
+            dec_in_state = self._dec_in_state
+
         # In decode mode, we run attention_decoder one step at a time
         # and so need to pass in the previous step's coverage vector each time
         if hps.mode.value == "decode" and hps.coverage.value:
-            prev_t_coverage = self.prev_t_coverage
-            prev_b_coverage = self.prev_b_coverage 
+            if prev_t_coverage is None:
+                prev_t_coverage = self.prev_t_coverage
+                prev_b_coverage = self.prev_b_coverage 
         else:
             prev_t_coverage = None
             prev_b_coverage = None
 
+        if self._dynamic_decoder:
+            return dynamic_attention_decoder(
+                inputs,
+                self._num_dec_steps,
+                dec_in_state,
+                self._enc_states,
+                self._enc_padding_mask,
+                self._query_states,
+                self._query_padding_mask,
+                cell,
+                use_coverage=hps.coverage.value,
+                t_keys=self._enc_keys,
+                b_keys=self._query_keys)
+
         #todo: 添加 query， 
         outputs, out_state, context_attn_dists, query_attn_dists, p_ts, p_bs, t_coverage, b_coverage = attention_decoder(
             inputs,
-            self._dec_in_state,
+            dec_in_state,
             self._enc_states,
             self._enc_padding_mask,
             #self._query_rep,
@@ -245,10 +333,34 @@ class SummarizationModel(object):
             pointer_gen=hps.pointer_gen.value,
             use_coverage=hps.coverage.value,
             prev_t_coverage=prev_t_coverage,
-            prev_b_coverage=prev_b_coverage)
+            prev_b_coverage=prev_b_coverage,
+            t_keys=self._enc_keys,
+            b_keys=self._query_keys)
 
         return outputs, out_state, context_attn_dists, query_attn_dists, p_ts, p_bs, t_coverage, b_coverage
 
+    def _add_scatter_indices(self):
+        """Add the indices that _calc_final_dist scatters the context and query attention distributions to:
+        the (batch number, extended vocab id) of every source position.
+        They don't change between decoder steps, so in decode mode run_encoder computes them once
+        and decode_onestep feeds them back."""
+        with tf.variable_scope('final_distribution'):
+            batch_size = tf.shape(self._enc_states)[0]
+            batch_nums = tf.range(0, limit=batch_size)
+            batch_nums = tf.expand_dims(batch_nums, 1)  # shape (batch_size, 1)
+            # number of states we attend over
+            context_attn_len = tf.shape(self._enc_batch_extend_vocab)[1]
+            # shape (batch_size, attn_len)
+            context_batch_nums = tf.tile(batch_nums, [1, context_attn_len])
+            # shape (batch_size, enc_t, 2)
+            self._context_indices = tf.stack((context_batch_nums, self._enc_batch_extend_vocab), axis=2)
+
+            query_attn_len = tf.shape(self._query_batch_extend_vocab)[1]
+            # shape (batch_size, attn_len)
+            query_batch_nums = tf.tile(batch_nums, [1, query_attn_len])
+            # shape (batch_size, enc_t, 2)
+            self._query_indices = tf.stack((query_batch_nums, self._query_batch_extend_vocab), axis=2)
+
     def _calc_final_dist(self, context_attn_dists, query_attn_dists):
         """Calculate the final distribution, for the pointer-generator model
 
@@ -290,28 +402,34 @@ class SummarizationModel(object):
             # This is done for each decoder timestep.
             # This is fiddly; we use tf.scatter_nd to do the projection
 
-            # shape (batch_size)
-            batch_nums = tf.range(0, limit=self._hps.batch_size.value)
-            batch_nums = tf.expand_dims(batch_nums, 1)  # shape (batch_size, 1)
-            # number of states we attend over
-            context_attn_len = tf.shape(self._enc_batch_extend_vocab)[1]
-            # shape (batch_size, attn_len)
-            context_batch_nums = tf.tile(batch_nums, [1, context_attn_len])
-            # shape (batch_size, enc_t, 2)
-            context_indices = tf.stack((context_batch_nums, self._enc_batch_extend_vocab), axis=2)
-            shape = [self._hps.batch_size.value, extended_vsize]
+            # shape (batch_size). The batch size is dynamic with a token budget
+            batch_size = tf.shape(self._enc_states)[0]
+            # shape (batch_size, enc_t, 2) and (batch_size, query_t, 2), see _add_scatter_indices
+            context_indices = self._context_indices
+            query_indices = self._query_indices
+
+            if self._dynamic_decoder:
+                # the attention distributions are stacked, shape (num_steps, batch_size, attn_len).
+                # Project all the steps with one scatter, indexed by (step, batch, id)
+                num_steps = tf.shape(context_attn_dists)[0]
+                step_nums = tf.reshape(tf.range(0, limit=num_steps), [-1, 1, 1, 1])  # shape (num_steps, 1, 1, 1)
+
+                def project(attn_dists, indices):
+                    # shape (num_steps, batch_size, attn_len, 3)
+                    step_indices = tf.concat(
+                        (tf.tile(step_nums, [1, batch_size, tf.shape(indices)[1], 1]),
+                         tf.tile(tf.expand_dims(indices, 0), [num_steps, 1, 1, 1])), axis=3)
+                    return tf.scatter_nd(step_indices, attn_dists, [num_steps, batch_size, extended_vsize])
+
+                # shape (num_steps, batch_size, extended_vsize)
+                return project(context_attn_dists, context_indices) + project(query_attn_dists, query_indices)
+
+            shape = [batch_size, extended_vsize]
             # list length max_dec_steps (batch_size, extended_vsize)
             context_attn_dists_projected = [
                 tf.scatter_nd(context_indices, copy_dist, shape)
                 for copy_dist in context_attn_dists
             ]
-
-            query_attn_len = tf.shape(self._query_batch_extend_vocab)[1]
-            # shape (batch_size, attn_len)
-            query_batch_nums = tf.tile(batch_nums, [1, query_attn_len])
-            # shape (batch_size, enc_t, 2)
-            query_indices = tf.stack((query_batch_nums, self._query_batch_extend_vocab), axis=2)
-
             query_attn_dists_projected = [
                 tf.scatter_nd(query_indices, copy_dist, shape)
                 for copy_dist in query_attn_dists
@@ -325,6 +443,82 @@ class SummarizationModel(object):
 
             return final_dists
 
+    def _top_k(self, context_attn_dist, query_attn_dist, k):
+        """The k most likely tokens after one decoder step.
+
+        Args:
+            context_attn_dist: shape (batch_size, attn_len)
+            query_attn_dist: shape (batch_size, query_len)
+            k: number of tokens to return
+
+        Returns:
+            topk_probs, topk_ids: shape (batch_size, k)
+        """
+        if self._hps.copy_source_space.value:
+            return self._source_top_k(context_attn_dist, query_attn_dist, k)
+        # shape (batch_size, extended_vsize)
+        final_dist = self._calc_final_dist([context_attn_dist], [query_attn_dist])[0]
+        return tf.nn.top_k(final_dist, k)
+
+    def _source_probs(self, context_attn_dist, query_attn_dist, targets):
+        """Probability of the target words, without projecting onto the extended vocabulary:
+        the sum of the attention over the source positions holding the target word.
+        Gives the same probabilities as picking the target words out of _calc_final_dist.
+
+        Args:
+            context_attn_dist: shape (batch_size, attn_len), or stacked (num_steps, batch_size, attn_len)
+            query_attn_dist: shape (batch_size, query_len), or stacked (num_steps, batch_size, query_len)
+            targets: The ids of the target words, shape (batch_size) or (num_steps, batch_size)
+
+        Returns:
+            Tensor shaped like targets
+        """
+        with tf.variable_scope('source_probs'):
+            targets = tf.expand_dims(targets, -1)
+            context_match = tf.to_float(tf.equal(self._enc_batch_extend_vocab, targets))
+            query_match = tf.to_float(tf.equal(self._query_batch_extend_vocab, targets))
+            return tf.reduce_sum(context_attn_dist * context_match, -1) + \
+                tf.reduce_sum(query_attn_dist * query_match, -1)
+
+    def _source_top_k(self, context_attn_dist, query_attn_dist, k):
+        """Like tf.nn.top_k on the final distribution of one decoder step, but over the distinct tokens of the source
+        (context and query) instead of the extended vocabulary.
+        If the source has less than k distinct tokens, the rest are [UNK] with probability 0.
+
+        Args:
+            context_attn_dist: shape (batch_size, attn_len)
+            query_attn_dist: shape (batch_size, query_len)
+            k: number of tokens to return
+
+        Returns:
+            topk_probs, topk_ids: shape (batch_size, k)
+        """
+        with tf.variable_scope('source_top_k'):
+            # shape (batch_size, attn_len + query_len)
+            ids = tf.concat(axis=1, values=[self._enc_batch_extend_vocab, self._query_batch_extend_vocab])
+            probs = tf.concat(axis=1, values=[context_attn_dist, query_attn_dist])
+            batch_size = tf.shape(ids)[0]
+            source_len = tf.shape(ids)[1]
+
+            # same[b, i, j] is True if the source positions i and j hold the same token
+            same = tf.equal(tf.expand_dims(ids, 2), tf.expand_dims(ids, 1))
+            # the probability of the token at each source position
+            token_probs = tf.reduce_sum(tf.to_float(same) * tf.expand_dims(probs, 1), axis=2)
+            # only keep the first position of each token
+            earlier = tf.cast(tf.matrix_band_part(tf.ones([source_len, source_len]), -1, 0) - tf.eye(source_len), tf.bool)
+            repeated = tf.reduce_any(tf.logical_and(same, earlier), axis=2)
+            token_probs = tf.where(repeated, -tf.ones_like(token_probs), token_probs)
+
+            # pad with zero probability [UNK]s so that there are at least k candidates
+            unk_id = self._vocab.word2id(data.MARK_UNK)
+            ids = tf.concat(axis=1, values=[ids, tf.fill([batch_size, k], unk_id)])
+            token_probs = tf.concat(axis=1, values=[token_probs, tf.zeros([batch_size, k])])
+
+            topk_probs, positions = tf.nn.top_k(token_probs, k)
+            batch_nums = tf.tile(tf.expand_dims(tf.range(0, limit=batch_size), 1), [1, k])
+            topk_ids = tf.gather_nd(ids, tf.stack((batch_nums, positions), axis=2))
+            return topk_probs, topk_ids
+
     def _add_emb_vis(self, embedding_var):
         """
         Do setup so that we can view word embedding visualization in Tensorboard,
@@ -347,7 +541,11 @@ class SummarizationModel(object):
         hps = self._hps
         vsize = self._vocab.size()
 
-        with tf.variable_scope('seq2seq'):
+        # The decoder is only run one step at a time in decode mode
+        self._dynamic_decoder = hps.dynamic_decoder.value and hps.mode.value != 'decode'
+
+        with tf.variable_scope('seq2seq') as seq2seq_scope:
+            self._seq2seq_scope = seq2seq_scope
             # Some initializers
             self.rand_unif_init = tf.random_uniform_initializer(
                 -hps.rand_unif_init_mag.value, hps.rand_unif_init_mag.value, seed=42)
@@ -360,17 +558,25 @@ class SummarizationModel(object):
                     'embedding', [vsize, hps.emb_dim.value],
                     dtype=tf.float32,
                     initializer=self.trunc_norm_init)
+                self._embedding = embedding
                 if hps.mode.value == "train":
                     self._add_emb_vis(embedding)
                 # tensor with shape (batch_size, max_enc_steps, emb_size)
                 emb_enc_inputs = tf.nn.embedding_lookup(embedding, self._enc_batch)
                 emb_query_inputs = tf.nn.embedding_lookup(embedding, self._query_batch)
 
-                # list length max_dec_steps containing shape (batch_size, emb_size)
-                emb_dec_inputs = [
-                    tf.nn.embedding_lookup(embedding, x)
-                    for x in tf.unstack(self._dec_batch, axis=1)
-                ]
+                if self._dynamic_decoder:
+                    # tensor with shape (batch_size, max_dec_steps, emb_size)
+                    emb_dec_inputs = tf.nn.embedding_lookup(embedding, self._dec_batch)
+                    # the decoder only runs up to the longest target in the batch
+                    self._num_dec_steps = tf.to_int32(
+                        tf.reduce_max(tf.reduce_sum(self._dec_padding_mask, axis=1)))
+                else:
+                    # list length max_dec_steps containing shape (batch_size, emb_size)
+                    emb_dec_inputs = [
+                        tf.nn.embedding_lookup(embedding, x)
+                        for x in tf.unstack(self._dec_batch, axis=1)
+                    ]
 
             # Add the encoder.
              # Add the encoder.
@@ -380,12 +586,19 @@ class SummarizationModel(object):
             query_outputs, query_state = self._add_encoder(emb_query_inputs, self._query_lens, 'encoder', True)
 
             self._enc_states = enc_outputs
+            self._context_state = context_state
             self._query_states = query_outputs
             self._query_rep = query_state
             self._dec_in_state = self._reduce_states(context_state, query_state, 'reduce_final_st')
+            if hps.no_rewrite_gate.value:
+                self._add_no_rewrite_gate()
 
             # Add the decoder.
             with tf.variable_scope('decoder'):
+                # the attention keys (W_h h_i) of the encoder and query states
+                self._enc_keys, self._query_keys = decoder_attention_keys(self._enc_states, self._query_states)
+                # everything computed from the context alone, which the encoder cache holds
+                self._context_outputs = [self._enc_states, self._enc_keys, self._context_state.c, self._context_state.h]
                 decoder_outputs, self._dec_out_state, self.context_attn_dists, \
                 self.query_attn_dists, self.p_ts, self.p_bs, \
                 self.t_coverage, self.b_coverage = self._add_decoder(emb_dec_inputs)
@@ -393,45 +606,89 @@ class SummarizationModel(object):
                 # self.query_attn_dists = [tf.multiply(p_b, dist)
                 #         for (p_b, dist) in zip(self.p_bs, self.query_attn_dists)]
 
-            # For pointer model, calc final distribution from copy distribution
-            final_dists = self._calc_final_dist(self.context_attn_dists, self.query_attn_dists)
+            if hps.copy_source_space.value:
+                # The probabilities are read off the attention distributions over the source positions
+                # (see _source_probs and _source_top_k), the dense final distribution isn't needed
+                final_dists = None
+            else:
+                # For pointer model, calc final distribution from copy distribution
+                self._add_scatter_indices()
+                final_dists = self._calc_final_dist(self.context_attn_dists, self.query_attn_dists)
 
         self.final_dists = final_dists
 
         if hps.mode.value == "decode":
-            if hps.batch_size.value > 0:
-                # We run decode beam search mode one decoder step at a time
-                # final_dists is a singleton list containing shape (batch_size, extended_vsize)
-                # assert len(final_dists) == 1
-                final_dists = final_dists[0]
-                # take the k largest probs. note batch_size=beam_size in decode mode
-                topk_probs, self._topk_ids = tf.nn.top_k(
-                    final_dists, hps.batch_size.value * 2)
-                self._topk_log_probs = tf.log(topk_probs)
+            # Everything the decoder attends over. It doesn't change between decoder steps,
+            # so run_encoder computes it once and decode_onestep feeds it back
+            self._attn_cache = {
+                'enc_states': self._enc_states,
+                'enc_keys': self._enc_keys,
+                'enc_padding_mask': self._enc_padding_mask,
+                'query_states': self._query_states,
+                'query_keys': self._query_keys,
+                'query_padding_mask': self._query_padding_mask,
+            }
+            if hps.copy_source_space.value:
+                self._attn_cache['enc_batch_extend_vocab'] = self._enc_batch_extend_vocab
+                self._attn_cache['query_batch_extend_vocab'] = self._query_batch_extend_vocab
             else:
-                assert len(final_dists) == 1
-                # take the k largest probs
-                topk_probs, self._topk_ids = tf.nn.top_k(final_dists, k=1)
-                self._topk_log_probs = tf.log(topk_probs)
+                self._attn_cache['context_indices'] = self._context_indices
+                self._attn_cache['query_indices'] = self._query_indices
+                self._attn_cache['max_art_oovs'] = self._max_art_oovs
+
+            # We run decode beam search mode one decoder step at a time
+            # context_attn_dists is a singleton list containing shape (batch_size, attn_len)
+            # take the k largest probs
+            topk_probs, self._topk_ids = self._top_k(
+                self.context_attn_dists[0], self.query_attn_dists[0],
+                hps.beam_size.value * 2 if hps.batch_size.value > 0 else 1)
+            self._topk_log_probs = tf.log(topk_probs)
 
     def _add_loss(self):
         with tf.variable_scope('loss'):
-            if FLAGS.pointer_gen:
+            if self._hps.pointer_gen.value:
                 # Calculate the loss per step
                 # This is fiddly; we use tf.gather_nd to pick out the probabilities of the gold target words
                 # will be list length max_dec_steps containing shape (batch_size)
                 loss_per_step = []
                 # shape (batch_size)
-                batch_nums = tf.range(0, limit=self._hps.batch_size.value)
-                for dec_step, dist in enumerate(self.final_dists):
-                    # The indices of the target words. shape (batch_size)
-                    targets = self._target_batch[:, dec_step]
-                    # shape (batch_size, 2)
-                    indices = tf.stack((batch_nums, targets), axis=1) 
-                    # shape (batch_size). prob of correct words on this step
-                    gold_probs = tf.gather_nd(dist, indices)
-                    losses = -tf.log(tf.clip_by_value(gold_probs, 1e-10, 1.0))
-                    loss_per_step.append(losses)
+                batch_nums = tf.range(0, limit=tf.shape(self._target_batch)[0])
+                if self._hps.copy_source_space.value and self._dynamic_decoder:
+                    num_steps = tf.shape(self.context_attn_dists)[0]
+                    # The indices of the target words. shape (num_steps, batch_size)
+                    targets = tf.transpose(self._target_batch[:, :num_steps])
+                    # shape (num_steps, batch_size). prob of correct words on each step
+                    gold_probs = self._source_probs(self.context_attn_dists, self.query_attn_dists, targets)
+                    loss_per_step = -tf.log(tf.clip_by_value(gold_probs, 1e-10, 1.0))
+                elif self._hps.copy_source_space.value:
+                    for dec_step, (context_dist, query_dist) in enumerate(
+                            zip(self.context_attn_dists, self.query_attn_dists)):
+                        # shape (batch_size). prob of correct words on this step
+                        gold_probs = self._source_probs(context_dist, query_dist, self._target_batch[:, dec_step])
+                        losses = -tf.log(tf.clip_by_value(gold_probs, 1e-10, 1.0))
+                        loss_per_step.append(losses)
+                elif self._dynamic_decoder:
+                    # final_dists has shape (num_steps, batch_size, extended_vsize)
+                    num_steps = tf.shape(self.final_dists)[0]
+                    # The indices of the target words. shape (num_steps, batch_size)
+                    targets = tf.transpose(self._target_batch[:, :num_steps])
+                    step_nums, step_batch_nums = tf.meshgrid(
+                        tf.range(0, limit=num_steps), batch_nums, indexing='ij')
+                    # shape (num_steps, batch_size, 3)
+                    indices = tf.stack((step_nums, step_batch_nums, targets), axis=2)
+                    # shape (num_steps, batch_size). prob of correct words on each step
+                    gold_probs = tf.gather_nd(self.final_dists, indices)
+                    loss_per_step = -tf.log(tf.clip_by_value(gold_probs, 1e-10, 1.0))
+                else:
+                    for dec_step, dist in enumerate(self.final_dists):
+                        # The indices of the target words. shape (batch_size)
+                        targets = self._target_batch[:, dec_step]
+                        # shape (batch_size, 2)
+                        indices = tf.stack((batch_nums, targets), axis=1) 
+                        # shape (batch_size). prob of correct words on this step
+                        gold_probs = tf.gather_nd(dist, indices)
+                        losses = -tf.log(tf.clip_by_value(gold_probs, 1e-10, 1.0))
+                        loss_per_step.append(losses)
 
                 # Apply dec_padding_mask and get loss
                 self._loss = _mask_and_avg(loss_per_step, self._dec_padding_mask)
@@ -451,10 +708,166 @@ class SummarizationModel(object):
                 self._total_loss = self._loss + self._hps.cov_loss_wt.value * self._coverage_loss
                 tf.summary.scalar('total_loss', self._total_loss)
 
+            # Calculate the loss of the no-rewrite gate
+            if self._hps.no_rewrite_gate.value:
+                self._gate_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=self._no_rewrite, logits=self._no_rewrite_logits))
+                tf.summary.scalar('gate_loss', self._gate_loss)
+
+    def _add_beam_search(self):
+        """Add the whole beam search to the graph as a tf.while_loop, so that decoding a batch takes a single session.run.
+        It makes the same search as beam_search.run_beam_search_batch, on a batch holding each dialogue repeated beam_size times:
+        on each step, the 2*beam_size most likely tokens after each hypothesis in the beam are ranked by log probability.
+        Going down the ranking, candidates ending with [STOP] are finished (if the step is at least min_dec_steps)
+        and the others are kept, until beam_size candidates are kept or a dialogue has beam_size finished hypotheses.
+        The best hypothesis is the finished one (or if there are none, the one in the beam) with the highest average log probability.
+
+        Sets:
+            self._beam_tokens: shape (num_dialogues, max_dec_steps + 1). The token ids of the best hypotheses, starting with [GO].
+            self._beam_log_probs: shape (num_dialogues, max_dec_steps + 1). The log probabilities of the tokens.
+            self._beam_lengths: shape (num_dialogues). The number of tokens of the best hypotheses.
+        """
+        hps = self._hps
+        beam_size = hps.beam_size.value
+        k = beam_size * 2  # candidates for each hypothesis
+        num_cands = beam_size * k  # candidates for each dialogue
+        max_len = hps.max_dec_steps.value + 1  # [GO] and up to max_dec_steps tokens
+        vsize = self._vocab.size()
+        unk_id = self._vocab.word2id(data.MARK_UNK)
+        eos_id = self._vocab.word2id(data.MARK_EOS)
+
+        with tf.variable_scope('beam_search'):
+            batch_size = tf.shape(self._enc_states)[0]
+            num_dialogues = batch_size // beam_size
+            dialogue_nums = tf.expand_dims(tf.range(0, limit=num_dialogues), 1)  # shape (num_dialogues, 1)
+
+            def gather_beams(values, indices):
+                """values shape (num_dialogues, n, ...), indices shape (num_dialogues, m). Returns shape (num_dialogues, m, ...)"""
+                dialogue_indices = tf.tile(dialogue_nums, [1, tf.shape(indices)[1]])
+                return tf.gather_nd(values, tf.stack((dialogue_indices, indices), axis=2))
+
+            def first_true(mask, n):
+                """The positions of the first n True entries of each row of mask, shape (num_dialogues, n).
+                If there are less than n, the remaining positions are those of False entries."""
+                positions = tf.tile(tf.expand_dims(tf.range(tf.shape(mask)[1]), 0), [num_dialogues, 1])
+                _, first = tf.nn.top_k(tf.where(mask, -positions, -positions - tf.shape(mask)[1]), n)
+                return first
+
+            def body(step, alive_seq, alive_lps, alive_score, state, t_cov, b_cov,
+                     fin_seq, fin_lps, fin_score, fin_len, fin_count):
+                # latest token produced by each hypothesis.
+                # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+                latest_tokens = tf.reshape(alive_seq[:, :, step], [-1])
+                latest_tokens = tf.where(latest_tokens < vsize, latest_tokens, tf.fill(tf.shape(latest_tokens), unk_id))
+                emb_dec_inputs = [tf.nn.embedding_lookup(self._embedding, latest_tokens)]
+
+                # Run one step of the decoder, with the variables of the one step decoder graph
+                with tf.variable_scope(self._seq2seq_scope, reuse=True):
+                    with tf.variable_scope('decoder'):
+                        _, new_state, context_attn_dists, query_attn_dists, _, _, new_t_cov, new_b_cov = self._add_decoder(
+                            emb_dec_inputs, state,
+                            t_cov if hps.coverage.value else None, b_cov if hps.coverage.value else None)
+                topk_probs, topk_ids = self._top_k(context_attn_dists[0], query_attn_dists[0], k)
+                topk_log_probs = tf.log(topk_probs)
+
+                # shape (num_dialogues, num_cands). Candidate j of hypothesis i is number i*k+j
+                cand_ids = tf.reshape(topk_ids, [num_dialogues, num_cands])
+                cand_lps = tf.reshape(topk_log_probs, [num_dialogues, num_cands])
+                cand_scores = tf.reshape(tf.expand_dims(alive_score, 2) + tf.reshape(topk_log_probs, [num_dialogues, beam_size, k]),
+                                         [num_dialogues, num_cands])
+                # On the first step, all the hypotheses are the same, so only the first one is extended
+                first_hyp_only = tf.logical_and(tf.equal(step, 0), tf.range(num_cands) >= k)
+                first_hyp_only = tf.tile(tf.expand_dims(first_hyp_only, 0), [num_dialogues, 1])
+                cand_scores = tf.where(first_hyp_only, tf.fill(tf.shape(cand_scores), -np.inf), cand_scores)
+
+                # Rank the candidates by log probability. All of them have the same length, so this is also the ranking by
+                # average log probability. top_k keeps equal values in order, like the stable sort of beam_search.sort_hyps
+                cand_scores, order = tf.nn.top_k(cand_scores, num_cands)
+                cand_hyps = order // k
+                cand_ids = gather_beams(cand_ids, order)
+                cand_lps = gather_beams(cand_lps, order)
+
+                # Go down the ranking until beam_size candidates are kept or there are beam_size finished hypotheses
+                is_eos = tf.equal(cand_ids, eos_id)
+                can_finish = tf.logical_and(is_eos, step >= hps.min_dec_steps.value)
+                num_kept_before = tf.cumsum(tf.to_int32(tf.logical_not(is_eos)), axis=1, exclusive=True)
+                num_finished_before = tf.cumsum(tf.to_int32(can_finish), axis=1, exclusive=True) + tf.expand_dims(fin_count, 1)
+                reached = tf.logical_and(num_kept_before < beam_size, num_finished_before < beam_size)
+                kept = tf.logical_and(reached, tf.logical_not(is_eos))
+                finished = tf.logical_and(reached, can_finish)
+
+                # The candidate sequences, shape (num_dialogues, num_cands, max_len)
+                new_token = tf.one_hot(step + 1, max_len, dtype=tf.int32)
+                cand_seq = gather_beams(alive_seq, cand_hyps) + tf.expand_dims(cand_ids, 2) * new_token
+                cand_lps_seq = gather_beams(alive_lps, cand_hyps) + tf.expand_dims(cand_lps, 2) * tf.to_float(new_token)
+
+                # The new beam
+                beam = first_true(kept, beam_size)
+                new_alive_seq = gather_beams(cand_seq, beam)
+                new_alive_lps = gather_beams(cand_lps_seq, beam)
+                new_alive_score = gather_beams(cand_scores, beam)
+                # The decoder states of the new beam come from the rows of their hypotheses
+                rows = tf.reshape(dialogue_nums * beam_size + gather_beams(cand_hyps, beam), [-1])
+                new_state = tf.contrib.rnn.LSTMStateTuple(tf.gather(new_state.c, rows), tf.gather(new_state.h, rows))
+                if hps.coverage.value:
+                    t_cov = tf.gather(new_t_cov, rows)
+                    b_cov = tf.gather(new_b_cov, rows)
+
+                # Append the finished candidates to the finished hypotheses
+                fin_slots = tf.tile(tf.expand_dims(tf.range(beam_size), 0), [num_dialogues, 1])
+                fin = first_true(tf.concat([fin_slots < tf.expand_dims(fin_count, 1), finished], axis=1), beam_size)
+                fin_seq = gather_beams(tf.concat([fin_seq, cand_seq], axis=1), fin)
+                fin_lps = gather_beams(tf.concat([fin_lps, cand_lps_seq], axis=1), fin)
+                # the average log probability; the candidates have step + 2 tokens, including [GO]
+                fin_score = gather_beams(tf.concat([fin_score, cand_scores / tf.to_float(step + 2)], axis=1), fin)
+                fin_len = gather_beams(tf.concat([fin_len, tf.fill([num_dialogues, num_cands], step + 2)], axis=1), fin)
+                fin_count += tf.reduce_sum(tf.to_int32(finished), axis=1)
+
+                return (step + 1, new_alive_seq, new_alive_lps, new_alive_score, new_state, t_cov, b_cov,
+                        fin_seq, fin_lps, fin_score, fin_len, fin_count)
+
+            def cond(step, *args):
+                fin_count = args[-1]
+                return tf.logical_and(step < hps.max_dec_steps.value, tf.reduce_any(fin_count < beam_size))
+
+            go_token = tf.one_hot(0, max_len, dtype=tf.int32) * self._vocab.word2id(data.MARK_GO)
+            loop_vars = (
+                tf.constant(0),
+                tf.tile(tf.reshape(go_token, [1, 1, max_len]), [num_dialogues, beam_size, 1]),
+                tf.zeros([num_dialogues, beam_size, max_len]),
+                tf.zeros([num_dialogues, beam_size]),
+                self._dec_in_state,
+                tf.zeros_like(self._enc_padding_mask),
+                tf.zeros_like(self._query_padding_mask),
+                tf.zeros([num_dialogues, beam_size, max_len], dtype=tf.int32),
+                tf.zeros([num_dialogues, beam_size, max_len]),
+                tf.zeros([num_dialogues, beam_size]),
+                tf.zeros([num_dialogues, beam_size], dtype=tf.int32),
+                tf.zeros([num_dialogues], dtype=tf.int32))
+            (step, alive_seq, alive_lps, alive_score, _, _, _,
+             fin_seq, fin_lps, fin_score, fin_len, fin_count) = tf.while_loop(cond, body, loop_vars)
+
+            # If a dialogue has no finished hypotheses, use the hypotheses in the beam
+            has_finished = fin_count > 0
+            seqs = tf.where(has_finished, fin_seq, alive_seq)
+            lps = tf.where(has_finished, fin_lps, alive_lps)
+            scores = tf.where(has_finished, fin_score, alive_score / tf.to_float(step + 1))
+            lengths = tf.where(has_finished, fin_len, tf.fill([num_dialogues, beam_size], step + 1))
+            valid = tf.logical_or(tf.expand_dims(tf.logical_not(has_finished), 1),
+                                  tf.tile(tf.expand_dims(tf.range(beam_size), 0), [num_dialogues, 1]) < tf.expand_dims(fin_count, 1))
+            # The best hypothesis; the first one of equal average log probabilities, like sort_hyps
+            _, best = tf.nn.top_k(tf.where(valid, scores, tf.fill(tf.shape(scores), -np.inf)), 1)
+            self._beam_tokens = gather_beams(seqs, best)[:, 0]
+            self._beam_log_probs = gather_beams(lps, best)[:, 0]
+            self._beam_lengths = gather_beams(lengths, best)[:, 0]
+
     def _add_train_op(self):
         """Sets self._train_op, the op to run for training."""
         # Take gradients of the trainable variables w.r.t. the loss function to minimize
         loss_to_minimize = self._total_loss if self._hps.coverage.value else self._loss
+        if self._hps.no_rewrite_gate.value:
+            # the gate doesn't backpropagate into the rest of the model
+            loss_to_minimize += self._gate_loss
         tvars = tf.trainable_variables()
         gradients = tf.gradients(
             loss_to_minimize,
@@ -485,6 +898,8 @@ class SummarizationModel(object):
         self._add_seq2seq()
         if self._hps.mode.value in ['train', 'eval']:
             self._add_loss()
+        if self._hps.mode.value == 'decode' and self._hps.in_graph_beam_search.value:
+            self._add_beam_search()
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
         if self._hps.mode.value == 'train':
             self._add_train_op()
@@ -493,7 +908,8 @@ class SummarizationModel(object):
         tf.logging.info('Time to build graph: %i seconds', t1 - t0)
 
     def run_train_step(self, sess, batch):
-        """Runs one training iteration. Returns a dictionary containing train op, summaries, loss, global_step and (optionally) coverage loss."""
+        """Runs one training iteration. Returns a dictionary containing train op, summaries, loss, global_step and (optionally) coverage loss.
+        If batch is None, the batch is read from the input dataset."""
         feed_dict = self._make_feed_dict(batch)
         to_return = {
             'train_op': self._train_op,
@@ -506,7 +922,8 @@ class SummarizationModel(object):
         return sess.run(to_return, feed_dict)
 
     def run_eval_step(self, sess, batch):
-        """Runs one evaluation iteration. Returns a dictionary containing summaries, loss, global_step and (optionally) coverage loss."""
+        """Runs one evaluation iteration. Returns a dictionary containing summaries, loss, global_step and (optionally) coverage loss.
+        If batch is None, the batch is read from the input dataset."""
         feed_dict = self._make_feed_dict(batch)
         to_return = {
             'summaries': self._summaries,
@@ -515,79 +932,194 @@ class SummarizationModel(object):
         }
         if self._hps.coverage.value:
             to_return['coverage_loss'] = self._coverage_loss
+        if self._hps.no_rewrite_gate.value:
+            to_return['no_rewrite_prob'] = self._no_rewrite_prob
+            to_return['no_rewrite'] = self._no_rewrite
         return sess.run(to_return, feed_dict)
 
-    def run_encoder(self, sess, batch):
-        """For beam search decoding. Run the encoder on the batch and return the encoder states and decoder initial state.
+    def encode(self, sess, batch):
+        """For decoding. Run the encoder once on each dialogue of the batch.
+        With the no-rewrite gate, its probability is fetched in the same run, from the query representation and
+        decoder initial state of the encoder. With the encoder cache, the outputs of the contexts encoded before
+        are fed instead of being recomputed, so that only the query encoder runs for them.
 
         Args:
             sess: Tensorflow session.
-            batch: Batch object that is the same example repeated across the batch (for beam search)
+            batch: Batch object with each dialogue repeated hps.beam_size times across the batch
 
         Returns:
-            enc_states: The encoder states. A tensor of shape [batch_size, <=max_enc_steps, 2*hidden_dim].
-            dec_in_state: A LSTMStateTuple of shape ([1,hidden_dim],[1,hidden_dim])
+            encoding: (attn_cache, dec_in_state) with one row per dialogue, to pass to run_encoder or run_beam_search
+                (or the rows of some of the dialogues, see select_encoding).
+            no_rewrite_prob: The probability that the rewrite of each dialogue is its query, shape (num_dialogues),
+                or None without the no-rewrite gate.
         """
-        # feed the batch into the placeholders
-        feed_dict = self._make_feed_dict(batch, just_enc=True)
-        (enc_states, query_states, dec_in_state, global_step) = sess.run(
-            [self._enc_states, self._query_states, self._dec_in_state, self.global_step],
-            feed_dict)
-
-        # dec_in_state is LSTMStateTuple shape ([batch_size,hidden_dim],[batch_size,hidden_dim])
-        # Given that the batch is a single example repeated, dec_in_state is identical across the batch so we just take the top row.
-        if FLAGS.mode == 'decode' and FLAGS.beam_size > 0:
-            dec_in_state = tf.contrib.rnn.LSTMStateTuple(
-                dec_in_state.c[0], dec_in_state.h[0])
-        else:
-            dec_in_state = tf.contrib.rnn.LSTMStateTuple(
-                dec_in_state.c, dec_in_state.h)
+        num_copies = self._hps.beam_size.value
+        # feed the first copy of each dialogue into the placeholders
+        feed_dict = {
+            placeholder: value if placeholder is self._max_art_oovs else value[::num_copies]
+            for placeholder, value in self._make_feed_dict(batch, just_enc=True).items()
+        }
+        fetches = {'attn_cache': self._attn_cache, 'dec_in_state': self._dec_in_state}
+        if self._hps.no_rewrite_gate.value:
+            fetches['no_rewrite_prob'] = self._no_rewrite_prob
+        if self._encoder_cache is not None:
+            enc_batch, enc_lens = batch.enc_batch[::num_copies], batch.enc_lens[::num_copies]
+            keys = [context_key(ids[:n]) for ids, n in zip(enc_batch, enc_lens)]
+            cached = [self._encoder_cache.get(key) for key in keys]
+            if all(entry is None for entry in cached):
+                # encode all the contexts in the same run, and keep their outputs
+                fetches['context_outputs'] = self._context_outputs
+            else:
+                feed_dict.update(self._cached_context_feed(sess, enc_batch, enc_lens, keys, cached))
+        results = sess.run(fetches, feed_dict)
+        if 'context_outputs' in results:
+            for i, (key, n) in enumerate(zip(keys, enc_lens)):
+                self._encoder_cache.put(key, _context_entry(results['context_outputs'], i, n))
+        return (results['attn_cache'], results['dec_in_state']), results.get('no_rewrite_prob')
 
-        return enc_states, query_states, dec_in_state
+    def select_encoding(self, encoding, dialogues):
+        """Return the encoding (see encode) of the given dialogues, in that order.
 
-    def decode_onestep(self, sess, batch, latest_tokens, enc_states, query_states,
-                       dec_init_states, prev_t_coverage, prev_b_coverage):
-        """For beam search decoding. Run the decoder for one step.
+        Args:
+            encoding: (attn_cache, dec_in_state) returned by encode.
+            dialogues: Integer array. The row of each dialogue in encoding.
+        """
+        attn_cache, dec_in_state = encoding
+        return (self.gather_attn_cache(attn_cache, dialogues),
+                tf.contrib.rnn.LSTMStateTuple(dec_in_state.c[dialogues], dec_in_state.h[dialogues]))
+
+    def run_encoder(self, sess, batch, beam_size=None, encoding=None):
+        """For beam search decoding. Run the encoder on the batch and return the attention cache and decoder initial state.
+        Each dialogue is only encoded once (see encode), and its encoding is repeated for the rows of its beam.
 
         Args:
             sess: Tensorflow session.
-            batch: Batch object containing single example repeated across the batch
-            latest_tokens: Tokens to be fed as input into the decoder for this timestep
-            enc_states: The encoder states.
-            dec_init_states: List of beam_size LSTMStateTuples; the decoder states from the previous timestep
-            prev_coverage: List of np arrays. The coverage vectors from the previous timestep. 
-            List of None if not using coverage.
+            batch: Batch object with each dialogue repeated hps.beam_size times across the batch (for beam search)
+            beam_size: Integer. Number of rows of each dialogue in the returned attention cache and decoder initial state.
+                Defaults to hps.beam_size.
+            encoding: The encoding of the dialogues of the batch returned by encode, or None to run the encoder.
 
         Returns:
-            ids: top 2k ids. shape [beam_size, 2*beam_size]
-            probs: top 2k log probabilities. shape [beam_size, 2*beam_size]
-            new_states: new states of the decoder. a list length beam_size containing
-                LSTMStateTuples each of shape ([hidden_dim,],[hidden_dim,])
-            attn_dists: List length beam_size containing lists length attn_length.
-            new_coverage: Coverage vectors for this step. A list of arrays. List of None if coverage is not turned on.
+            attn_cache: dict of numpy arrays that the decoder attends over, to pass to decode_onestep:
+                the encoder and query states, their attention keys, padding masks and
+                scatter indices into the extended vocabulary, and max_art_oovs.
+            dec_in_state: A LSTMStateTuple of shape ([batch_size,hidden_dim],[batch_size,hidden_dim])
         """
+        if beam_size is None:
+            beam_size = self._hps.beam_size.value
+        if encoding is None:
+            encoding, _ = self.encode(sess, batch)
+        attn_cache, dec_in_state = encoding
+
+        # dec_in_state is LSTMStateTuple shape ([num_dialogues,hidden_dim],[num_dialogues,hidden_dim])
+        # Repeat the encoding of each dialogue for the rows of its beam
+        if beam_size > 1:
+            attn_cache, dec_in_state = self.select_encoding(
+                encoding, np.repeat(np.arange(len(dec_in_state.c)), beam_size))
 
-        beam_size = len(dec_init_states)
+        return attn_cache, dec_in_state
 
-        # Turn dec_init_states (a list of LSTMStateTuples) into a single LSTMStateTuple for the batch
-        cells = [np.expand_dims(state.c, axis=0) for state in dec_init_states]
-        hiddens = [
-            np.expand_dims(state.h, axis=0) for state in dec_init_states
-        ]
-        new_c = np.concatenate(cells, axis=0)  # shape [batch_size,hidden_dim]
-        new_h = np.concatenate(
-            hiddens, axis=0)  # shape [batch_size,hidden_dim]
-        new_dec_in_state = tf.contrib.rnn.LSTMStateTuple(new_c, new_h)
+    def _cached_context_feed(self, sess, enc_batch, enc_lens, keys, cached):
+        """Return a feed dict of the context encoder outputs of the dialogues, taken from the encoder cache.
+        The contexts missing from the cache are encoded first and added to it.
 
-        feed = {
+        Args:
+            sess: Tensorflow session.
+            enc_batch, enc_lens: The encoder inputs of the dialogues, one row per dialogue.
+            keys: The encoder cache key of each dialogue's context.
+            cached: The encoder cache entry of each dialogue's context, None for a miss. Missing entries are filled in.
+        """
+        misses = [i for i, entry in enumerate(cached) if entry is None]
+        if misses:
+            miss_lens = enc_lens[misses]
+            outputs = sess.run(self._context_outputs, {
+                self._enc_batch: enc_batch[misses, :miss_lens.max()],
+                self._enc_lens: miss_lens,
+            })
+            for j, (i, n) in enumerate(zip(misses, miss_lens)):
+                cached[i] = _context_entry(outputs, j, n)
+                self._encoder_cache.put(keys[i], cached[i])
+
+        # pad the encoder states and keys to the length of the batch; the padding is masked out by the attention
+        enc_states = np.zeros([len(cached), enc_batch.shape[1], cached[0][0].shape[1]], dtype=np.float32)
+        enc_keys = np.zeros([len(cached), enc_batch.shape[1], cached[0][1].shape[1]], dtype=np.float32)
+        for i, (states, attn_keys, _, _) in enumerate(cached):
+            enc_states[i, :len(states)] = states
+            enc_keys[i, :len(attn_keys)] = attn_keys
+        return {
             self._enc_states: enc_states,
-            self._enc_padding_mask: batch.enc_padding_mask,
-            self._query_states: query_states,
-            self._query_padding_mask: batch.query_padding_mask,
-            self._dec_in_state: new_dec_in_state,
-            self._dec_batch: np.transpose(np.array([latest_tokens])),
+            self._enc_keys: enc_keys,
+            self._context_state.c: np.stack([entry[2] for entry in cached]),
+            self._context_state.h: np.stack([entry[3] for entry in cached]),
         }
 
+    def gather_attn_cache(self, attn_cache, rows):
+        """Return the attention cache of a decoder batch made of the given rows of attn_cache.
+
+        Args:
+            attn_cache: The attention cache returned by run_encoder.
+            rows: Integer array. The row of attn_cache of each row of the new decoder batch.
+        """
+        attn_cache = {
+            name: value if name == 'max_art_oovs' else value[rows]
+            for name, value in attn_cache.items()
+        }
+        for name in ['context_indices', 'query_indices']:
+            if name in attn_cache:
+                # the scatter indices start with the batch number
+                attn_cache[name][:, :, 0] = np.arange(len(rows))[:, None]
+        return attn_cache
+
+    def run_beam_search(self, sess, batch, encoding=None):
+        """For in-graph beam search decoding. Run the whole beam search on the batch with a single session.run.
+
+        Args:
+            sess: Tensorflow session.
+            batch: Batch object with each dialogue repeated beam_size times across the batch
+            encoding: The encoding of the dialogues of the batch returned by encode, fed instead of running the encoder,
+                or None to run the encoder in the same run.
+
+        Returns:
+            tokens: The token ids of the best hypothesis of each dialogue, starting with [GO]. shape (num_dialogues, max_dec_steps + 1)
+            log_probs: The log probabilities of the tokens. shape (num_dialogues, max_dec_steps + 1)
+            lengths: The number of tokens of the best hypotheses. shape (num_dialogues)
+        """
+        feed_dict = self._make_feed_dict(batch, just_enc=True)
+        if encoding is not None:
+            # as in decode_onestep, feeding the attention cache and initial state skips the encoder
+            attn_cache, dec_in_state = self.run_encoder(sess, batch, encoding=encoding)
+            feed_dict.update({self._attn_cache[name]: value for name, value in attn_cache.items()})
+            feed_dict[self._dec_in_state] = dec_in_state
+        return sess.run([self._beam_tokens, self._beam_log_probs, self._beam_lengths], feed_dict)
+
+    def decode_onestep(self, sess, latest_tokens, attn_cache,
+                       dec_init_states, prev_t_coverage, prev_b_coverage):
+        """For beam search decoding. Run the decoder for one step.
+
+        Args:
+            sess: Tensorflow session.
+            latest_tokens: Tokens to be fed as input into the decoder for this timestep
+            attn_cache: The attention cache returned by run_encoder.
+            dec_init_states: LSTMStateTuple of arrays shape [batch_size, hidden_dim]; the decoder states from the previous timestep
+            prev_t_coverage, prev_b_coverage: np arrays shape [batch_size, attn_length].
+                The coverage vectors from the previous timestep. Ignored if not using coverage.
+
+        Returns:
+            ids: top 2k ids. shape [batch_size, 2*beam_size]
+            probs: top 2k log probabilities. shape [batch_size, 2*beam_size]
+            new_states: new states of the decoder. LSTMStateTuple of arrays shape [batch_size, hidden_dim]
+            attn_dists: np array shape [batch_size, attn_length].
+            new_t_coverage, new_b_coverage: Coverage vectors for this step. np arrays shape [batch_size, attn_length],
+                or None if coverage is not turned on.
+        """
+
+        batch_size = len(latest_tokens)
+
+        # feeding the cached attention keys and indices skips the encoder and the key projections
+        feed = {self._attn_cache[name]: value for name, value in attn_cache.items()}
+        feed[self._dec_in_state] = dec_init_states
+        feed[self._dec_batch] = np.transpose(np.array([latest_tokens]))
+
         to_return = {
             "ids": self._topk_ids,
             "probs": self._topk_log_probs,
@@ -597,52 +1129,53 @@ class SummarizationModel(object):
             "p_ts": self.p_ts
         }
 
-        feed[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
-        feed[self._query_batch_extend_vocab] = batch.query_batch_extend_vocab
-        feed[self._max_art_oovs] = batch.max_art_oovs
-
         if self._hps.coverage.value:
-            feed[self.prev_t_coverage] = np.stack(prev_t_coverage, axis=0)
-            feed[self.prev_b_coverage] = np.stack(prev_b_coverage, axis=0)
+            feed[self.prev_t_coverage] = prev_t_coverage
+            feed[self.prev_b_coverage] = prev_b_coverage
             to_return['t_coverage'] = self.t_coverage
             to_return['b_coverage'] = self.b_coverage
 
         results = sess.run(to_return, feed_dict=feed)  # run the decoder step
 
-        # Convert results['states'] (a single LSTMStateTuple) into a list of LSTMStateTuple -- one for each hypothesis
-        new_states = [
-            tf.contrib.rnn.LSTMStateTuple(results['states'].c[i, :],
-                                          results['states'].h[i, :])
-            for i in range(beam_size)
-        ]
-
-        # Convert singleton list containing a tensor to a list of k arrays
+        # Take the array out of the singleton list
         assert len(results['attn_dists']) == 1
-        attn_dists = results['attn_dists'][0].tolist()
+        attn_dists = results['attn_dists'][0]
 
-        # Convert the coverage tensor to a list length k containing the coverage vector for each hypothesis
-        if FLAGS.coverage:
-            new_t_coverage = results['t_coverage'].tolist()
-            new_b_coverage = results['b_coverage'].tolist()
-            assert len(new_t_coverage) == beam_size
+        if self._hps.coverage.value:
+            new_t_coverage = results['t_coverage']
+            new_b_coverage = results['b_coverage']
+            assert len(new_t_coverage) == batch_size
         else:
-            new_t_coverage = [None for _ in range(beam_size)]
-            new_b_coverage = [None for _ in range(beam_size)]
+            new_t_coverage = None
+            new_b_coverage = None
 
-        return results['ids'], results['probs'], new_states, attn_dists, new_t_coverage, new_b_coverage
+        return results['ids'], results['probs'], results['states'], attn_dists, new_t_coverage, new_b_coverage
+
+
+def _context_entry(context_outputs, i, enc_len):
+    """The encoder cache entry of row i of the fetched context outputs (see SummarizationModel._context_outputs),
+    without the padding. The arrays are copied so that the entry doesn't keep the whole batch alive."""
+    enc_states, enc_keys, state_c, state_h = context_outputs
+    return enc_states[i, :enc_len].copy(), enc_keys[i, :enc_len].copy(), state_c[i].copy(), state_h[i].copy()
 
 
 def _mask_and_avg(values, padding_mask):
     """Applies mask to values then returns overall average (a scalar)
 
     Args:
-        values: a list length max_dec_steps containing arrays shape (batch_size).
+        values: a list length max_dec_steps containing arrays shape (batch_size),
+            or a tensor shape (num_steps, batch_size) with num_steps <= max_dec_steps.
         padding_mask: tensor shape (batch_size, max_dec_steps) containing 1s and 0s.
 
     Returns:
         a scalar
     """
     dec_lens = tf.reduce_sum(padding_mask, axis=1)  # shape batch_size. float32
+    if not isinstance(values, list):
+        # the steps after num_steps are padding for every batch member
+        num_steps = tf.shape(values)[0]
+        values_per_ex = tf.reduce_sum(tf.transpose(values) * padding_mask[:, :num_steps], axis=1) / dec_lens
+        return tf.reduce_mean(values_per_ex)
     values_per_step = [
         v * padding_mask[:, dec_step] for dec_step, v in enumerate(values)
     ]
@@ -656,12 +1189,20 @@ def _coverage_loss(attn_dists, padding_mask):
 
     Args:
         attn_dists: The attention distributions for each decoder timestep. 
-        A list length max_dec_steps containing shape (batch_size, attn_length)
+        A list length max_dec_steps containing shape (batch_size, attn_length),
+        or a tensor shape (num_steps, batch_size, attn_length)
         padding_mask: shape (batch_size, max_dec_steps).
 
     Returns:
         coverage_loss: scalar
     """
+    if not isinstance(attn_dists, list):
+        # the coverage before each step is the sum of the attention distributions of the previous steps
+        coverage = tf.cumsum(attn_dists, axis=0, exclusive=True)
+        # shape (num_steps, batch_size)
+        covlosses = tf.reduce_sum(tf.minimum(attn_dists, coverage), [2])
+        return _mask_and_avg(covlosses, padding_mask)
+
     # shape (batch_size, attn_length). Initial coverage is zero.
     coverage = tf.zeros_like(attn_dists[0])
     # Coverage loss per decoder timestep. 
@@ -0,0 +1,121 @@
+"""
+Desc: a persistent exact-match cache of rewrites, in a local SQLite file.
+Popular utterances recur constantly in online traffic; the rewrite server and the Rewriter look each dialogue up
+before decoding it. An entry is keyed by the normalized context and query and the checkpoint that decoded it:
+the entries of other checkpoints are dropped as soon as a new checkpoint uses the cache.
+The least recently used entries are evicted once the texts take more than max_bytes.
+"""
+import sqlite3
+import threading
+import time
+
+
+def normalize_dialogue(context, query):
+    """Return the cache key strings of a dialogue. The context is a list of turns, or a string with the turns
+    separated by '/'. Only the outer whitespace is stripped, since the tokenizer keeps the inner spaces as tokens."""
+    if not isinstance(context, str):
+        context = '/'.join(context)
+    return context.strip(), query.strip()
+
+
+class ResultCache(object):
+    """Maps (checkpoint, context, query) to the rewrite decoded for it, in the SQLite file at path."""
+
+    def __init__(self, path, max_bytes):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS rewrites (checkpoint TEXT, context TEXT, query TEXT, rewrite TEXT, '
+            'size INTEGER, last_used REAL, PRIMARY KEY (checkpoint, context, query))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS rewrites_last_used ON rewrites (last_used)')
+        self._db.commit()
+        self._num_bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM rewrites').fetchone()[0]
+        self._checkpoint = None
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, checkpoint, dialogues):
+        """Return the cached rewrite of each (context, query) dialogue decoded by checkpoint, None for a miss."""
+        with self._lock:
+            self._use_checkpoint(checkpoint)
+            now = time.time()
+            rewrites = []
+            for dialogue in dialogues:
+                key = (checkpoint,) + normalize_dialogue(*dialogue)
+                row = self._db.execute(
+                    'SELECT rewrite FROM rewrites WHERE checkpoint = ? AND context = ? AND query = ?', key).fetchone()
+                if row is None:
+                    self.misses += 1
+                    rewrites.append(None)
+                else:
+                    self.hits += 1
+                    self._db.execute(
+                        'UPDATE rewrites SET last_used = ? WHERE checkpoint = ? AND context = ? AND query = ?',
+                        (now,) + key)
+                    rewrites.append(row[0])
+            self._db.commit()
+            return rewrites
+
+    def store(self, checkpoint, dialogues, rewrites):
+        """Cache the rewrites of the (context, query) dialogues decoded by checkpoint."""
+        with self._lock:
+            self._use_checkpoint(checkpoint)
+            now = time.time()
+            for dialogue, rewrite in zip(dialogues, rewrites):
+                context, query = normalize_dialogue(*dialogue)
+                size = len(context.encode('utf8')) + len(query.encode('utf8')) + len(rewrite.encode('utf8'))
+                if size > self._max_bytes:
+                    continue
+                key = (checkpoint, context, query)
+                old = self._db.execute(
+                    'SELECT size FROM rewrites WHERE checkpoint = ? AND context = ? AND query = ?', key).fetchone()
+                self._db.execute('INSERT OR REPLACE INTO rewrites VALUES (?, ?, ?, ?, ?, ?)',
+                                 key + (rewrite, size, now))
+                self._num_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def _use_checkpoint(self, checkpoint):
+        """Drop the entries of the other checkpoints when the cache is first used with checkpoint."""
+        if checkpoint == self._checkpoint:
+            return
+        self._db.execute('DELETE FROM rewrites WHERE checkpoint != ?', (checkpoint,))
+        self._num_bytes = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM rewrites').fetchone()[0]
+        self._checkpoint = checkpoint
+
+    def _evict(self):
+        """Delete the least recently used entries until the texts take at most max_bytes."""
+        excess = self._num_bytes - self._max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for rowid, size in self._db.execute('SELECT rowid, size FROM rewrites ORDER BY last_used'):
+            evicted.append((rowid,))
+            excess -= size
+            self._num_bytes -= size
+            if excess <= 0:
+                break
+        self._db.executemany('DELETE FROM rewrites WHERE rowid = ?', evicted)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM rewrites').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def rewrite_with_cache(cache, checkpoint, dialogues, rewrite_batch):
+    """Rewrite the (context, query) dialogues, taking the cached ones from cache (None for no cache)
+    and decoding the others together with rewrite_batch, a function from a list of dialogues to their rewrites."""
+    if cache is None:
+        return rewrite_batch(dialogues)
+    rewrites = cache.lookup(checkpoint, dialogues)
+    misses = [i for i, rewrite in enumerate(rewrites) if rewrite is None]
+    if misses:
+        decoded = rewrite_batch([dialogues[i] for i in misses])
+        cache.store(checkpoint, [dialogues[i] for i in misses], decoded)
+        for i, rewrite in zip(misses, decoded):
+            rewrites[i] = rewrite
+    return rewrites
@@ -0,0 +1,107 @@
+"""
+Desc: streaming batch inference over JSONL, for offline rewriting of large logs.
+Each input line is a JSON object with a context (a list of turns, or a string with the turns separated by '/')
+and a query. For each line, in input order, the object is written back with its rewrite and score
+(the average log probability of the rewrite's tokens), and with --timings the time its batch took to decode.
+A line that can't be read gets an error instead; blank lines are skipped.
+The model is loaded with a Rewriter, whose settings are read from a JSON config file (see rewriter.DEFAULT_CONFIG).
+Run like this:
+  python rewrite_jsonl.py config.json log/myexperiment/eval dialogues.jsonl > rewrites.jsonl
+  cat dialogues.jsonl | python rewrite_jsonl.py config.json log/myexperiment/eval - --batch_dialogues=64
+with config.json holding e.g. {"vocab_path": "data/vocab.txt", "vocab_size": 4000, "decode_strategy": "greedy"}.
+"""
+import argparse
+import io
+import json
+import sys
+import time
+
+from batcher import dialogue_error
+from rewriter import Rewriter
+
+
+def read_chunks(lines, chunk_size):
+    """Yield the non-blank lines in lists of chunk_size (the last one can be shorter)."""
+    chunk = []
+    for line in lines:
+        if line.strip():
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def rewrite_chunk(rewriter, lines, batch_dialogues, timings):
+    """Rewrite the dialogues of a chunk of JSONL lines and return the output lines, in the same order.
+    The dialogues are decoded in batches of similar lengths, to waste less of the batches on padding."""
+    records = [None] * len(lines)
+    dialogues = []  # (line index, (context, query))
+    for i, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+            dialogue = (record['context'], record['query'])
+        except (ValueError, KeyError, TypeError) as e:
+            records[i] = {'error': 'Expected a JSON object with a context and a query: %s' % e}
+            continue
+        # a malformed dialogue would fail the whole batch it is decoded with
+        error = dialogue_error(*dialogue)
+        if error is not None:
+            records[i] = {'error': 'Invalid dialogue: %s' % error}
+            continue
+        records[i] = record
+        dialogues.append((i, dialogue))
+
+    def length(item):
+        context, query = item[1]
+        return len(context if isinstance(context, str) else '/'.join(context)) + len(query)
+
+    dialogues.sort(key=length)
+    for start in range(0, len(dialogues), batch_dialogues):
+        batch = dialogues[start:start + batch_dialogues]
+        t0 = time.time()
+        results = rewriter.decode_batch([dialogue for _, dialogue in batch])
+        batch_ms = (time.time() - t0) * 1000
+        for (i, _), (rewrite, score) in zip(batch, results):
+            records[i]['rewrite'] = rewrite
+            records[i]['score'] = float(score)
+            if timings:
+                records[i]['batch_ms'] = batch_ms
+                records[i]['batch_size'] = len(batch)
+    return [json.dumps(record, ensure_ascii=False) + '\n' for record in records]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite the dialogues of a JSONL file or stdin, to stdout.')
+    parser.add_argument('config', help='JSON file with the Rewriter config')
+    parser.add_argument('ckpt_path', help='checkpoint, or directory whose latest checkpoint is loaded')
+    parser.add_argument('input', nargs='?', default='-', help='JSONL file of dialogues, - for stdin (default)')
+    parser.add_argument('--batch_dialogues', type=int, default=32, help='number of dialogues decoded together')
+    parser.add_argument('--sort_chunks', type=int, default=8,
+                        help='number of batches read at once and sorted by length before decoding')
+    parser.add_argument('--timings', action='store_true', help='add the decode time of each line\'s batch')
+    args = parser.parse_args()
+
+    with open(args.config, encoding='utf8') as f:
+        rewriter = Rewriter(json.load(f), args.ckpt_path)
+    # read and write UTF-8 whatever the locale
+    lines = io.open(sys.stdin.fileno() if args.input == '-' else args.input, encoding='utf8',
+                    closefd=args.input != '-')
+    out = io.open(sys.stdout.fileno(), 'w', encoding='utf8', closefd=False)
+    t0 = time.time()
+    count = 0
+    try:
+        for chunk in read_chunks(lines, args.batch_dialogues * args.sort_chunks):
+            # one write per chunk; the flush lets a downstream consumer follow the progress
+            out.write(''.join(rewrite_chunk(rewriter, chunk, args.batch_dialogues, args.timings)))
+            out.flush()
+            count += len(chunk)
+    finally:
+        lines.close()
+        rewriter.close()
+    sys.stderr.write('Rewrote %i dialogues in %.1f seconds\n' % (count, time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
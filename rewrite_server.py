@@ -0,0 +1,197 @@
+"""
+Desc: an HTTP server that rewrites queries with a trained model, for online use.
+The checkpoint is loaded once. Concurrent requests are queued and decoded together, in batches of up to
+serve_max_batch_size dialogues; a batch waits at most serve_max_wait_ms after its first request to fill up.
+Start it with run_summarization.py --mode=serve, then:
+  curl -d '{"context": ["西安天气", "西安今天的天气是多云转小雨25度到35度东北风3级"], "query": "明天有雨吗"}' http://localhost:8000/rewrite
+which returns the rewrite and the time the request spent in the server:
+  {"rewrite": "西安明天有雨吗", "latency_ms": 12.5}
+"""
+import json
+import queue
+import socketserver
+import threading
+import time
+import traceback
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+from batcher import dialogue_batch, dialogue_error
+from beam_search import hypothesis_words
+from result_cache import rewrite_with_cache
+
+LATENCY_LOG_INTERVAL = 100  # log the latency percentiles every this many requests
+
+
+class RewriteRequest(object):
+    """A dialogue waiting in the server queue to be rewritten."""
+
+    def __init__(self, context, query):
+        self.context = context
+        self.query = query
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.rewrite = None
+        self.error = None  # traceback of an exception raised while decoding the request's batch
+        self.latency = None
+
+
+class RewriteServer(object):
+    """Rewrites dialogues with a BeamSearchDecoder, decoding concurrent requests together in micro-batches."""
+
+    def __init__(self, decoder, vocab, hps, max_batch_size, max_wait, strategy=None, result_cache=None):
+        """Initialize the server and start the thread that decodes the batches.
+
+        Args:
+            decoder: BeamSearchDecoder object, with the checkpoint loaded.
+            vocab: Vocabulary object
+            hps: hyperparameters
+            max_batch_size: maximum number of dialogues in a batch
+            max_wait: maximum seconds a batch waits after its first request to fill up
+            strategy: decode strategy (see BeamSearchDecoder.search), or None for FLAGS.decode_strategy
+            result_cache: ResultCache the dialogues are looked up in before being decoded, or None
+        """
+        self._decoder = decoder
+        self._vocab = vocab
+        self._hps = hps
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._strategy = strategy
+        self._result_cache = result_cache
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=1000)  # latencies of the latest requests
+        self._num_requests = 0
+
+        self._batch_thread = threading.Thread(target=self._run_batches)
+        self._batch_thread.daemon = True
+        self._batch_thread.start()
+
+    def rewrite(self, context, query):
+        """Queue a dialogue and wait for its rewrite. Called from the request handler threads.
+
+        Args:
+            context: the previous turns of the dialogue; a list of strings, or a string with the turns separated by '/'
+            query: the current turn; a string
+
+        Returns:
+            rewrite: the rewritten query; a string
+            latency: seconds from the arrival of the request to its rewrite
+        """
+        request = RewriteRequest(context if isinstance(context, str) else '/'.join(context), query)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise Exception("Decoding failed:\n%s" % request.error)
+        return request.rewrite, request.latency
+
+    def _next_requests(self):
+        """Wait for a request, then collect the requests arriving until the batch is full
+        or max_wait after the arrival of the first one."""
+        requests = [self._queue.get()]
+        deadline = requests[0].arrival_time + self._max_wait
+        while len(requests) < self._max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                requests.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def _rewrite_batch(self, requests):
+        """Return the rewrites of the requests; those missing from the result cache are decoded as one batch."""
+        return rewrite_with_cache(self._result_cache, self._decoder.ckpt_path,
+                                  [(r.context, r.query) for r in requests], self._decode)
+
+    def _decode(self, dialogues):
+        """Decode the (context, query) dialogues as one batch and return their rewrites."""
+        beam_size = self._hps.beam_size.value
+        batch = dialogue_batch(dialogues, self._vocab, self._hps)
+        best_hyps = self._decoder.search(batch, self._strategy)
+        return [''.join(hypothesis_words(hyp, self._vocab, batch, d * beam_size))
+                for d, hyp in enumerate(best_hyps)]
+
+    def _run_batches(self):
+        """Decode the queued requests in batches, forever."""
+        while True:
+            requests = self._next_requests()
+            try:
+                rewrites = self._rewrite_batch(requests)
+            except Exception:
+                tf.logging.error("Error decoding a batch of %i requests", len(requests))
+                error = traceback.format_exc()
+                tf.logging.error(error)
+                rewrites = [None] * len(requests)
+                for request in requests:
+                    request.error = error
+            now = time.time()
+            for request, rewrite in zip(requests, rewrites):
+                request.rewrite = rewrite
+                request.latency = now - request.arrival_time
+                request.done.set()
+                self._log_latency(request.latency, len(requests))
+
+    def _log_latency(self, latency, batch_size):
+        self._latencies.append(latency)
+        self._num_requests += 1
+        tf.logging.info('request latency: %.1f ms (batch of %i)', latency * 1000, batch_size)
+        if self._num_requests % LATENCY_LOG_INTERVAL == 0:
+            latencies = np.array(self._latencies) * 1000
+            tf.logging.info('%i requests. latency over the last %i: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms',
+                            self._num_requests, len(latencies), np.percentile(latencies, 50),
+                            np.percentile(latencies, 90), np.percentile(latencies, 99))
+            if self._result_cache is not None:
+                tf.logging.info('result cache: %i hits, %i misses',
+                                self._result_cache.hits, self._result_cache.misses)
+
+
+class _RewriteHandler(BaseHTTPRequestHandler):
+    """Handles POST /rewrite requests with a JSON object {"context": ..., "query": ...}."""
+
+    def do_POST(self):
+        if self.path != '/rewrite':
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+            context, query = body['context'], body['query']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, 'Expected a JSON object with a context and a query')
+            return
+        # a malformed dialogue would fail the whole batch it is decoded with
+        error = dialogue_error(context, query)
+        if error is not None:
+            self.send_error(400, 'Invalid dialogue: %s' % error)
+            return
+        try:
+            rewrite, latency = self.server.rewrite_server.rewrite(context, query)
+        except Exception as e:
+            self.send_error(500, str(e).splitlines()[0])
+            return
+        response = json.dumps({'rewrite': rewrite, 'latency_ms': latency * 1000}, ensure_ascii=False).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        # the latency of each request is already logged by the RewriteServer
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(decoder, vocab, hps, port, max_batch_size, max_wait, strategy=None, result_cache=None):
+    """Run the rewrite server on localhost:port until interrupted. See RewriteServer for the arguments."""
+    http_server = _ThreadingHTTPServer(('localhost', port), _RewriteHandler)
+    http_server.rewrite_server = RewriteServer(decoder, vocab, hps, max_batch_size, max_wait, strategy, result_cache)
+    tf.logging.info('Rewrite server listening on http://localhost:%i/rewrite', port)
+    try:
+        http_server.serve_forever()
+    finally:
+        http_server.server_close()
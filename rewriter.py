@@ -0,0 +1,158 @@
+"""
+Desc: rewrite dialogues in-process with a trained model, for use as a library.
+The Rewriter reads its settings from a config instead of the tf.app.flags of run_summarization.py,
+and builds the batches in memory instead of reading them from data files with the threaded Batcher:
+  rewriter = Rewriter({'vocab_path': '../data/vocab.txt'}, 'log/myexperiment/eval')
+  rewriter.rewrite_batch([(["西安天气", "西安今天的天气是多云转小雨25度到35度东北风3级"], "明天有雨吗")])
+which returns ['西安明天有雨吗'].
+"""
+import os
+
+import tensorflow as tf
+
+import util
+from batcher import dialogue_batch
+from beam_search import decode_dialogues, hypothesis_words
+from data import Vocab
+from model import SummarizationModel
+from result_cache import ResultCache, rewrite_with_cache
+
+# The model and decoding settings of a Rewriter, with the defaults of the run_summarization.py flags of the same names.
+# They must match the flags the checkpoint was trained with.
+DEFAULT_CONFIG = {
+    'vocab_path': None,
+    'vocab_size': 30000,
+    'decode_strategy': 'beam',
+    'result_cache_path': None,  # SQLite file caching the rewrites, see result_cache.py
+    'result_cache_mb': 64.0,
+    # model
+    'encoder_type': 'bi',
+    'hidden_dim': 256,
+    'emb_dim': 128,
+    'max_enc_steps': 50,
+    'max_dec_steps': 30,
+    'pointer_gen': True,
+    'coverage': False,
+    'dynamic_decoder': False,
+    'copy_source_space': False,
+    'no_rewrite_gate': False,
+    # decoding
+    'beam_size': 4,
+    'min_dec_steps': 5,
+    'dec_steps_slack': -1,
+    'early_stop_beam': False,
+    'in_graph_beam_search': False,
+    'sample_top_k': 4,
+    'sample_temperature': 1.0,
+    'adaptive_beam_margin': 0.5,
+    'decode_time_budget': 0.0,
+    'no_rewrite_threshold': 0.9,
+    'encoder_cache_mb': 0.0,
+}
+
+# The hyperparameters of the training and batching flags, which the model reads when it builds its graph.
+# They don't change the rewrites of a restored decode mode model, so they aren't settings of the Rewriter:
+# the batches are built by dialogue_batch and the initializers, optimizer and loss weights are unused.
+_IGNORED_HPS = {
+    'batch_size': 1,
+    'max_batch_tokens': 0,
+    'decode_batch_dialogues': 1,
+    'learning_rate': 0.0,
+    'adagrad_init_acc': 0.1,
+    'rand_unif_init_mag': 0.02,
+    'trunc_norm_init_std': 1e-4,
+    'max_grad_norm': 0.0,
+    'cov_loss_wt': 0.0,
+}
+
+
+class Rewriter(object):
+    """Rewrites dialogues with a trained model loaded once from a checkpoint."""
+
+    def __init__(self, config, ckpt_path):
+        """Build the model in decode mode and restore the checkpoint.
+
+        Args:
+            config: dict, or object with attributes (e.g. an argparse.Namespace), overriding DEFAULT_CONFIG.
+                vocab_path is required.
+            ckpt_path: a checkpoint, or a directory whose latest checkpoint is loaded (e.g. the eval dir of an experiment)
+        """
+        config = dict(config if isinstance(config, dict) else vars(config))
+        unknown = set(config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise Exception("Unknown Rewriter settings: %s" % ', '.join(sorted(unknown)))
+        settings = dict(DEFAULT_CONFIG, **config)
+        if settings['vocab_path'] is None:
+            raise Exception("The Rewriter config needs a vocab_path")
+        if settings['decode_strategy'] not in ['beam', 'greedy', 'sample', 'adaptive']:
+            raise Exception("decode_strategy must be one of beam/greedy/sample/adaptive")
+        self._strategy = settings['decode_strategy']
+
+        hps_dict = {key: val for key, val in settings.items()
+                    if key not in ['vocab_path', 'vocab_size', 'decode_strategy', 'result_cache_path', 'result_cache_mb']}
+        hps_dict.update(_IGNORED_HPS)
+        self._hps = util.HParams(mode='decode', **hps_dict)
+        self._vocab = Vocab(settings['vocab_path'], settings['vocab_size'])
+
+        if os.path.isdir(ckpt_path):
+            latest = tf.train.latest_checkpoint(ckpt_path)
+            if latest is None:
+                latest = tf.train.latest_checkpoint(ckpt_path, latest_filename="checkpoint_best")
+            if latest is None:
+                raise Exception("No checkpoint found in %s" % ckpt_path)
+            ckpt_path = latest
+        self._ckpt_path = ckpt_path
+        self._result_cache = None
+        if settings['result_cache_path']:
+            self._result_cache = ResultCache(settings['result_cache_path'], int(settings['result_cache_mb'] * 1024 * 1024))
+
+        # The model gets its own graph, so that several Rewriters can live in one process
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._model = SummarizationModel(self._hps, self._vocab)
+            self._model.build_graph()
+            saver = tf.train.Saver()
+            self._sess = tf.Session(config=util.get_config())
+            tf.logging.info('Loading checkpoint %s', ckpt_path)
+            saver.restore(self._sess, ckpt_path)
+
+    @property
+    def result_cache(self):
+        """The ResultCache of the rewrites, with its hit and miss counters, or None if it is disabled."""
+        return self._result_cache
+
+    def rewrite_batch(self, dialogues):
+        """Rewrite the queries of the dialogues. Those missing from the result cache are decoded together as one batch.
+
+        Args:
+            dialogues: list of (context, query) pairs. The context is a list of turns,
+                or a string with the turns separated by '/'; the query is a string.
+
+        Returns:
+            list of strings; the rewritten query of each dialogue.
+        """
+        if not dialogues:
+            return []
+        return rewrite_with_cache(self._result_cache, self._ckpt_path, dialogues,
+                                  lambda misses: [rewrite for rewrite, _ in self.decode_batch(misses)])
+
+    def decode_batch(self, dialogues):
+        """Decode the dialogues as one batch, without the result cache.
+
+        Args:
+            dialogues: list of (context, query) pairs, see rewrite_batch.
+
+        Returns:
+            list of (rewrite, score) pairs, the score being the average log probability of the rewrite's tokens.
+        """
+        batch = dialogue_batch(dialogues, self._vocab, self._hps)
+        best_hyps, _ = decode_dialogues(self._sess, self._model, self._vocab, batch, self._strategy)
+        beam_size = self._hps.beam_size.value
+        return [(''.join(hypothesis_words(hyp, self._vocab, batch, d * beam_size)), hyp.avg_log_prob)
+                for d, hyp in enumerate(best_hyps)]
+
+    def close(self):
+        """Release the session and the result cache."""
+        self._sess.close()
+        if self._result_cache is not None:
+            self._result_cache.close()
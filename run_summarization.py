@@ -9,12 +9,13 @@ import tensorflow as tf
 import numpy as np
 from collections import namedtuple
 from data import Vocab
-from batcher import Batcher
+from batcher import Batcher, batch_dataset
 from model import SummarizationModel
 from decode import BeamSearchDecoder
+import rewrite_server
+from result_cache import ResultCache
 import util
 from tensorflow.python import debug as tf_debug
-from copy import deepcopy
 FLAGS = tf.app.flags.FLAGS
 
 # Where to find data
@@ -25,8 +26,22 @@ tf.app.flags.DEFINE_string(
 tf.app.flags.DEFINE_string('vocab_path', '../data/vocab.txt',
                            'Path expression to text vocabulary file.')
 
+# Input pipeline
+tf.app.flags.DEFINE_integer(
+    'input_workers', 0,
+    'If > 0, build the batches in this many worker processes instead of in input threads of the trainer.')
+tf.app.flags.DEFINE_integer(
+    'input_seed', -1,
+    'If >= 0, seed for shuffling the datafiles and batches, which makes the batch order reproducible.')
+tf.app.flags.DEFINE_boolean(
+    'use_tf_data', False,
+    'For train/eval mode. If True, read the batches through a prefetching tf.data pipeline inside the graph '\
+    'instead of feeding them, so that copying the next batch overlaps the current step.')
+tf.app.flags.DEFINE_integer('tf_data_prefetch', 4,
+                            'Number of batches prefetched by the tf.data pipeline.')
+
 # Important settings
-tf.app.flags.DEFINE_string('mode', 'train', 'must be one of train/eval/decode')
+tf.app.flags.DEFINE_string('mode', 'train', 'must be one of train/eval/decode/serve')
 tf.app.flags.DEFINE_boolean(
     'single_pass', False,
     'For decode mode only. '\
@@ -36,6 +51,25 @@ tf.app.flags.DEFINE_boolean(
     'If False (default), run concurrent decoding, i.e. repeatedly load latest checkpoint, '\
     'use it to produce summaries for randomly-chosen examples and log the results to screen, indefinitely.'
 )
+tf.app.flags.DEFINE_string(
+    'decode_dir', '',
+    'For single_pass decode mode. The directory to write the results to; by default a directory of log_root '\
+    'named after the dataset, the decoding flags and the checkpoint.')
+tf.app.flags.DEFINE_boolean(
+    'resume_decode', False,
+    'For single_pass decode mode. If the decode directory exists, continue decoding into it after the examples '\
+    'recorded in its progress.json, instead of refusing to start. The input and checkpoint must be the same.')
+tf.app.flags.DEFINE_integer(
+    'num_decode_shards', 1,
+    'For single_pass decode mode. Split the dataset into this many shards, of the examples whose index is '\
+    'the same modulo num_decode_shards, and only decode shard decode_shard. See decode_shards.py.')
+tf.app.flags.DEFINE_integer('decode_shard', 0, 'The shard decoded with num_decode_shards > 1.')
+tf.app.flags.DEFINE_integer(
+    'intra_op_threads', 0,
+    'In decode mode, the number of threads of the decoder session for the work inside an op (0: one per core).')
+tf.app.flags.DEFINE_integer(
+    'inter_op_threads', 0,
+    'In decode mode, the number of threads of the decoder session for running ops in parallel (0: one per core).')
 tf.app.flags.DEFINE_string('encoder_type', 'bi', 'encode type')
 # Where to save output
 tf.app.flags.DEFINE_string('log_root', './log',
@@ -50,12 +84,79 @@ tf.app.flags.DEFINE_integer('hidden_dim', 256,
                             'dimension of RNN hidden states')
 tf.app.flags.DEFINE_integer('emb_dim', 128, 'dimension of word embeddings')
 tf.app.flags.DEFINE_integer('batch_size', 64, 'minibatch size')
+tf.app.flags.DEFINE_integer(
+    'max_batch_tokens', 0,
+    'If > 0, train/eval batches are formed by this budget of padded (context + query + max_dec_steps) tokens '\
+    'instead of batch_size examples, and the batch dimension of the graph is dynamic.')
 tf.app.flags.DEFINE_integer(
     'max_enc_steps', 50, 'max timesteps of encoder (max source text tokens)')
 tf.app.flags.DEFINE_integer('beam_size', 4,
                             'beam size for beam search decoding.')
+tf.app.flags.DEFINE_boolean(
+    'no_rewrite_gate', False,
+    'Train a classifier predicting from the encoder states whether the rewrite is the query itself. '\
+    'Eval mode logs its precision; in decode mode the dialogues it is confident about are not decoded.')
+tf.app.flags.DEFINE_float(
+    'no_rewrite_threshold', 0.9,
+    'With no_rewrite_gate, the gate probability from which the query is returned as its own rewrite '\
+    '(in decode mode) or counted as such (in eval mode). Above 1 never skips decoding.')
+tf.app.flags.DEFINE_integer('serve_port', 8000, 'In serve mode, the port of the rewrite server.')
+tf.app.flags.DEFINE_integer(
+    'serve_max_batch_size', 16,
+    'In serve mode, the maximum number of dialogues decoded together.')
+tf.app.flags.DEFINE_float(
+    'serve_max_wait_ms', 5.0,
+    'In serve mode, the maximum milliseconds a batch waits after its first request for more requests.')
+tf.app.flags.DEFINE_string(
+    'serve_strategy', 'greedy',
+    'In serve mode, the decode strategy (see decode_strategy). Greedy has the lowest latency.')
+tf.app.flags.DEFINE_string(
+    'result_cache_path', '',
+    'In serve mode, if not empty, a SQLite file caching the rewrite of each distinct dialogue for the loaded checkpoint. '\
+    'The entries of other checkpoints are dropped when a new checkpoint uses it.')
+tf.app.flags.DEFINE_float('result_cache_mb', 64.0,
+                          'Maximum MB of text in the result cache; the least recently used entries are evicted.')
+tf.app.flags.DEFINE_string(
+    'decode_strategy', 'beam',
+    'must be one of beam/greedy/sample/adaptive. greedy and sample decode a single hypothesis for each dialogue '\
+    'without beam search bookkeeping; greedy is the fastest. adaptive starts each dialogue with a beam of 1 '\
+    'and widens it up to beam_size when the most likely candidates are close.')
+tf.app.flags.DEFINE_float(
+    'adaptive_beam_margin', 0.5,
+    'For the adaptive decode strategy, the beam is widened when the average log probabilities '\
+    'of the two most likely candidates are less than this apart.')
+tf.app.flags.DEFINE_float(
+    'decode_time_budget', 0.0,
+    'For the adaptive decode strategy, if > 0, seconds after which decoding a batch stops '\
+    'and each dialogue takes its best hypothesis so far.')
+tf.app.flags.DEFINE_integer(
+    'sample_top_k', 4,
+    'For the sample decode strategy, number of most likely tokens to sample from. At most 2*beam_size.')
+tf.app.flags.DEFINE_float(
+    'sample_temperature', 1.0,
+    'For the sample decode strategy, the log probabilities are divided by this before sampling.')
+tf.app.flags.DEFINE_boolean(
+    'in_graph_beam_search', False,
+    'Run the whole beam search inside the graph as a tf.while_loop, with one session.run per decode batch '\
+    'instead of one per decoder step.')
+tf.app.flags.DEFINE_integer(
+    'decode_batch_dialogues', 1,
+    'Number of dialogues decoded together in decode mode. A decode batch holds beam_size hypotheses for each.')
+tf.app.flags.DEFINE_float(
+    'encoder_cache_mb', 0.0,
+    'In decode/serve mode, if > 0, keep the context encoder outputs of the most recently decoded contexts '\
+    'in this many MB, so that a repeated context only runs the query encoder.')
 tf.app.flags.DEFINE_integer('max_dec_steps', 30,
                             'max timesteps of decoder (max summary tokens)')
+tf.app.flags.DEFINE_integer(
+    'dec_steps_slack', -1,
+    'If >= 0, in decode mode each dialogue is decoded for at most its query length plus this many steps '\
+    '(and at most max_dec_steps). See length_stats.py to choose it from the training set. '\
+    'Not used by in_graph_beam_search.')
+tf.app.flags.DEFINE_boolean(
+    'early_stop_beam', False,
+    'In beam search decoding, stop a dialogue once no hypothesis in its beam can get a higher average '\
+    'log probability than its best finished hypothesis.')
 tf.app.flags.DEFINE_integer(
     'min_dec_steps', 5,
     'Minimum sequence length of generated summary. Applies only for beam search decoding mode'
@@ -77,6 +178,15 @@ tf.app.flags.DEFINE_float(
     'trunc_norm_init_std', 1e-4,
     'std of trunc norm init, used for initializing everything else')
 tf.app.flags.DEFINE_float('max_grad_norm', 2.0, 'for gradient clipping')
+tf.app.flags.DEFINE_boolean(
+    'dynamic_decoder', False,
+    'In train/eval mode, run the decoder in a tf.while_loop up to the longest target in the batch '\
+    'instead of unrolling max_dec_steps steps in the graph. Same variables and loss.')
+tf.app.flags.DEFINE_boolean(
+    'copy_source_space', False,
+    'Compute the probabilities of the target words from the attention over the matching source positions, '\
+    'and run the decode top-k over the distinct source tokens, instead of projecting the attention onto '\
+    'the extended vocabulary. Same loss, but the cost per step scales with the dialogue length instead of the vocab size.')
 
 # Pointer-generator or baseline model
 tf.app.flags.DEFINE_boolean(
@@ -245,7 +355,8 @@ def run_training(model, batcher, sess_context_manager, sv, summary_writer):
             sess = tf_debug.LocalCLIDebugWrapperSession(sess)
             sess.add_tensor_filter("has_inf_or_nan", tf_debug.has_inf_or_nan)
         while True:  # repeats until interrupted
-            batch = batcher.next_batch()
+            # with tf.data the model reads the batch itself
+            batch = None if FLAGS.use_tf_data else batcher.next_batch()
 
             tf.logging.info('running training step...')
             t0 = time.time()
@@ -289,10 +400,13 @@ def run_eval(model, batcher, vocab):
     summary_writer = tf.summary.FileWriter(eval_dir)
     running_avg_loss = 0  # the eval job keeps a smoother, running average loss to tell it when to implement early stopping
     best_loss = None  # will hold the best loss achieved so far
+    # counts of the no-rewrite gate predictions: true positives, false positives, false negatives
+    gate_tp, gate_fp, gate_fn = 0, 0, 0
 
     while True:
         _ = util.load_ckpt(saver, sess)  # load a new checkpoint
-        batch = batcher.next_batch()  # get the next batch
+        # get the next batch; with tf.data the model reads the batch itself
+        batch = None if FLAGS.use_tf_data else batcher.next_batch()
 
         # run eval on the batch
         t0 = time.time()
@@ -306,6 +420,15 @@ def run_eval(model, batcher, vocab):
         if FLAGS.coverage:
             coverage_loss = results['coverage_loss']
             tf.logging.info("coverage_loss: %f", coverage_loss)
+        if FLAGS.no_rewrite_gate:
+            predicted = results['no_rewrite_prob'] >= FLAGS.no_rewrite_threshold
+            actual = results['no_rewrite'] > 0.5
+            gate_tp += np.sum(predicted & actual)
+            gate_fp += np.sum(predicted & ~actual)
+            gate_fn += np.sum(~predicted & actual)
+            tf.logging.info("no-rewrite gate precision: %.3f, recall: %.3f (%i skipped)",
+                            gate_tp / max(gate_tp + gate_fp, 1), gate_tp / max(gate_tp + gate_fn, 1),
+                            gate_tp + gate_fp)
 
         # add summaries
         summaries = results['summaries']
@@ -355,23 +478,41 @@ def main(unused_argv):
 
     vocab = Vocab(FLAGS.vocab_path, FLAGS.vocab_size)  # create a vocabulary
 
-    # If in decode mode, set batch_size = beam_size
-    # Reason: in decode mode, we decode one example at a time.
-    # On each step, we have beam_size-many hypotheses in the beam, so we need to make a batch of these hypotheses.
+    # The rewrite server runs the model as in decode mode
+    serve = FLAGS.mode == 'serve'
+    if serve:
+        FLAGS.mode = 'decode'
+
+    # If in decode mode, set batch_size = decode_batch_dialogues * beam_size
+    # Reason: in decode mode, we decode decode_batch_dialogues examples at a time.
+    # On each step, we have beam_size-many hypotheses in the beam of each example, so we need to make a batch of these hypotheses.
     if FLAGS.mode == 'decode':
-        FLAGS.batch_size = FLAGS.beam_size
+        FLAGS.batch_size = FLAGS.decode_batch_dialogues * FLAGS.beam_size
+
+    for strategy in [FLAGS.decode_strategy, FLAGS.serve_strategy]:
+        if strategy not in ['beam', 'greedy', 'sample', 'adaptive']:
+            raise Exception("The decode_strategy and serve_strategy flags must be one of beam/greedy/sample/adaptive")
+    if FLAGS.sample_top_k < 1 or FLAGS.sample_top_k > 2 * FLAGS.beam_size:
+        raise Exception("sample_top_k should be between 1 and 2*beam_size")
 
     # If single_pass=True, check we're in decode mode
     if FLAGS.single_pass and FLAGS.mode != 'decode':
         raise Exception(
             "The single_pass flag should only be True in decode mode")
+    if FLAGS.num_decode_shards > 1 and not FLAGS.single_pass:
+        raise Exception("num_decode_shards should only be set in single_pass decode mode")
+    if not 0 <= FLAGS.decode_shard < FLAGS.num_decode_shards:
+        raise Exception("decode_shard should be between 0 and num_decode_shards-1")
 
     # Make a namedtuple hps, containing the values of the hyperparameters that the model needs
     hparam_list = [
         'mode', 'learning_rate', 'adagrad_init_acc', 'rand_unif_init_mag',
         'trunc_norm_init_std', 'max_grad_norm', 'hidden_dim', 'emb_dim',
-        'batch_size','encoder_type', 'max_dec_steps', 'max_enc_steps', 'coverage',
-        'cov_loss_wt', 'pointer_gen'
+        'batch_size', 'max_batch_tokens', 'encoder_type', 'max_dec_steps', 'max_enc_steps', 'coverage',
+        'cov_loss_wt', 'pointer_gen', 'dynamic_decoder', 'copy_source_space',
+        'beam_size', 'decode_batch_dialogues', 'in_graph_beam_search', 'no_rewrite_gate',
+        'min_dec_steps', 'dec_steps_slack', 'early_stop_beam', 'sample_top_k', 'sample_temperature',
+        'adaptive_beam_margin', 'decode_time_budget', 'no_rewrite_threshold', 'encoder_cache_mb'
     ]
     hps_dict = {}
     for key, val in FLAGS.__flags.items():  # for each flag
@@ -379,32 +520,43 @@ def main(unused_argv):
             hps_dict[key] = val  # add it to the dict
     hps = namedtuple("HParams", hps_dict.keys())(**hps_dict)
 
-    # Create a batcher object that will create minibatches of data
-    batcher = Batcher(
-        FLAGS.data_path, vocab, hps, single_pass=FLAGS.single_pass)
+    # Create a batcher object that will create minibatches of data. The rewrite server makes its own batches
+    batcher = None if serve else Batcher(
+        FLAGS.data_path, vocab, hps, single_pass=FLAGS.single_pass,
+        num_workers=FLAGS.input_workers,
+        seed=FLAGS.input_seed if FLAGS.input_seed >= 0 else None,
+        shard=(FLAGS.decode_shard, FLAGS.num_decode_shards) if FLAGS.num_decode_shards > 1 else None)
 
     tf.set_random_seed(42)  # a seed value for randomness
 
+    # In train/eval mode the batches can be read through a tf.data pipeline instead of being fed
+    input_dataset = None
+    if FLAGS.use_tf_data and hps.mode.value in ['train', 'eval']:
+        input_dataset = batch_dataset(batcher, hps, FLAGS.tf_data_prefetch)
+
     if hps.mode.value == 'train':
         print("creating model...")
-        model = SummarizationModel(hps, vocab)
+        model = SummarizationModel(hps, vocab, input_dataset)
         setup_training(model, batcher)
     elif hps.mode.value == 'eval':
-        model = SummarizationModel(hps, vocab)
+        model = SummarizationModel(hps, vocab, input_dataset)
         run_eval(model, batcher, vocab)
     elif hps.mode.value == 'decode':
-        decode_model_hps = deepcopy(hps)  # This will be the hyperparameters for the decoder model
-        decode_model_hps.max_dec_steps.value = 1
-        # The model is configured with max_dec_steps=1
-        # because we only ever run one step of the decoder at a time (to do beam search).
-        # Note that the batcher is initialized with max_dec_steps equal to e.g. 100
-        # because the batches need to contain the full summaries
-        model = SummarizationModel(decode_model_hps, vocab)
+        # The model runs one step of the decoder at a time (to do beam search),
+        # while the batches contain the full summaries, up to max_dec_steps
+        model = SummarizationModel(hps, vocab)
         decoder = BeamSearchDecoder(model, batcher, vocab)
-        # decode indefinitely (unless single_pass=True, in which case deocde the dataset exactly once)
-        decoder.decode()
+        if serve:
+            result_cache = None
+            if FLAGS.result_cache_path:
+                result_cache = ResultCache(FLAGS.result_cache_path, int(FLAGS.result_cache_mb * 1024 * 1024))
+            rewrite_server.serve(decoder, vocab, hps, FLAGS.serve_port, FLAGS.serve_max_batch_size,
+                                 FLAGS.serve_max_wait_ms / 1000, FLAGS.serve_strategy, result_cache)
+        else:
+            # decode indefinitely (unless single_pass=True, in which case deocde the dataset exactly once)
+            decoder.decode()
     else:
-        raise ValueError("The 'mode' flag must be one of train/eval/decode")
+        raise ValueError("The 'mode' flag must be one of train/eval/decode/serve")
 
 
 if __name__ == '__main__':
@@ -21,13 +21,38 @@ import os
 FLAGS = tf.app.flags.FLAGS
 
 
-def get_config():
-    """Returns config for tf.session"""
-    config = tf.ConfigProto(allow_soft_placement=True)
+def get_config(intra_op_threads=0, inter_op_threads=0):
+    """Returns config for tf.session. The thread pool sizes default to the number of cores (0)."""
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
     config.gpu_options.allow_growth = True
     return config
 
 
+class HParam(object):
+    """Holds the value of one hyperparameter, like the flag objects in the hps built in run_summarization.py."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class HParams(object):
+    """Plain container of hyperparameters, accessed like the hps namedtuple of flag objects (hps.<name>.value).
+    Unlike flag objects, it can be pickled, e.g. to send it to another process."""
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            setattr(self, name, HParam(value))
+
+
+def plain_hps(hps):
+    """Returns a HParams copy of the hps namedtuple of flag objects."""
+    if isinstance(hps, HParams):
+        return hps
+    return HParams(**{name: flag.value for name, flag in hps._asdict().items()})
+
+
 def load_ckpt(saver, sess, ckpt_dir="train"):
     """
     Load checkpoint from the ckpt_dir (if unspecified, this is train dir) 